@@ -3,6 +3,7 @@ from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv()) # read local .env file
 import markdown
 import secrets
+import unicodedata
 import zipfile
 import concurrent.futures
 from io import BytesIO
@@ -10,9 +11,10 @@ import logging
 from datetime import datetime
 
 from flask import (Flask, redirect, render_template, request,
-                   send_from_directory, url_for, flash, send_file, jsonify)
+                   send_from_directory, url_for, flash, send_file, jsonify, Response, stream_with_context)
 from werkzeug.utils import secure_filename
-from azure.core.exceptions import ResourceNotFoundError
+from urllib.parse import quote
+from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError
 
 from app_functions import findByHSCode
 from app_functions import findBySCCode
@@ -23,6 +25,9 @@ from app_functions import file_management as fm
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
 from data_stores.AzureTableObjects import AzureTableObjects as ato
 from data_stores.DataStores import DataStores as ds
+from data_stores.FileCatalog import FileCatalog
+from data_stores.ReleaseRegistry import ReleaseRegistry
+from data_stores.LocalVectorIndex import LocalVectorIndex
 from initializers.extract_data_for_review import convertPDFToExcelForReview
 from data_stores.AzureTableObjects import MutexError
 import log_handling
@@ -31,15 +36,26 @@ from app_functions import compare as comp
 import config
 from app_functions import lineitems_to_csv as l2c
 from app_functions import full_export
+from app_functions import export_artifacts
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY')  # Needed for flask flash messages, which is used to communicate success/error messages with user
 app.config['MAX_CONTENT_LENGTH'] = config.flask_max_accepted_file_size # Max accepted file size by Flask app
 
-log_handling.configure_logging()
-
-try: ds.updateJSONdictsFromAzureBlob() # update the on-memory json-store from Azure blob
-except Exception as e: logging.error(f'Cannot run updateJSONdictsFromAzureBlob at app launch: {e}')
+def start_background_services():
+    """Loads the on-memory json-store and starts the background syncs. Only called by the process serving the app."""
+    try: ds.updateJSONdictsFromAzureBlob() # update the on-memory json-store from Azure blob
+    except Exception as e: logging.error(f'Cannot run updateJSONdictsFromAzureBlob at app launch: {e}')
+    ds.startBackgroundSync() # keep the on-memory json-store of this worker in sync with chapters uploaded/deleted through other workers
+    FileCatalog.startBackgroundRefresh() # keep the file management page's listings in sync with files uploaded/deleted through other workers
+    ReleaseRegistry.startBackgroundRefresh() # keep the declared releases (search page filters) in sync with releases added/removed through other workers
+    if config.vectorstore == "local_numpy": LocalVectorIndex.startBackgroundBackfill() # make the vector snapshots of chapters ingested before they were written (searches go to cosmos until then)
+
+# When the app is run with python app.py, the PDF extraction worker processes (see extract_data_for_review) import this module again, as __mp_main__.
+# They must not load the json-store or poll Azure, and their logs are forwarded to this process.
+if __name__ != '__mp_main__':
+    log_handling.configure_logging()
+    start_background_services()
 
 # If any of these functions run into an error, exception handling is automatically done by Flask itself. App does not crash and error is logged.
 
@@ -434,6 +450,21 @@ def view_jobs():
     activeJobsSorted,completedJobsSorted = ato.get_all_jobs_classified()
     return render_template('jobs.html', activeJobs=activeJobsSorted,completedJobs=completedJobsSorted)
 
+def csv_download_response(chunks, download_name: str, compress: bool) -> Response:
+    """Returns a response that streams the csv chunks (see lineitems_to_csv.stream_csv) as a file download (.csv, or .csv.gz if compress)."""
+    if compress: response = Response(stream_with_context(chunks), mimetype='application/gzip')
+    else: response = Response(stream_with_context(chunks), mimetype='text/csv')
+    download_name += '.csv.gz' if compress else '.csv'
+    # Content-Disposition built as send_file builds it: names that are not ascii get an ascii fallback (NFKD) and an RFC 5987 filename*
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': "UTF-8''" + quote(download_name, safe="!#$&+-.^_`|~")} # safe = RFC 5987 attr-char
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
 @app.route("/export_search_results", methods=["POST"])
 def export_search_results():
     """Endpoint for exporting search results as csv. Pass in data as json.
@@ -442,6 +473,7 @@ def export_search_results():
         user_query (str): __description__
         query_type (str): choose from available searches ['hscode','sccode','lineitem']
         options (list[str]): needed if query_type = 'lineitem'. This shoud be an array. eg: ["2024-08-05","2024-11-08"]
+        compression (str, optional): 'gzip' to get a gzipped csv (.csv.gz)
     """
     logging.info('Request for export_search_results received')
 
@@ -469,18 +501,55 @@ def export_search_results():
             results.append(result)
     
     # return jsonify(results)
-    file = l2c.convert_lineitems_to_csv(results)
-    response = send_file(file, as_attachment=True, download_name=f'{query_type}_search__{user_query}_{str(datetime.now())}.csv')
+    chunks = l2c.stream_csv(l2c.lineitems_to_rows(results), compress=data.get('compression') == 'gzip')
+    return csv_download_response(chunks, f'{query_type}_search__{user_query}_{str(datetime.now())}', data.get('compression') == 'gzip')
+
+def artifact_download_response(properties, download_name: str) -> Response:
+    """Returns a response that sends a precomputed export (see export_artifacts) as a csv file download, or the byte range of it asked for in a Range header.
+    Returns None if the artifact was replaced since its properties were read."""
+    byteRange = None
+    if request.if_range.etag != None: ifRangeMatches = request.if_range.etag == properties.etag.strip('"')
+    elif request.if_range.date != None: ifRangeMatches = request.if_range.date == properties.last_modified.replace(microsecond=0) # HTTP dates are in whole seconds
+    else: ifRangeMatches = True # no If-Range header
+    if request.range != None and len(request.range.ranges) == 1 and ifRangeMatches: # otherwise the whole artifact is sent
+        byteRange = request.range.range_for_length(properties.size)
+        if byteRange == None: return Response(status=416, headers={'Content-Range': f'bytes */{properties.size}'})
+    start, end = byteRange if byteRange != None else (0, properties.size)
+    try: chunks = export_artifacts.stream_artifact(properties, start, end)
+    except (ResourceModifiedError, ResourceNotFoundError): return None
+    response = Response(stream_with_context(chunks), status=206 if byteRange != None else 200, mimetype='text/csv')
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(end - start)
+    if byteRange != None: response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{properties.size}'
+    response.set_etag(properties.etag.strip('"'))
+    response.last_modified = properties.last_modified
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name + '.csv')
     return response
 
-@app.route("/export_all_lineitems", methods=["POST"])
+@app.route("/export_all_lineitems", methods=["GET", "POST"])
 def export_all_lineitems():
-    """Endpoint to export all line items in the json store."""
+    """Endpoint to export all line items in the json store.
+    The whole store, or a single release, is sent from its precomputed export (see export_artifacts) when that is current, with support for Range requests.
+    Otherwise (or with other filters) the csv is streamed while it is being made.
+
+    Args (form fields or query parameters, all optional):
+        releases (list[str]): only export line items of these releases. eg: releases=2024-08-05&releases=2024-11-08
+        chapters (list[int]): only export line items of these chapters
+        compression (str): 'gzip' to get a gzipped csv (.csv.gz)
+    """
     logging.info('Request for export_all_lineitems received')
-    results = full_export.get_all_lineitems()
-    file = l2c.convert_lineitems_to_csv(results)
-    response = send_file(file, as_attachment=True, download_name=f'all_lineitems_{str(datetime.now())}.csv')
-    return response
+    releases = request.values.getlist('releases') or None
+    try: chapterNumbers = [int(chapter) for chapter in request.values.getlist('chapters')] or None
+    except ValueError: return jsonify({'error': 'chapters must be chapter numbers'}), 400
+    compress = request.values.get('compression') == 'gzip'
+    logging.info(f'export_all_lineitems endpoint - releases: {releases}, chapters: {chapterNumbers}, compression: {compress}')
+    if not compress and chapterNumbers == None and (releases == None or len(releases) == 1):
+        properties = export_artifacts.get_current_artifact(releases[0] if releases != None else None)
+        if properties != None:
+            response = artifact_download_response(properties, f"all_lineitems_{properties.last_modified.strftime('%Y%m%d_%H%M%S')}")
+            if response != None: return response
+    rows = full_export.iter_all_lineitem_rows(l2c.column_order, releases, chapterNumbers)
+    return csv_download_response(l2c.stream_csv(rows, compress), f"all_lineitems_{datetime.now().strftime('%Y%m%d_%H%M%S')}", compress)
 
 if __name__ == '__main__':
    app.run()
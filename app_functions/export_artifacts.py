@@ -0,0 +1,133 @@
+# Precomputed csv exports of the json store (one per release, and one of the whole store), kept in config.export_artifact_container_name.
+# Each artifact is tagged (blob metadata 'dataversion') with the content fingerprint of the chapters it was made from (see DataStores.getContentFingerprint),
+# so a request can tell whether it is current and have it sent as a plain blob download instead of making the csv again.
+
+import time
+import hashlib
+import logging
+import threading
+from collections.abc import Iterator
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties, ContentSettings
+
+import config
+from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+from data_stores.DataStores import DataStores
+from app_functions import lineitems_to_csv as l2c
+from app_functions import full_export
+
+__pending_releases: set[str] = set() # releases whose artifact must be made again (the whole store's artifact is made again with them)
+__last_scheduled: float = 0.0
+__condition = threading.Condition()
+__builder_thread: threading.Thread = None
+
+
+def __getArtifactName(release: str = None) -> str:
+    return f'releases/{release}.csv' if release != None else 'all_lineitems.csv'
+
+def __getDataVersion(release: str = None) -> str:
+    """The tag of an artifact that is current: the content fingerprint of the chapters exported, combined with the csv columns (so a change to those also makes artifacts stale)."""
+    fingerprint = DataStores.getContentFingerprint([release] if release != None else None)
+    return hashlib.sha256((fingerprint + '|' + ','.join(l2c.column_order)).encode('utf-8')).hexdigest()
+
+def __buildArtifact(release: str = None) -> None:
+    """Makes the csv of a release (of the whole store if None) from the json store held in memory and uploads it, streamed, unless the artifact in storage is already current.
+    The artifact of a release that no longer has any chapters is deleted.
+    """
+    blob_client = abo.get_container_client(config.export_artifact_container_name).get_blob_client(__getArtifactName(release))
+    dataVersion = __getDataVersion(release)
+    try:
+        if blob_client.get_blob_properties().metadata.get('dataversion') == dataVersion: return
+    except ResourceNotFoundError: pass
+
+    if release != None and not any(key[1] == release for key in DataStores.getJson_dicts().keys()):
+        try: blob_client.delete_blob()
+        except ResourceNotFoundError: pass
+        logging.info(f'Export artifact of release {release} deleted, the release has no chapters')
+        return
+
+    startTime = time.perf_counter()
+    rows = full_export.iter_all_lineitem_rows(l2c.column_order, [release] if release != None else None)
+    blob_client.upload_blob(l2c.stream_csv(rows), blob_type="BlockBlob", overwrite=True, metadata={'dataversion': dataVersion},
+                            content_settings=ContentSettings(content_type='text/csv'))
+    if __getDataVersion(release) != dataVersion: # the json store changed while the csv was being made, so the artifact may hold some of both
+        blob_client.set_blob_metadata({'dataversion': 'mixed'})
+        schedule_regeneration(release)
+    logging.info(f"Export artifact {__getArtifactName(release)} made in {time.perf_counter() - startTime:.1f} s")
+
+def __buildPendingArtifacts() -> None:
+    """Runs in the builder thread. Waits until config.export_artifact_delay_seconds have passed since the last change was scheduled
+    (so that a batch of uploads/deletions is exported once), then makes the artifacts of the changed releases and of the whole store.
+    """
+    global __pending_releases
+    while True:
+        with __condition:
+            while len(__pending_releases) == 0: __condition.wait()
+            while time.monotonic() - __last_scheduled < config.export_artifact_delay_seconds:
+                __condition.wait(config.export_artifact_delay_seconds - (time.monotonic() - __last_scheduled))
+            releases, __pending_releases = __pending_releases, set()
+        for release in sorted(release for release in releases if release != None) + [None]:
+            try: __buildArtifact(release)
+            except Exception as e: logging.error(f'Export artifact {__getArtifactName(release)} could not be made: {e}')
+
+def schedule_regeneration(release: str) -> None:
+    """Schedules the export artifacts of a release and of the whole store to be made again in the background (call after a chapter of the release was added, changed or deleted).
+
+    Args:
+        release (str): _description_
+    """
+    global __builder_thread, __last_scheduled
+    with __condition:
+        __pending_releases.add(release)
+        __last_scheduled = time.monotonic()
+        if __builder_thread == None:
+            __builder_thread = threading.Thread(target=__buildPendingArtifacts, name='export-artifact-builder', daemon=True)
+            __builder_thread.start()
+        __condition.notify_all()
+
+def __scheduleIfNotPending(release: str) -> None:
+    """Schedules the artifact of a release to be made again, unless it already is (so that requests for it do not keep putting off the build, see __buildPendingArtifacts)."""
+    with __condition:
+        if release not in __pending_releases: schedule_regeneration(release)
+
+def get_current_artifact(release: str = None) -> BlobProperties:
+    """Returns the properties of the export artifact of a release (of the whole store if None) if it is current, i.e. made from the same chapters this process holds.
+    If there is no artifact yet, or it is not current (eg: the chapters were changed through another worker/instance and picked up by the json store's background sync), it is scheduled to be made.
+
+    Args:
+        release (str, optional): _description_. Defaults to None.
+
+    Returns:
+        BlobProperties: properties of the artifact (eg: 'size', 'etag', 'last_modified'), None if it is not current
+    """
+    blob_client = abo.get_container_client(config.export_artifact_container_name).get_blob_client(__getArtifactName(release))
+    try: properties = blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        if release == None or any(key[1] == release for key in DataStores.getJson_dicts().keys()): __scheduleIfNotPending(release)
+        return None
+    if properties.metadata.get('dataversion') != __getDataVersion(release):
+        __scheduleIfNotPending(release) # the builder checks the version again, so an artifact made by another worker meanwhile is not made twice
+        return None
+    return properties
+
+def stream_artifact(properties: BlobProperties, start: int = 0, end: int = None) -> Iterator[bytes]:
+    """Returns the chunks of (a byte range of) an export artifact. The download is started (and so checked to still be the artifact of the given properties) before returning.
+
+    Args:
+        properties (BlobProperties): of the artifact (see get_current_artifact)
+        start (int, optional): first byte. Defaults to 0.
+        end (int, optional): byte after the last one (None for the end of the artifact). Defaults to None.
+
+    Raises:
+        ResourceModifiedError: If the artifact was replaced since properties were read
+
+    Returns:
+        Iterator[bytes]: chunks of the artifact
+    """
+    blob_client = abo.get_container_client(config.export_artifact_container_name).get_blob_client(properties.name)
+    length = (properties.size if end == None else end) - start
+    if length == 0: return iter([])
+    downloader = blob_client.download_blob(offset=start, length=length, etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+    return downloader.chunks()
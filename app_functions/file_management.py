@@ -1,5 +1,7 @@
 import secrets
 import logging
+import time
+import threading
 import concurrent.futures
 from io import BytesIO
 
@@ -9,11 +11,15 @@ import openpyxl as oxl
 
 from data_stores.AzureTableObjects import AzureTableObjects as ato
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+from data_stores.FileCatalog import FileCatalog
+from data_stores.ReleaseRegistry import ReleaseRegistry
 from initializers import deletingFuncs as delf
 from initializers import extract_data_for_review
 from data_stores.AzureTableObjects import MutexError
 from initializers.extract_data_to_json_store import extract_data_to_json_store
 from initializers.create_vectorstore import update_vectorstore
+from app_functions import export_artifacts
+from other_funcs.memoryBudget import MemoryBudget
 import config
 
 def allowed_file(filename: str, extension: str) -> bool:
@@ -43,19 +49,19 @@ def validateUpload(extension: str, file: FileStorage) -> str:
 def generateArrayForTableRows() -> list[list[str]]:
     """Generates the list required to construct the dynamic table in the file management interface.
     The list contains lists representing items in a single table row (i.e. file names, and status)
+    The blob names and chapter records are read from the in-memory FileCatalog, not listed from storage on each call.
 
     Returns:
         list[list[str]]: table rows
     """
     tableRows: list[list[str]] = []
     # listOfPDFNames = abo.getListOfFilenamesInContainer(config.pdf_container_name) # no need bcuz there if a record exists for a chapter, it will definitely have a PDF
-    listOfGeneratedExcelNames = abo.getListOfFilenamesInContainer(config.generatedExcel_container_name)
-    listOfReviewedExcelNames = abo.getListOfFilenamesInContainer(config.reviewedExcel_container_name)
-    listOfJSONs = abo.getListOfFilenamesInContainer(config.json_container_name)
-    entities = ato.get_all_chapter_records()
-    for entity in entities:
-        release_date = entity['RowKey'].rsplit(':')[0]
-        chapterNumber = entity['RowKey'].rsplit(':')[1]
+    listOfGeneratedExcelNames = FileCatalog.getBlobNames(config.generatedExcel_container_name)
+    listOfReviewedExcelNames = FileCatalog.getBlobNames(config.reviewedExcel_container_name)
+    listOfJSONs = FileCatalog.getBlobNames(config.json_container_name)
+    for rowkey, status in FileCatalog.getChapterRecordStatuses():
+        release_date = rowkey.rsplit(':')[0]
+        chapterNumber = rowkey.rsplit(':')[1]
         excelName = chapterNumber + '.xlsx'
         jsonName = chapterNumber + '.json'
         tableRow = [release_date,chapterNumber,f'{chapterNumber}.pdf']
@@ -65,7 +71,6 @@ def generateArrayForTableRows() -> list[list[str]]:
         else: tableRow.append('Nil')
         if f'{release_date}/{jsonName}' in listOfJSONs: tableRow.append(jsonName)
         else: tableRow.append('Nil')
-        status = entity['RecordStatus']
         tableRow += [status]
         tableRows.append(tableRow)
     return tableRows
@@ -79,10 +84,12 @@ def delete_upto_corrected_excel(chapterNumber: int, release: str):
     with concurrent.futures.ThreadPoolExecutor() as executor:
         futures = [
             executor.submit(delf.deleteChapterFromCosmos, chapterNumber, release), 
+            executor.submit(delf.deleteChapterVectorSnapshotBlob, chapterNumber, release), 
             executor.submit(delf.deleteChapterJsonBlob, chapterNumber, release), 
             executor.submit(delf.deleteChapterReviewedExcelBlob, chapterNumber, release)
         ]
         concurrent.futures.wait(futures)
+    export_artifacts.schedule_regeneration(release) # the chapter's line items are no longer in the json store
 
     ato.set_job_progress(job_id, 'done')
     ato.end_job(job_id)
@@ -107,7 +114,8 @@ def delete_upto_pdf(chapterNumber: int, release: str):
     
 def upload_pdf(pdffile: BytesIO, release_date: str,user_entered_chapter_number: int = None, filename: str = None, is_called_by_batch: bool = False):
     """Basically does the entire uploadPDF stage mentioned in section 3.1.3 in the developer guide.
-    is_called_by_batch argument is used if the function is calle by batch_upload_pdf - if False, this function will handle job tracking"""
+    is_called_by_batch argument is used if the function is calle by batch_upload_pdf - if False, this function will handle job tracking
+    Returns whether the chapter was uploaded."""
     
     if not is_called_by_batch:
         job_id = ato.create_new_job('upload_pdf', f'release_date: {release_date}, user_entered_chapter_number: {user_entered_chapter_number}, filename: {filename}')
@@ -124,7 +132,7 @@ def upload_pdf(pdffile: BytesIO, release_date: str,user_entered_chapter_number:
         if not is_called_by_batch:
             ato.set_job_progress(job_id, 'error with pdf')
             ato.end_job(job_id)
-        return
+        return False
     
     
     try: ato.create_new_blank_chapter_record(chapterNumber, release_date)
@@ -133,14 +141,14 @@ def upload_pdf(pdffile: BytesIO, release_date: str,user_entered_chapter_number:
         if not is_called_by_batch:
             ato.set_job_progress(job_id, 'record already existed')
             ato.end_job(job_id)
-        return
+        return False
 
     mutexKey = secrets.token_hex()
     try: ato.claim_mutex(chapterNumber, mutexKey, release_date)
     except MutexError as e:
         logging.error(e.__str__())
         if not is_called_by_batch: ato.end_job(job_id)
-        return
+        return False
     ato.edit_chapter_record(chapterNumber, mutexKey, release_date, newRecordStatus=config.RecordStatus.uploadingPDF)
     pdffile.seek(0)
     abo.upload_to_blob_from_stream(pdffile, config.pdf_container_name, f'{release_date}/{chapterNumber}.pdf') # PDF uploaded to azure blob
@@ -156,19 +164,51 @@ def upload_pdf(pdffile: BytesIO, release_date: str,user_entered_chapter_number:
     if not is_called_by_batch:
         ato.set_job_progress(job_id, 'done')
         ato.end_job(job_id)
+    return True
 
 def batch_upload_pdfs(pdffiles: list[BytesIO], release_date: str, filenames: list[str] = None):
+    """Does the uploadPDF stage (see upload_pdf) for many chapters, up to config.batch_upload_pdf_workers chapters at the same time.
+    Chapters only start while their estimated memory use fits in config.batch_upload_memory_budget_bytes (see MemoryBudget).
+    The job's progress lists the filenames of the finished chapters ('failed: <filename>' for the ones that were not uploaded), and ChapterTimings the time each chapter took.
+    When all are finished, the progress is 'done (<filenames>)' if every chapter was uploaded, else '<count> of <total> failed (<filenames>)'.
+    """
     job_description = f'Release Date: {release_date} filenames: {filenames}'
     job_id = ato.create_new_job('batch_upload_pdfs', job_description)
-    for i,pdffile in enumerate(pdffiles): # uploads happen in series, so time taken for the total upload process is the same, but memory is saved
-        filename = filenames[i]
-        upload_pdf(pdffile,release_date,filename=filename, is_called_by_batch=True)
-        current_progress = ato.get_job_progress(job_id)
-        current_progress += filename + ','
-        ato.set_job_progress(job_id, current_progress)
-    current_progress = ato.get_job_progress(job_id)
-    if len(current_progress) > 0: current_progress = current_progress[:-1] # remove final ','
-    ato.set_job_progress(job_id, current_progress)
+    memory_budget = MemoryBudget(config.batch_upload_memory_budget_bytes)
+    done_filenames: list[str] = []
+    failed_filenames: list[str] = []
+    chapter_timings: list[str] = []
+    progress_lock = threading.Lock()
+
+    def upload_one(i: int):
+        """Helper function. Uploads the i-th PDF within the memory budget, then records its progress."""
+        pdffile, filename = pdffiles[i], filenames[i]
+        estimated_bytes = pdffile.getbuffer().nbytes * config.batch_upload_memory_per_pdf_byte
+        memory_budget.acquire(estimated_bytes)
+        start_time = time.perf_counter()
+        isSuccess = False
+        try: isSuccess = upload_pdf(pdffile,release_date,filename=filename, is_called_by_batch=True)
+        except Exception as e: logging.error(f'Uploading {filename} of release {release_date} failed: {e}')
+        finally:
+            memory_budget.release(estimated_bytes)
+            pdffiles[i] = None # the PDF is not needed anymore, let it be freed before the rest of the batch is done
+            pdffile.close()
+        seconds = time.perf_counter() - start_time
+        logging.info(f'{filename} of release {release_date} processed in {seconds:.1f} s')
+        with progress_lock:
+            done_filenames.append(filename if isSuccess else f'failed: {filename}')
+            if not isSuccess: failed_filenames.append(filename)
+            chapter_timings.append(f'{filename}: {seconds:.1f} s')
+            ato.update_job(job_id, {'Progress': ','.join(done_filenames), 'ChapterTimings': ', '.join(chapter_timings)}) # kept in memory, written periodically by the job tracker
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.batch_upload_pdf_workers) as executor:
+        futures = [executor.submit(upload_one, i) for i in range(len(pdffiles))]
+        concurrent.futures.wait(futures)
+    logging.log(25, f'Batch upload of {len(filenames)} PDFs of release {release_date} done in {time.perf_counter() - start_time:.1f} s')
+    if failed_filenames: logging.error(f'{len(failed_filenames)} of {len(filenames)} PDFs of release {release_date} could not be uploaded: {failed_filenames}')
+    status = 'done' if not failed_filenames else f'{len(failed_filenames)} of {len(filenames)} failed'
+    ato.set_job_progress(job_id, f"{status} ({','.join(done_filenames)})")
     ato.end_job(job_id)
 
 def upload_excel(excelfile: BytesIO, filename: str, release_date: str, user_entered_chapter_number: int = None, is_called_by_batch: bool = False):
@@ -206,6 +246,7 @@ def upload_excel(excelfile: BytesIO, filename: str, release_date: str, user_ente
     isSuccess = extract_data_to_json_store(excelfile, mutexKey, chapterNumber, release_date)
     if isSuccess:
         logging.log(25,'Excel and generated json successfully uploaded.')
+        export_artifacts.schedule_regeneration(release_date)
     else:
         logging.error(f'Excel was rejected due to an error. Maybe at least one of the HS codes provided did not match the entered chapter number. Excel: {filename}. Release: {release_date}')
         ato.release_mutex(chapterNumber, mutexKey, release_date)
@@ -241,18 +282,7 @@ def add_release(release: str):
     Currently not used to enforce anything.
     This system is used to make radio or dropdown buttons for filters in some html pages.
     """
-    existing_streamed = abo.download_blob_file_to_stream(config.release_holder_filename, config.release_holder_container_name)
-    existing_streamed.seek(0)
-    existing_text = existing_streamed.getvalue().decode('utf-8')
-    existing_releases = existing_text.rsplit('\n')
-    for existing_release in existing_releases:
-        _existing_release = existing_release.rstrip()
-        _release = release.rstrip()
-        if _existing_release == _release: return
-    new_text = existing_text + release + '\n'
-    new_streamed = BytesIO(new_text.encode('utf-8'))
-    new_streamed.seek(0)
-    abo.upload_to_blob_from_stream(new_streamed,config.release_holder_container_name,config.release_holder_filename)
+    ReleaseRegistry.addRelease(release)
 
 def remove_release(release: str):
     """Used to remove a release.
@@ -260,35 +290,16 @@ def remove_release(release: str):
     Currently not used to enforce anything.
     This system is used to make radio or dropdown buttons for filters in some html pages.
     """
-    existing_releases = get_stored_releases()
-    for i in range(0,len(existing_releases)):
-        existing_release = existing_releases[i]
-        _release = release.strip()
-        _existing_release = existing_release.strip()
-        if _release == _existing_release:
-            logging.info(f'Release {release} removed.') 
-            existing_releases.pop(i)
-            break
-    new_text = ''
-    for each in existing_releases:
-        if each.strip() == '': continue
-        new_text += each + '\n'
-    new_streamed = BytesIO(new_text.encode('utf-8'))
-    new_streamed.seek(0)
-    abo.upload_to_blob_from_stream(new_streamed,config.release_holder_container_name,config.release_holder_filename)
+    ReleaseRegistry.removeRelease(release)
 
 def get_stored_releases() -> list[str]:
     """Used to get declared releases.
     The functions add_release, remove_release and get_stored_releases can be used by front-end to offer dropdown menus for user to select release date.
     Currently not used to enforce anything.
     This system is used to make radio or dropdown buttons for filters in some html pages.
+    Served from memory (see ReleaseRegistry), so no storage I/O is done per call.
     """
-    existing_streamed = abo.download_blob_file_to_stream(config.release_holder_filename, config.release_holder_container_name)
-    existing_streamed.seek(0)
-    existing_text = existing_streamed.getvalue().decode('utf-8')
-    existing_releases = existing_text.rsplit('\n')
-    existing_releases=existing_releases[:-1] # last line is blank
-    return existing_releases
+    return ReleaseRegistry.getReleases()
 
 def does_excel_have_hscodeerrors(excel: BytesIO) -> bool:
     """Checks if a given excel (typically the generated excel) has hscode errors that the user must review."""
@@ -16,9 +16,6 @@ def findByHSCode(query: str, whitelist_releases: list[str] = None) -> list[dict]
      """
      if query == None or query == '': return[]
 
-     data_dict = DataStores.getJson_dicts()
-     
-     results = []
      chapterNumber = 0
 
      # find the chapter number from the hs code (we restrict the search just to that chapter)
@@ -35,43 +32,15 @@ def findByHSCode(query: str, whitelist_releases: list[str] = None) -> list[dict]
           logging.error(e)
           return []
 
-     keys = []
-     for key in data_dict.keys():
-          if key[0] == chapterNumber: keys.append(key)
-     if len(keys) == 0: return []
-     
-     for key in keys:
-          if whitelist_releases:
-               if key[1] not in whitelist_releases: continue
-          items = data_dict[key]["Items"]
-          for item in items:
-               # todo: implement binary search
-               if query in item["HS Code"]:
-                    item["Release"] = key[1] # Adding this because we want a link to the PDF to be displayed with the result
-                    item["Chapter Number"] = str(chapterNumber) # Adding this because we want a link to the PDF to be displayed with the result
-                    results.append(item)
-
-     # sorted_results = sorted(results, key=lambda x: (x["HS Code"], x["Release"]))
-     # I couldn't find a way to sort a list in python using built-in methods where the case is to sort by one field ascending
-     # and the other field descending, where neither field is unary.
-     # So had to implement a class
-     class Result:
-          def __init__(self, result):
-               self.result = result
-          def __lt__(self,other):
-               if self.result['HS Code'] < other.result['HS Code']: return True
-               if self.result['HS Code'] > other.result['HS Code']: return False
-               if self.result['HS Code'] == other.result['HS Code']:
-                    if self.result['Release'] > other.result['Release']: return True
-                    else: return False
-     
-     # sortng by HS code ascending, then release descending
-     result_objects = []
-     for result in results:
-          result_objects.append(Result(result))
-     result_objects.sort()
-     sorted_results = []
-     for object in result_objects:
-          sorted_results.append(object.result)
-     return sorted_results
+     # stored HS codes are standardized (####.##.##N), so chapters 1-9 carry a leading zero that the user may have left out (eg: 2 -> 02, 802.10 -> 0802.10)
+     headingPart = query if dotIndex == -1 else query[:dotIndex]
+     hscodePrefix = '0' + query if len(headingPart) % 2 == 1 else query
 
+     # the index is already sorted by HS code ascending, then release descending
+     results = []
+     for release, item in DataStores.searchHSCodeIndex(chapterNumber, hscodePrefix, whitelist_releases):
+          result = dict(item)
+          result["Release"] = release # Adding this because we want a link to the PDF to be displayed with the result
+          result["Chapter Number"] = str(chapterNumber) # Adding this because we want a link to the PDF to be displayed with the result
+          results.append(result)
+     return results
@@ -1,7 +1,13 @@
 from data_stores.DataStores import DataStores
 
 def findBySCCode(query: str) -> list[dict]:
-    """Temporariry implementation. May not be efficient.
+    """Searches the json store for line items with the given SC code, using the SC code index held by DataStores.
+
+    Args:
+        query (str): SC code query. eg: 'SC151', '151', or '51' (same as 'SC051')
+
+    Returns:
+        list[dict]: list of search results (line items), sorted by HS code ascending, then release descending
     """
     # formatting user query to match dictionary
     sccode = ''
@@ -12,18 +18,11 @@ def findBySCCode(query: str) -> list[dict]:
     else:
         sccode = query
 
-    data_dict = DataStores.getJson_dicts()
-    hscodes = []
-    for chapter in data_dict.keys():
-        chapter_dict = data_dict[chapter]
-        items = chapter_dict['Items']
-        for item in items:
-            if item['SC Code'] == sccode: hscodes.append(item['HS Code'])
-    
-    from app_functions import findByHSCode as fhs
     allResults = []
-    for hscode in hscodes:
-        results = fhs.findByHSCode(hscode)
-        allResults = allResults + results
+    for release, chapterNumber, item in DataStores.searchSCCodeIndex(sccode):
+        result = dict(item)
+        result["Release"] = release # Adding this because we want a link to the PDF to be displayed with the result
+        result["Chapter Number"] = str(chapterNumber) # Adding this because we want a link to the PDF to be displayed with the result
+        allResults.append(result)
     
     return allResults
\ No newline at end of file
@@ -1,19 +1,28 @@
+from collections.abc import Iterator
+
 from data_stores.DataStores import DataStores
 
-def get_all_lineitems() -> list[dict]:
-    """Gets all lineitems in the json store"""
+def iter_all_lineitem_rows(columns: list[str], releases: list[str] = None, chapterNumbers: list[int] = None) -> Iterator[list]:
+    """Yields the line items in the json store as rows of values, read column by column from the store (line items are not copied into dictionaries).
+    Only one chapter's rows are held at a time, so this can be used to stream an export of the whole store.
 
-    lineitems = []
+    Args:
+        columns (list[str]): columns of each row, in order. 'Release' and 'Chapter Number' are filled in from the chapter. None where a line item does not have the column.
+        releases (list[str], optional): If given, only line items of these releases. Defaults to None.
+        chapterNumbers (list[int], optional): If given, only line items of these chapters. Defaults to None.
 
-    chapter_dictionaries = DataStores.getJson_dicts()
-    for chapterNumber_releaseDate_combo in chapter_dictionaries.keys():
-        chapterNumber = chapterNumber_releaseDate_combo[0]
-        releaseDate = chapterNumber_releaseDate_combo[1]
-        chapter_dictionary = chapter_dictionaries[chapterNumber_releaseDate_combo]
+    Yields:
+        Iterator[list]: row of values in the order of columns
+    """
+    chapter_dictionaries = list(DataStores.getJson_dicts().items()) # the chapters are replaced (not changed) on updates, so this is a consistent snapshot to export from
+    for (chapterNumber, releaseDate), chapter_dictionary in chapter_dictionaries:
+        if releases != None and releaseDate not in releases: continue
+        if chapterNumbers != None and chapterNumber not in chapterNumbers: continue
         items = chapter_dictionary['Items']
-        for item in items: 
-            item['Release'] = releaseDate
-            item['Chapter Number'] = chapterNumber
-            lineitems.append(item)
-
-    return lineitems
\ No newline at end of file
+        values = []
+        for column in columns:
+            if column == 'Release': values.append([releaseDate] * len(items))
+            elif column == 'Chapter Number': values.append([chapterNumber] * len(items))
+            else: values.append(items.get_column(column))
+        for row in zip(*values):
+            yield list(row)
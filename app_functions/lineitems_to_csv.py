@@ -1,45 +1,77 @@
-from io import BytesIO
-
-import pandas as pd
-
-def convert_lineitems_to_csv(lineitems: list[dict]) -> BytesIO:
-
-    csv = BytesIO()
-
-    if lineitems == None or len(lineitems) == 0:
-        blank_df = pd.DataFrame()
-        blank_df.to_csv(csv, index=False)
-        csv.seek(0)
-        return csv
-
-    column_order = [
-        "Score",
-        "Release",
-        "Chapter Number",
-        "HS Hdg", 
-        "HS Code", 
-        "SC Code","HS Hdg Name",
-        "Prefix",
-        "Description", 
-        "Unit",
-        "ICL/SLSI","Preferential Duty_AP",
-        "Preferential Duty_AD",
-        "Preferential Duty_BN","Preferential Duty_GT",
-        "Preferential Duty_IN",
-        "Preferential Duty_PK","Preferential Duty_SA",
-        "Preferential Duty_SF",
-        "Preferential Duty_SD","Preferential Duty_SG",
-        "Gen Duty",
-        "VAT",
-        "PAL_Gen",
-        "PAL_SG","Cess_GEN",
-        "Cess_SG",
-        "Excise SPD",
-        "Surcharge on Customs Duty","SSCL","SCL"]
-
-    df = pd.DataFrame(lineitems)
-    df = df.reindex(columns=column_order)
-    df.to_csv(csv, index=False)
-    csv.seek(0)
-    return csv
+import csv
+import zlib
+from collections.abc import Iterable, Iterator, Mapping
 
+import config
+
+column_order = [
+    "Score",
+    "Release",
+    "Chapter Number",
+    "HS Hdg",
+    "HS Code",
+    "SC Code","HS Hdg Name",
+    "Prefix",
+    "Description",
+    "Unit",
+    "ICL/SLSI","Preferential Duty_AP",
+    "Preferential Duty_AD",
+    "Preferential Duty_BN","Preferential Duty_GT",
+    "Preferential Duty_IN",
+    "Preferential Duty_PK","Preferential Duty_SA",
+    "Preferential Duty_SF",
+    "Preferential Duty_SD","Preferential Duty_SG",
+    "Gen Duty",
+    "VAT",
+    "PAL_Gen",
+    "PAL_SG","Cess_GEN",
+    "Cess_SG",
+    "Excise SPD",
+    "Surcharge on Customs Duty","SSCL","SCL"]
+
+class __TextBuffer:
+    """File-like object the csv writer writes to, from which the text written so far can be taken."""
+
+    def __init__(self) -> None:
+        self.parts: list[str] = []
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        self.parts.append(text)
+        self.size += len(text)
+
+    def take(self) -> bytes:
+        data = ''.join(self.parts).encode('utf-8')
+        self.parts, self.size = [], 0
+        return data
+
+def lineitems_to_rows(lineitems: Iterable[Mapping]) -> Iterator[list]:
+    """Yields the values of each line item in column_order (None where the line item does not have the column)."""
+    for lineitem in lineitems:
+        yield [lineitem.get(column) for column in column_order]
+
+def stream_csv(rows: Iterable[list], compress: bool = False) -> Iterator[bytes]:
+    """Yields a csv (header of column_order, then the given rows) in chunks of about config.csv_export_chunk_bytes,
+    so the csv can be sent while it is being made, without the whole of it (or of its rows) ever being in memory.
+    Values are written the way pandas' to_csv writes them (None as a blank cell, '\\n' line endings).
+
+    Args:
+        rows (Iterable[list]): values in column_order (see lineitems_to_rows)
+        compress (bool, optional): gzip the csv. Defaults to False.
+
+    Yields:
+        Iterator[bytes]: chunks of the csv (of the .csv.gz if compress)
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None # wbits=31 gives the gzip format
+    buffer = __TextBuffer()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(column_order)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.size >= config.csv_export_chunk_bytes:
+            data = buffer.take()
+            if compressor != None: data = compressor.compress(data)
+            if data: yield data
+    data = buffer.take()
+    if compressor != None: data = compressor.compress(data) + compressor.flush()
+    if data: yield data
@@ -1,17 +1,24 @@
 import logging
+import time
+import heapq
+import concurrent.futures
 
-from other_funcs.getEmbeddings import getEmbeddings
-from app_functions import findByHSCode as fhsc
+import config
+from data_stores.DataStores import DataStores
 from data_stores.CosmosObjects import CosmosObjects
+from data_stores.LocalVectorIndex import LocalVectorIndex
+from data_stores.EmbeddingCache import EmbeddingCache
 
-def vectorStoreSearch(question: str, releases: list[str]) -> list[tuple[dict,float]]:
+def vectorStoreSearch(question: str, releases: list[str], chapterNumber: int = None) -> list[tuple[dict,float]]:
     """Searches text fields of a line-item for matches with the user's query.
     Works by embedding the user's question and getting a vector, and comparing it with the vectors in Cosmos DB (vector similarity search).
-    The top k results from Cosmos have HS code as a metadata, so now we use this to carry out a regular HS code search.
+    The top k results from Cosmos have HS code as a metadata, so now we use this to look up the line items of that HS code in the release.
+    Releases are searched concurrently, and their (already sorted) results merged.
 
     Args:
         question (str): user's question
         releases (list[str]): list of releases whose vectorstores to check
+        chapterNumber (int, optional): If given, only line items of this chapter are searched. Defaults to None.
 
     Returns:
         list[tuple[dict,float]]: list of: search_result_dict, score
@@ -22,47 +29,90 @@ def vectorStoreSearch(question: str, releases: list[str]) -> list[tuple[dict,flo
 
     logging.info("Vector store search called")
 
-    embeddings = getEmbeddings.getEmbeddings()
-    embeddedQuestion = embeddings.embed_query(question)
-
-    search_results = []
-    for release in releases:
+    embeddedQuestion = EmbeddingCache.getQueryEmbedding(question)
+    logging.debug(f"Embedding cache stats: {EmbeddingCache.getStats()}")
+
+    def search_release(release: str) -> list[tuple[dict,float]]:
+        """Helper function. Returns the search results of a single release, most similar first.
+        """
+        search_results = []
+        filters = {"Chapter Number": chapterNumber} if chapterNumber != None else None
+        for hscode, score in similarity_search_with_score(embeddedQuestion, release, k=10, filters=filters): # most similar first
+            for item in DataStores.getLineItemsByHSCode(release, hscode):
+                result = dict(item)
+                result["Release"] = release # Adding this because we want a link to the PDF to be displayed with the result
+                result["Chapter Number"] = str(int(hscode[:2])) # Adding this because we want a link to the PDF to be displayed with the result
+                search_results.append((result, score))
+        return search_results
+
+    if len(releases) == 0: return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(releases)) as executor:
+        search_results_by_release = list(executor.map(search_release, releases))
+    return list(heapq.merge(*search_results_by_release, key=lambda x: x[1], reverse=True)) # ties keep the order of the releases, as the previous stable sort did
+ 
 
-        resultingHSCodesAndScores = similarity_search_with_score(embeddedQuestion, release, k=10)
+def buildVectorSearchQuery(queryEmbeddings: list[float], k: int, filters: dict = None) -> tuple[str, list[dict]]:
+    """Builds a parameterized Cosmos vector search query. The vector is sent once as the @embedding parameter instead of being written into the query text.
+    Only the HS code and the similarity score are projected.
 
-        for resultingHSCodeAndScore in resultingHSCodesAndScores:
-            hscode = resultingHSCodeAndScore[0]
-            score = resultingHSCodeAndScore[1]
-            results = fhsc.findByHSCode(hscode)
-            for result in results:
-                if result['Release'] == release:
-                    search_results.append((result, score))
-    sorted_search_results = sorted(search_results, key=lambda x: x[1], reverse=True)  
-    return sorted_search_results
- 
+    Args:
+        queryEmbeddings (list[float]): The embeddings of the user query (vector)
+        k (int): Top how much to return
+        filters (dict, optional): document field -> value, results must be equal on all of them (eg: {"Chapter Number": 5}). Defaults to None.
 
-def similarity_search_with_score(queryEmbeddings: list[float], release: str, k: int = 4) -> list[tuple[str, float]]:
-    """Performs a similarity search vectorsearch against Cosmos.
+    Returns:
+        tuple[str, list[dict]]: query, parameters (to be given to query_items)
+    """
+    parameters = [{"name": "@k", "value": k}, {"name": "@embedding", "value": queryEmbeddings}]
+    query = 'SELECT TOP @k c["HS Code"], VectorDistance(c.embedding, @embedding) AS similarityScore FROM c'
+    if filters:
+        conditions = []
+        for i, (field, value) in enumerate(filters.items()):
+            conditions.append(f'c["{field}"] = @filter{i}')
+            parameters.append({"name": f"@filter{i}", "value": value})
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY VectorDistance(c.embedding, @embedding)"
+    return query, parameters
+
+def similarity_search_with_score(queryEmbeddings: list[float], release: str, k: int = 4, filters: dict = None) -> list[tuple[str, float]]:
+    """Performs a similarity search vectorsearch against Cosmos, or against the in-process LocalVectorIndex if config.vectorstore is "local_numpy"
+    (and the vector snapshots of the release are all made, see LocalVectorIndex.isReady).
+    A search filtered on "Chapter Number" alone is sent only to the chapter's partition (where the container is partitioned by chapter).
+    The request charge (RUs) and latency of each Cosmos query is logged.
 
     Args:
         queryEmbeddings (list[float]): The embeddings of the user query (vector)
         k (int, optional): Top how much to return. Defaults to 4.
+        filters (dict, optional): document field -> value to restrict the search to (see buildVectorSearchQuery). Defaults to None.
 
     Returns:
         list[tuple[str, float]]: A list of (HS Codes, Similarity Score)
     """
-    query = "SELECT TOP " + str(k)
-    query += ' c["HS Code"], VectorDistance(c.embedding, '
-    query += str(queryEmbeddings) + ") "
-    query += "AS similarityScore FROM c "
+    if config.vectorstore == "local_numpy" and LocalVectorIndex.isReady(release):
+        return LocalVectorIndex.similarity_search_with_score(queryEmbeddings, release, k, filters)
 
-    query += "ORDER BY VectorDistance(c.embedding, " + str(queryEmbeddings) + ")"
+    query, parameters = buildVectorSearchQuery(queryEmbeddings, k, filters)
 
     hscodesAndScores = []
+    requestCharge = 0.0
+
+    def record_request_charge(headers: dict, result):
+        """Helper function, called by the cosmos sdk with the headers of each response. 
+        It is also called once with the item iterator before any request is made (and the headers of the previous request), that call is ignored.
+        """
+        nonlocal requestCharge
+        if isinstance(result, dict): requestCharge += float(headers.get('x-ms-request-charge', 0))
+
+    if filters and set(filters.keys()) == {"Chapter Number"} and CosmosObjects.isPartitionedByChapter(release):
+        partitionScope = {"partition_key": str(filters["Chapter Number"])}
+    else:
+        partitionScope = {"enable_cross_partition_query": True}
 
+    startTime = time.perf_counter()
     items = list(
-        CosmosObjects.getCosmosContainer(release).query_items(query=query, enable_cross_partition_query=True)
+        CosmosObjects.getCosmosContainer(release).query_items(query=query, parameters=parameters, response_hook=record_request_charge, **partitionScope)
     )
+    logging.info(f"Cosmos vector search on release {release}: {len(items)} results, {requestCharge:.2f} RUs, {(time.perf_counter() - startTime) * 1000:.0f} ms")
     for item in items:
         hscode = item["HS Code"]
         score = item["similarityScore"]
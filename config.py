@@ -1,5 +1,9 @@
-vectorstore = "azure_cosmos_nosql"  # "chroma" or "azure_cosmos_nosql" # chromaDB only partial implementation, not properly wired up
+vectorstore = "azure_cosmos_nosql"  # "chroma", "azure_cosmos_nosql" or "local_numpy" # chromaDB only partial implementation, not properly wired up # "local_numpy" still ingests to cosmos, but searches run against an in-process index loaded from the vector snapshots
 cosmosNoSQLDBName = "tariff-search-db"
+cosmos_partition_key_path = "/categoryId" # each cosmos document sets this field to its chapter number (str), so a chapter is a single partition
+cosmos_connection_pool_size = 32 # max keep-alive connections kept open to cosmos, shared by search, ingestion and deletion (the bulk writer can use up to cosmos_bulk_max_concurrency at once)
+cosmos_connection_pool_count = 4 # number of cosmos hosts (eg: regional endpoints) to keep a connection pool for
+cosmos_connection_timeout_seconds = 60
 embeddings = "AzureOpenAI" # 'OpenAI' or 'AzureOpenAI'
 lifetimeTokenLimit = 10000000
 lifetimeTokenLimit_chatbot = 10000000
@@ -31,13 +35,63 @@ generatedDict_container_name = "generatedict-container"
 reviewedExcel_container_name = "reviewedexcel-container"
 json_container_name = "json-container"
 cosmos_ids_container_name = "cosmos-ids-container"
+vector_snapshot_container_name = "vector-snapshot-container"
+embedding_cache_container_name = "embedding-cache-container"
 release_holder_container_name = "release-holder"
 release_holder_filename = "releases.txt"
+export_artifact_container_name = "export-container"
+release_registry_refresh_seconds = 30 # how often the declared releases (ReleaseRegistry) are checked for changes made through other workers/instances (downloaded only if the ETag changed)
+
+# File management page (FileCatalog), blob names and chapter records are kept in memory
+file_catalog_refresh_seconds = 15 # how often one of (generated excels, reviewed excels, jsons, chapter records) is listed again, to pick up changes made through other workers/instances
+
+# Loading the json store into memory (DataStores)
+json_store_download_workers = 8 # max number of json blobs downloaded at the same time
+json_store_cache_directory = "files/json_store_cache" # local snapshot of the json container, a blob is only downloaded again if its ETag changed
+json_store_sync_interval_seconds = 30 # how often each worker checks the json container for chapters changed by other workers/instances
+
+# HS code to SC code mapping (HSCodeToSCCodeMapping), read again whenever the file changes
+hscode_to_sccode_mapping_filepath = 'files/HSCode_to_SCCode_Mapping Sorted.csv'
+
+# Local vector index (LocalVectorIndex), used when vectorstore = "local_numpy"
+local_vector_index_refresh_seconds = 60 # how often a release's index checks the vector snapshot container for changed chapters
+
+# Embedding cache (EmbeddingCache)
+embedding_cache_size = 4096 # max number of embeddings held in memory (least recently used are dropped first), all embeddings are also kept in embedding_cache_container_name
+embedding_cache_download_workers = 16 # max number of cached document embeddings read/written at the same time during ingestion
+embedding_cache_query_lookup_timeout_seconds = 1 # a search reading its query's embedding from embedding_cache_container_name gives up after this (and embeds the query instead)
+
+# Batched embedding requests during ingestion (batch_embedder)
+embedding_batch_max_inputs = 256 # texts per embeddings request (the API accepts up to 2048)
+embedding_batch_max_tokens = 64000 # total tokens per embeddings request
+embedding_max_concurrent_requests = 4 # embeddings requests in flight at once, shared by all ingestion jobs of the process
+embedding_max_retries = 8 # retries of a throttled (429) or failed request, with exponential backoff or the wait given by the service
+
+# Bulk writes to Cosmos during ingestion (cosmos_bulk_writer)
+cosmos_bulk_initial_concurrency = 4 # documents written at once at the start, raised by ~1 per round of successful writes and halved on each throttle
+cosmos_bulk_max_concurrency = 32 # upper bound of documents written at once
+cosmos_bulk_max_retries = 20 # retries of a throttled (429) document before it is reported as failed
+
+# PDF extraction (extract_data_for_review)
+pdf_extraction_workers = 4 # worker processes PDF pages are extracted in (1 to extract in the web app process)
+pdf_extraction_min_pages_per_worker = 4 # a PDF is split into one contiguous range of pages per worker process, no range being shorter than this (a PDF of fewer pages is extracted in the web app process)
+
+# Batch PDF uploads (file_management.batch_upload_pdfs)
+batch_upload_pdf_workers = 4 # chapters processed at the same time (each under its own chapter mutex)
+batch_upload_memory_budget_bytes = 1024 * 1024 * 1024 # estimated memory all chapters being processed at the same time may use
+batch_upload_memory_per_pdf_byte = 20 # estimated peak memory of processing a PDF (tables, dataframes, excel), per byte of the PDF
+
+# CSV exports (lineitems_to_csv.stream_csv)
+csv_export_chunk_bytes = 64 * 1024 # size of the pieces an export is sent in
+export_artifact_delay_seconds = 30 # precomputed exports (export_artifacts) are made again once no chapter has been added/deleted for this long, so a batch upload is exported once
 
 # Azure Storage Table
 azureStorage_chapterTracker_TableName = 'chaptertracker'
 azureStorageTablePartitionKeyValue = 'a'
 job_tracker_tableName = 'jobs'
+job_tracker_flush_seconds = 5 # how often job progress kept in memory is written to the job tracker table
+job_tracker_max_job_age_seconds = 24 * 60 * 60 # a job started by a process is kept in its memory until it ends, or at most this long (in case it is never ended)
+job_tracker_recount_seconds = 300 # the number of jobs in the job tracker table (kept in memory, see total_jobs_threshold) is counted again when older than this
 
 class RecordStatus:
     uploadingPDF = 'uploading PDF'
@@ -51,6 +105,7 @@ class RecordStatus:
     addingNewCosmosIdTracker = 'uploading cosmos ID tracker'
     deletingExistingCosmosDocs = 'deleting existing line items from cosmos'
     deletingExistingCosmosIDTracker = 'deleting existing cosmos id tracker'
+    addingNewDocsToCosmosFailed = 'some line items could not be added to cosmos, delete and upload the corrected excel again'
 
 class RecordState:
     pdfUploaded = 'pdfUploaded'
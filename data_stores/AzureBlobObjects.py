@@ -2,6 +2,7 @@ import os
 import logging
 from azure.storage.blob import BlobServiceClient, ContainerClient
 import config
+from data_stores.FileCatalog import FileCatalog
 from azure.core.exceptions import ServiceRequestError, ResourceNotFoundError
 from io import BytesIO
 
@@ -55,14 +56,17 @@ class AzureBlobObjects:
             else: container_client.upload_blob(name=filename, data=data, overwrite=True)
 
     @classmethod
-    def upload_to_blob_from_stream(cls, filestream: BytesIO, containerName: str, file_name: str):
+    def upload_to_blob_from_stream(cls, filestream: BytesIO, containerName: str, file_name: str) -> dict:
         """Upload file specified in filepath to the specified container in Azure storage.
+        Returns the properties of the uploaded blob (eg: 'etag', 'last_modified').
         """
         cls.get_container_client(containerName) # this will creates container if it doesn't exist already
         blob_service_client = cls.get_blob_service_client()
         blob_client = blob_service_client.get_blob_client(container=containerName, blob=file_name)
         logging.info("file about to be uploaded to blob from stream with given filename: " + file_name)
-        blob_client.upload_blob(filestream, blob_type="BlockBlob", overwrite=True)
+        properties = blob_client.upload_blob(filestream, blob_type="BlockBlob", overwrite=True)
+        FileCatalog.blobUploaded(containerName, file_name)
+        return properties
 
     @classmethod
     def download_blob_file(cls, filename: str, containerName: str, savepath: str):
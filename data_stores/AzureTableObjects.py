@@ -1,9 +1,14 @@
 import os
 import uuid
+import time
+import threading
 import config
 import logging
 from datetime import datetime
-from azure.data.tables import TableServiceClient, TableEntity, UpdateMode, TableClient
+from azure.data.tables import TableServiceClient, TableEntity, UpdateMode, TableClient, TableTransactionError
+from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError
+from azure.core import MatchConditions
+from data_stores.FileCatalog import FileCatalog
 
 class MutexError(Exception):
     """Custom exception for specific error handling."""
@@ -21,6 +26,21 @@ class AzureTableObjects:
     __table_service_client = None
     __table_clients: dict[str,TableClient] = {}
 
+    # chapter records whose mutex is held in this process, with their ETag (see claim_mutex)
+    __chapter_records: dict[str,tuple[dict,str]] = {} # rowkey -> (entity, etag)
+    __chapter_records_lock = threading.Lock()
+
+    # job tracker state (write-behind, see update_job)
+    __jobs: dict[str,dict] = {} # job_id -> entity, of the jobs started by this process whose end has not been written yet (at most config.job_tracker_max_job_age_seconds)
+    __job_started_at: dict[str,float] = {} # job_id -> time.monotonic() it was created, of the jobs in __jobs
+    __pending_job_updates: dict[str,dict[str,object]] = {} # job_id -> fields changed but not written to the table yet
+    __job_count: int = None # number of jobs in the table (None until first counted)
+    __job_counted_at: float = None # time.monotonic() of the last count of __job_count
+    __jobs_lock = threading.Lock()
+    __job_writes_lock = threading.Lock() # keeps writes of job updates in order
+    __job_flush_thread: threading.Thread = None
+    __max_operations_per_transaction = 100 # limit of an Azure Table transaction
+
 
     @classmethod
     def get_table_service_client(cls):
@@ -52,57 +72,123 @@ class AzureTableObjects:
             'MutexLock': False
         }
         table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
-        table_client.create_entity(entity)
+        metadata = table_client.create_entity(entity)
+        with cls.__chapter_records_lock: # a new record is usually claimed right away, so this saves reading it again
+            cls.__chapter_records[rowkey] = (entity, metadata['etag'])
+        FileCatalog.chapterRecordChanged(rowkey, entity['RecordStatus'])
 
     @classmethod
     def get_chapter_record(cls, chapterNumber: int, release_date: str) -> TableEntity:
         rowkey = release_date + ':' + str(chapterNumber)
         table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
         return table_client.get_entity(partition_key= config.azureStorageTablePartitionKeyValue, row_key= rowkey)
+
+    @classmethod
+    def __readChapterRecord(cls, rowkey: str) -> tuple[dict,str]:
+        """Reads a chapter record from the table. Returns the entity and its ETag."""
+        table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
+        entity = table_client.get_entity(partition_key= config.azureStorageTablePartitionKeyValue, row_key= rowkey)
+        return dict(entity), entity.metadata['etag']
+
+    @classmethod
+    def __updateChapterRecord(cls, chapterNumber: int, release_date: str, change) -> tuple[dict,str]:
+        """Changes a chapter record with a single ETag-conditional MERGE, starting from the cached copy of the record (see __chapter_records) if there is one.
+        If the record was modified since that copy was taken, the update is rejected by the table, so the record is read again and the change re-evaluated on it.
+        So a change (eg: claiming the mutex) is only ever made to the record as it currently is.
+
+        Args:
+            chapterNumber (int): _description_
+            release_date (str): _description_
+            change: function(entity) -> fields to merge into the record (None if nothing needs to change). Raises MutexError if the change is not allowed.
+
+        Returns:
+            tuple[dict,str]: the updated record and its ETag
+        """
+        rowkey = release_date + ':' + str(chapterNumber)
+        with cls.__chapter_records_lock:
+            cached = cls.__chapter_records.get(rowkey)
+        entity, etag = cached if cached != None else cls.__readChapterRecord(rowkey)
+        table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
+        while True:
+            try: fields = change(entity)
+            except MutexError:
+                if cached == None: raise
+                cached = None # the cached copy may be out of date, make sure with the record as it is now
+                entity, etag = cls.__readChapterRecord(rowkey)
+                continue
+            if fields == None: return entity, etag
+            try:
+                metadata = table_client.update_entity(mode= UpdateMode.MERGE, entity={'PartitionKey': config.azureStorageTablePartitionKeyValue, 'RowKey': rowkey, **fields},
+                                                      etag=etag, match_condition=MatchConditions.IfNotModified)
+                if 'RecordStatus' in fields: FileCatalog.chapterRecordChanged(rowkey, fields['RecordStatus'])
+                return {**entity, **fields}, metadata['etag']
+            except ResourceModifiedError: # changed by someone else since it was read
+                cached = None
+                entity, etag = cls.__readChapterRecord(rowkey)
     
     @classmethod
     def claim_mutex(cls, chapterNumber: int, mutexKey: str, release_date: str):
-        entity = cls.get_chapter_record(chapterNumber, release_date)
-        if entity['MutexLock'] == False:
-            entity['MutexLock'] = True
-            entity['MutexKey'] = mutexKey
-        elif entity['MutexLock'] == True and entity['MutexKey'] == mutexKey: pass
-        else: raise MutexError(chapterNumber)
+        """Claims the mutex of a chapter (atomically, see __updateChapterRecord). While it is held, the record is cached, so that each
+        edit_chapter_record / release_mutex / delete_chapter_record with this mutexKey costs a single table call.
 
-        table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
-        table_client.update_entity(mode= UpdateMode.REPLACE, entity=entity)
+        Raises:
+            MutexError: If the mutex is held with another mutexKey
+        """
+        def claim(entity: dict) -> dict:
+            if entity['MutexLock'] == False: return {'MutexLock': True, 'MutexKey': mutexKey}
+            elif entity['MutexLock'] == True and entity['MutexKey'] == mutexKey: return None
+            else: raise MutexError(chapterNumber)
+
+        rowkey = release_date + ':' + str(chapterNumber)
+        try: record = cls.__updateChapterRecord(chapterNumber, release_date, claim)
+        except (MutexError, ResourceNotFoundError):
+            with cls.__chapter_records_lock: # a record cached by the caller holding the mutex is left for it
+                cached = cls.__chapter_records.get(rowkey)
+                if cached != None and cached[0]['MutexKey'] == mutexKey: cls.__chapter_records.pop(rowkey)
+            raise
+        with cls.__chapter_records_lock:
+            cls.__chapter_records[rowkey] = record
 
     @classmethod
     def release_mutex(cls, chapterNumber: int, mutexKey: str, release_date: str):
-        entity = cls.get_chapter_record(chapterNumber, release_date)
-        if entity['MutexKey'] == mutexKey:
-            entity['MutexLock'] = False
-            entity['MutexKey'] = ''
-        else: raise MutexError(chapterNumber)
+        def release(entity: dict) -> dict:
+            if entity['MutexKey'] == mutexKey: return {'MutexLock': False, 'MutexKey': ''}
+            else: raise MutexError(chapterNumber)
 
-        table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
-        table_client.update_entity(mode= UpdateMode.REPLACE, entity=entity)
+        try: cls.__updateChapterRecord(chapterNumber, release_date, release)
+        finally:
+            with cls.__chapter_records_lock: cls.__chapter_records.pop(release_date + ':' + str(chapterNumber), None)
 
     @classmethod
     def edit_chapter_record(cls, chapterNumber: int, mutexKey: str, release_date: str, newRecordStatus: str = None, newRecordState = None):
-        entity = cls.get_chapter_record(chapterNumber, release_date)
-        if entity['MutexKey'] != mutexKey: raise MutexError(chapterNumber)
+        def edit(entity: dict) -> dict:
+            if entity['MutexKey'] != mutexKey: raise MutexError(chapterNumber)
+            fields = {}
+            if newRecordStatus != None:
+                fields['RecordStatus'] = newRecordStatus
+            if newRecordState != None:
+                fields['RecordState'] = newRecordState
+            return fields
 
-        if newRecordStatus != None:
-            entity['RecordStatus'] = newRecordStatus
-        if newRecordState != None:
-            entity['RecordState'] = newRecordState
-
-        table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
-        table_client.update_entity(mode= UpdateMode.REPLACE, entity=entity)
+        record = cls.__updateChapterRecord(chapterNumber, release_date, edit)
+        with cls.__chapter_records_lock:
+            if record[0]['MutexLock'] == True: cls.__chapter_records[release_date + ':' + str(chapterNumber)] = record
 
     @classmethod
     def delete_chapter_record(cls, chapterNumber: int, mutexKey: str, release_date: str):
-        entity = cls.get_chapter_record(chapterNumber, release_date)
-        if entity['MutexKey'] != mutexKey: raise MutexError(chapterNumber)
-
+        rowkey = release_date + ':' + str(chapterNumber)
+        with cls.__chapter_records_lock:
+            cached = cls.__chapter_records.pop(rowkey, None)
+        entity, etag = cached if cached != None else cls.__readChapterRecord(rowkey)
         table_client = cls.get_table_client(config.azureStorage_chapterTracker_TableName)
-        table_client.delete_entity(partition_key=config.azureStorageTablePartitionKeyValue, row_key=f"{release_date}:{str(chapterNumber)}")
+        while True:
+            if entity['MutexKey'] != mutexKey: raise MutexError(chapterNumber)
+            try:
+                table_client.delete_entity(partition_key=config.azureStorageTablePartitionKeyValue, row_key=rowkey, etag=etag, match_condition=MatchConditions.IfNotModified)
+                FileCatalog.chapterRecordDeleted(rowkey)
+                return
+            except ResourceModifiedError: # changed by someone else since it was read
+                entity, etag = cls.__readChapterRecord(rowkey)
 
     @classmethod
     def get_all_chapter_records(cls) -> list[TableEntity]:
@@ -153,40 +239,157 @@ class AzureTableObjects:
         }
         table_client = cls.get_table_client(config.job_tracker_tableName)
         table_client.create_entity(entity)
+        with cls.__jobs_lock:
+            cls.__jobs[rowkey] = entity
+            cls.__job_started_at[rowkey] = time.monotonic()
+            if cls.__job_count != None: cls.__job_count += 1
+            cls.__startJobFlushThread() # also drops the job from memory if it is never ended
         return rowkey
     
     @classmethod
     def get_job_progress(cls, job_id: str) -> str:
+        with cls.__jobs_lock:
+            if job_id in cls.__jobs: return cls.__jobs[job_id]['Progress'] # jobs of this process are tracked in memory
         table_client = cls.get_table_client(config.job_tracker_tableName)
         entity = table_client.get_entity(config.azureStorageTablePartitionKeyValue, job_id)
         return entity['Progress']
     
     @classmethod
-    def set_job_progress(cls, job_id: str, progress: str) -> str:
-        table_client = cls.get_table_client(config.job_tracker_tableName)
-        entity = table_client.get_entity(config.azureStorageTablePartitionKeyValue, job_id)
-        entity['Progress'] = progress
-        table_client.update_entity(mode= UpdateMode.REPLACE, entity=entity)
+    def set_job_progress(cls, job_id: str, progress: str) -> None:
+        cls.update_job(job_id, {'Progress': progress})
+
+    @classmethod
+    def update_job(cls, job_id: str, fields: dict):
+        """Sets the given fields of a job (other fields are left as they are). The change is made in memory, and written to the table (merged into the entity)
+        by a background thread every config.job_tracker_flush_seconds, so many updates of a job in between cost a single write. end_job writes it straight away.
+
+        Args:
+            job_id (str): _description_
+            fields (dict): field name -> value, eg: {'Progress': '28.pdf'}
+        """
+        with cls.__jobs_lock:
+            if job_id in cls.__jobs: cls.__jobs[job_id].update(fields)
+            cls.__pending_job_updates.setdefault(job_id, {}).update(fields)
+            cls.__startJobFlushThread()
+
+    @classmethod
+    def __startJobFlushThread(cls):
+        """Starts the thread writing the job updates kept in memory (if not started yet). Caller must hold __jobs_lock."""
+        if cls.__job_flush_thread == None:
+            cls.__job_flush_thread = threading.Thread(target=cls.__flushJobUpdatesPeriodically, name='job-tracker-flush', daemon=True)
+            cls.__job_flush_thread.start()
 
     @classmethod
     def end_job(cls, job_id: str):
-        table_client = cls.get_table_client(config.job_tracker_tableName)
-        entity = table_client.get_entity(config.azureStorageTablePartitionKeyValue, job_id)
-        entity['EndTime'] = str(datetime.now())
-        table_client.update_entity(mode= UpdateMode.REPLACE, entity=entity)
+        """Sets the end time of a job and writes its updates to the table straight away.
+        If the write fails, the updates are kept in memory and written by the background thread later (see update_job), the error is only logged.
+        """
+        with cls.__job_writes_lock: # so that an earlier update of this job being flushed cannot land after this one
+            with cls.__jobs_lock:
+                fields = cls.__pending_job_updates.pop(job_id, {})
+                fields['EndTime'] = str(datetime.now())
+                if job_id in cls.__jobs: cls.__jobs[job_id].update(fields) # dropped by __writeJobUpdates once the end is written
+                entity = dict(cls.__jobs[job_id]) if job_id in cls.__jobs else None
+            try: cls.__writeJobUpdates({job_id: fields})
+            except Exception as e:
+                logging.error(f'Writing the end of job {job_id} to the job tracker failed, it will be retried: {e}')
+                with cls.__jobs_lock: cls.__startJobFlushThread()
+                return
+        if entity == None: # not started by this process
+            entity = cls.get_table_client(config.job_tracker_tableName).get_entity(config.azureStorageTablePartitionKeyValue, job_id)
+        entity.update(fields)
         log_message = ''
         for key in entity.keys():
             log_message += f'{key}: {entity[key]}\n'
         logging.log(14,f'{log_message}')
 
         # if too many jobs in the azure table, trigger a cleanup
-        if len(cls.get_all_jobs()) > config.total_jobs_threshold:
+        if cls.__getJobCount() > config.total_jobs_threshold:
             cls.delete_old_completed_jobs()
 
+    @classmethod
+    def __flushJobUpdatesPeriodically(cls):
+        """Runs in a background thread, writes the job updates made in memory every config.job_tracker_flush_seconds.
+        Jobs started more than config.job_tracker_max_job_age_seconds ago that were never ended are then no longer kept in memory (their progress is read from the table).
+        """
+        while True:
+            time.sleep(config.job_tracker_flush_seconds)
+            try: cls.flush_job_updates()
+            except Exception as e: logging.error(f'Writing job updates to the job tracker failed: {e}')
+            with cls.__jobs_lock:
+                for job_id in [job_id for job_id, started_at in cls.__job_started_at.items() if time.monotonic() - started_at > config.job_tracker_max_job_age_seconds]:
+                    if job_id in cls.__pending_job_updates: continue # not written yet
+                    cls.__jobs.pop(job_id, None)
+                    cls.__job_started_at.pop(job_id)
+
+    @classmethod
+    def flush_job_updates(cls):
+        """Writes the job updates made in memory (see update_job) to the table now."""
+        with cls.__job_writes_lock:
+            with cls.__jobs_lock:
+                updates = cls.__pending_job_updates
+                cls.__pending_job_updates = {}
+            cls.__writeJobUpdates(updates)
+
+    @classmethod
+    def __writeJobUpdates(cls, updates: dict[str,dict]):
+        """Merges the given fields into the job entities, in transactions of up to 100 jobs (all jobs are in the same partition).
+        If a transaction is rejected (eg: one of its jobs was deleted meanwhile), its jobs are written one by one.
+        Jobs of this process whose end was written are no longer kept in memory.
+        Caller must hold __job_writes_lock.
+
+        Args:
+            updates (dict[str,dict]): job_id -> fields to set
+
+        Raises:
+            Exception: If a write failed (other than for a job that no longer exists). The updates not written are put back in __pending_job_updates first.
+        """
+        if not updates: return
+        table_client = cls.get_table_client(config.job_tracker_tableName)
+        entities = [{'PartitionKey': config.azureStorageTablePartitionKeyValue, 'RowKey': job_id, **fields} for job_id, fields in updates.items()]
+        unwritten = set(updates.keys())
+        try:
+            for i in range(0, len(entities), cls.__max_operations_per_transaction):
+                batch = entities[i:i + cls.__max_operations_per_transaction]
+                try:
+                    table_client.submit_transaction([('update', entity, {'mode': UpdateMode.MERGE}) for entity in batch])
+                    unwritten.difference_update(entity['RowKey'] for entity in batch)
+                except TableTransactionError:
+                    for entity in batch:
+                        try: table_client.update_entity(mode= UpdateMode.MERGE, entity=entity)
+                        except ResourceNotFoundError: logging.warning(f"Job {entity['RowKey']} no longer exists in the job tracker, its update was dropped")
+                        unwritten.discard(entity['RowKey'])
+        finally:
+            with cls.__jobs_lock:
+                for job_id in updates.keys():
+                    if job_id in unwritten: # fields updated since are newer, so they are kept over these
+                        pending = cls.__pending_job_updates.setdefault(job_id, {})
+                        for key, value in updates[job_id].items(): pending.setdefault(key, value)
+                    elif job_id in cls.__jobs and cls.__jobs[job_id]['EndTime'] != '' and job_id not in cls.__pending_job_updates:
+                        cls.__jobs.pop(job_id)
+                        cls.__job_started_at.pop(job_id, None)
+
+    @classmethod
+    def __getJobCount(cls) -> int:
+        """Returns the number of jobs in the table. Counted (reading only the keys), then kept up to date as jobs are created and deleted by this process.
+        Counted again once the count is older than config.job_tracker_recount_seconds, as other workers/instances create and delete jobs too.
+        """
+        if cls.__job_count == None or time.monotonic() - cls.__job_counted_at > config.job_tracker_recount_seconds:
+            table_client = cls.get_table_client(config.job_tracker_tableName)
+            job_count = sum(1 for _ in table_client.list_entities(select=['RowKey']))
+            with cls.__jobs_lock:
+                cls.__job_count, cls.__job_counted_at = job_count, time.monotonic()
+        return cls.__job_count
+
     @classmethod
     def get_all_jobs(cls) -> list[TableEntity]:
         table_client = cls.get_table_client(config.job_tracker_tableName)
-        return list(table_client.list_entities())
+        jobs = list(table_client.list_entities())
+        with cls.__jobs_lock:
+            cls.__job_count, cls.__job_counted_at = len(jobs), time.monotonic()
+            for job in jobs: # updates not written yet
+                if job['RowKey'] in cls.__pending_job_updates: job.update(cls.__pending_job_updates[job['RowKey']])
+        return jobs
     
     @classmethod
     def get_all_jobs_classified(cls) -> tuple[list[TableEntity],list[TableEntity]]:
@@ -209,13 +412,22 @@ class AzureTableObjects:
     
     @classmethod
     def delete_old_completed_jobs(cls):
-        """Deleted old completed jobs according to the parameters specified in the config file."""
+        """Deleted old completed jobs according to the parameters specified in the config file. Deleted in transactions of up to 100 jobs."""
         _,completed_jobs_sorted = cls.get_all_jobs_classified()
         count = len(completed_jobs_sorted)
         start_deleting_index = int(count*(1 - config.ratio_of_completed_jobs_to_delete_when_threshold_is_hit))
         jobs_to_delete = completed_jobs_sorted[start_deleting_index:]
         table_client = cls.get_table_client(config.job_tracker_tableName)
-        for job in jobs_to_delete:
-            table_client.delete_entity(config.azureStorageTablePartitionKeyValue,job['RowKey'])
-
-
+        deleted = 0
+        for i in range(0, len(jobs_to_delete), cls.__max_operations_per_transaction):
+            batch = jobs_to_delete[i:i + cls.__max_operations_per_transaction]
+            try:
+                table_client.submit_transaction([('delete', {'PartitionKey': job['PartitionKey'], 'RowKey': job['RowKey']}) for job in batch])
+                deleted += len(batch)
+            except TableTransactionError as e: # eg: another worker deleted some of them already
+                logging.warning(f'Deleting {len(batch)} old jobs in a transaction failed, deleting them one by one: {e}')
+                for job in batch:
+                    table_client.delete_entity(config.azureStorageTablePartitionKeyValue,job['RowKey']) # no error if already deleted
+                    deleted += 1
+        with cls.__jobs_lock:
+            if cls.__job_count != None: cls.__job_count = max(0, cls.__job_count - deleted)
@@ -0,0 +1,177 @@
+import threading
+from array import array
+from collections.abc import Mapping, Sequence
+
+class ValuePool:
+    """Singleton class holding the process-wide dictionary used to encode the values of the json store.
+    Every distinct value (eg: 'Free', '18%', 'kg', a HS heading name) is stored once, and columns hold its integer code instead.
+    Values are reference counted by the chapters holding them: acquired when a chapter is encoded, released when its encoded form is garbage collected
+    (so a code stays valid for as long as anything can decode it). Values of deleted or replaced chapters are so freed, and their codes reused.
+    """
+
+    __values: list = []
+    __codes: dict = {}
+    __refcounts: list[int] = []
+    __free_codes: list[int] = []
+    __lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, values) -> dict:
+        """Returns the code of each of the distinct values, adding the values that are not in the pool yet. Each code must be released once (see release).
+
+        Args:
+            values: distinct values
+
+        Returns:
+            dict: value -> code
+        """
+        codes = {}
+        with cls.__lock:
+            for value in values:
+                code = cls.__codes.get(value)
+                if code == None:
+                    if cls.__free_codes:
+                        code = cls.__free_codes.pop()
+                        cls.__values[code] = value
+                    else:
+                        code = len(cls.__values)
+                        cls.__values.append(value)
+                        cls.__refcounts.append(0)
+                    cls.__codes[value] = code
+                cls.__refcounts[code] += 1
+                codes[value] = code
+        return codes
+
+    @classmethod
+    def release(cls, codes) -> None:
+        """Releases codes returned by acquire. A value no longer held by any chapter is removed from the pool."""
+        with cls.__lock:
+            for code in codes:
+                cls.__refcounts[code] -= 1
+                if cls.__refcounts[code] == 0:
+                    del cls.__codes[cls.__values[code]]
+                    cls.__values[code] = None
+                    cls.__free_codes.append(code)
+
+    @classmethod
+    def decode(cls, code: int):
+        return cls.__values[code]
+
+    @classmethod
+    def size(cls) -> int:
+        """Number of distinct values held in the pool."""
+        with cls.__lock: return len(cls.__values) - len(cls.__free_codes)
+
+
+class LineItemView(Mapping):
+    """Read-only dictionary-like view of a single line item (row) of a ColumnarItems object.
+    Use dict(view) to get a regular (mutable) dictionary.
+    """
+
+    __slots__ = ('__items', '__position')
+
+    def __init__(self, items: 'ColumnarItems', position: int) -> None:
+        self.__items = items
+        self.__position = position
+
+    def __getitem__(self, key: str):
+        return self.__items.get_value(self.__position, key)
+
+    def __iter__(self):
+        return self.__items.iter_keys(self.__position)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.__items.iter_keys(self.__position))
+
+    def __repr__(self) -> str:
+        return f'LineItemView({dict(self)!r})'
+
+
+class ColumnarItems(Sequence):
+    """The line items of a chapter, stored column by column. Each column is an array of ValuePool codes (-1 where an item does not have that key).
+    Indexing returns a LineItemView, so this can be used wherever the list of line item dictionaries of a chapter json was used (read-only).
+    The codes are released when the object is garbage collected.
+    """
+
+    __MISSING = -1
+
+    def __init__(self, items: list[dict]) -> None:
+        """Encodes a list of line item dictionaries (the 'Items' list of a chapter json).
+
+        Args:
+            items (list[dict]): line items. Key order of the first item that has a key is kept.
+        """
+        self.__keys: list[str] = []
+        self.__columns: dict[str,array] = {}
+        self.__length = len(items)
+        self.__codes: list[int] = []
+        codes = ValuePool.acquire({value for item in items for value in item.values()}) # the pool is locked once per chapter
+        self.__codes = list(codes.values())
+        for position, item in enumerate(items):
+            for key, value in item.items():
+                column = self.__columns.get(key)
+                if column == None:
+                    column = array('i', [ColumnarItems.__MISSING]) * self.__length
+                    self.__columns[key] = column
+                    self.__keys.append(key)
+                column[position] = codes[value]
+
+    def __del__(self) -> None:
+        ValuePool.release(self.__codes)
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [LineItemView(self, i) for i in range(*position.indices(self.__length))]
+        if position < 0: position += self.__length
+        if position < 0 or position >= self.__length: raise IndexError('line item index out of range')
+        return LineItemView(self, position)
+
+    def get_value(self, position: int, key: str):
+        column = self.__columns.get(key)
+        if column == None: raise KeyError(key)
+        code = column[position]
+        if code == ColumnarItems.__MISSING: raise KeyError(key)
+        return ValuePool.decode(code)
+
+    def iter_keys(self, position: int):
+        for key in self.__keys:
+            if self.__columns[key][position] != ColumnarItems.__MISSING: yield key
+
+    def get_column(self, key: str) -> list:
+        """Returns the decoded values of a whole column (None where an item does not have the key)."""
+        column = self.__columns.get(key)
+        if column == None: return [None] * self.__length
+        return [None if code == ColumnarItems.__MISSING else ValuePool.decode(code) for code in column]
+
+
+class ColumnarChapter(Mapping):
+    """Read-only, dictionary-like, compact in-memory form of a chapter json (the dictionary with 'Chapter Number', 'Chapter Name', 'Pre-Table Notes' and 'Items').
+    Top level values are encoded in the ValuePool (released when the object is garbage collected), and 'Items' is held as a ColumnarItems object.
+    """
+
+    def __init__(self, json_dict: dict) -> None:
+        self.__fields: dict[str,int] = {}
+        self.__items: ColumnarItems = None
+        self.__codes: list[int] = []
+        codes = ValuePool.acquire({value for key, value in json_dict.items() if key != 'Items'})
+        self.__codes = list(codes.values())
+        for key, value in json_dict.items():
+            if key == 'Items': self.__items = ColumnarItems(value)
+            else: self.__fields[key] = codes[value]
+
+    def __del__(self) -> None:
+        ValuePool.release(self.__codes)
+
+    def __getitem__(self, key: str):
+        if key == 'Items' and self.__items != None: return self.__items
+        return ValuePool.decode(self.__fields[key])
+
+    def __iter__(self):
+        yield from self.__fields.keys()
+        if self.__items != None: yield 'Items'
+
+    def __len__(self) -> int:
+        return len(self.__fields) + (1 if self.__items != None else 0)
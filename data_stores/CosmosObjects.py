@@ -2,44 +2,82 @@ from azure.cosmos import CosmosClient, PartitionKey
 from azure.cosmos import exceptions as AzureCosmosExceptions
 from azure.cosmos import database as AzureCosmosDatabase
 from azure.cosmos import container as AzureCosmosContainer
+from azure.cosmos import documents as AzureCosmosDocuments
+from azure.core.pipeline.transport import RequestsTransport
+import requests
+import threading
 import os
 import logging
 import config
 
 class CosmosObjects:
     """Singleton class to hold cosmos objects. (So that wasteful similar calls to cosmos are not made, each time a reference to an object is required).
+    Search, ingestion and deletion all go through these, and both clients share one pooled HTTP session (config.cosmos_connection_pool_size keep-alive connections),
+    so connections and container metadata are set up once per process rather than once per job.
     
     Attributes:
         __cosmosClient: CosmosClient = None
         __cosmosDatabase: AzureCosmosDatabase.DatabaseProxy = None
-        __cosmosContainer: AzureCosmosContainer.ContainerProxy = None
+        __cosmosContainers: dict[str,AzureCosmosContainer.ContainerProxy] = {}
 
     Methods:
-        3 Methods to get each of the above attributes
+        Methods to get each of the above attributes
     """
 
     __cosmosClient: CosmosClient = None
     __cosmosDatabase: AzureCosmosDatabase.DatabaseProxy = None
     __cosmosContainers: dict[str,AzureCosmosContainer.ContainerProxy] = {}
+    __bulkCosmosClient: CosmosClient = None
+    __bulkCosmosContainers: dict[str,AzureCosmosContainer.ContainerProxy] = {}
+    __partitionKeyPaths: dict[str,str] = {}
+    __transport: RequestsTransport = None
+    __lock = threading.RLock()
+
+    @classmethod
+    def __getTransport(cls) -> RequestsTransport:
+        """Singleton method to return the HTTP transport (a pooled, keep-alive requests session) shared by the cosmos clients"""
+        if CosmosObjects.__transport == None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=config.cosmos_connection_pool_count, pool_maxsize=config.cosmos_connection_pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            CosmosObjects.__transport = RequestsTransport(session=session, session_owner=False)
+        return CosmosObjects.__transport
     
     @classmethod
-    def __getCosmosClient(cls) -> CosmosClient:
+    def getCosmosClient(cls) -> CosmosClient:
         """Singleton method to return a Cosmos object"""
-        if CosmosObjects.__cosmosClient == None:
-            ENDPOINT = os.environ["COSMOS_ENDPOINT"]
-            KEY = os.environ["COSMOS_KEY"]
-            CosmosObjects.__cosmosClient = CosmosClient(url=ENDPOINT, credential=KEY)
-            logging.info("Azure Cosmos client created using URL and key given in config.py")
+        with cls.__lock:
+            if CosmosObjects.__cosmosClient == None:
+                ENDPOINT = os.environ["COSMOS_ENDPOINT"]
+                KEY = os.environ["COSMOS_KEY"]
+                CosmosObjects.__cosmosClient = CosmosClient(url=ENDPOINT, credential=KEY, transport=cls.__getTransport(), connection_timeout=config.cosmos_connection_timeout_seconds)
+                logging.info("Azure Cosmos client created using URL and key given in config.py")
 
         return CosmosObjects.__cosmosClient
 
+    @classmethod
+    def __getBulkCosmosClient(cls) -> CosmosClient:
+        """Singleton method to return a Cosmos client that does not retry throttled (429) requests itself, 
+        so that a bulk writer sees every throttle and can slow down (see cosmos_bulk_writer)."""
+        with cls.__lock:
+            if CosmosObjects.__bulkCosmosClient == None:
+                ENDPOINT = os.environ["COSMOS_ENDPOINT"]
+                KEY = os.environ["COSMOS_KEY"]
+                connection_policy = AzureCosmosDocuments.ConnectionPolicy()
+                connection_policy.RetryOptions = AzureCosmosDocuments.RetryOptions(max_retry_attempt_count=0)
+                CosmosObjects.__bulkCosmosClient = CosmosClient(url=ENDPOINT, credential=KEY, connection_policy=connection_policy, transport=cls.__getTransport(), connection_timeout=config.cosmos_connection_timeout_seconds)
+                logging.info("Azure Cosmos client for bulk writes created using URL and key given in config.py")
+
+        return CosmosObjects.__bulkCosmosClient
+
 
     @classmethod
     def __getCosmosDatabase(cls) -> AzureCosmosDatabase.DatabaseProxy:
         """Singleton method to return a Cosmos object"""
         if CosmosObjects.__cosmosDatabase == None:
             try:
-                cosmosClient = CosmosObjects.__getCosmosClient()
+                cosmosClient = CosmosObjects.getCosmosClient()
                 CosmosObjects.__cosmosDatabase = cosmosClient.create_database_if_not_exists(id=config.cosmosNoSQLDBName)
                 logging.info(f"Database created or returned: {CosmosObjects.__cosmosDatabase.id}")
 
@@ -51,7 +89,7 @@ class CosmosObjects:
 
     @classmethod
     def getCosmosContainer(cls, release: str) -> AzureCosmosContainer.ContainerProxy:
-        """Singleton method to return a Cosmos object
+        """Singleton method to return a Cosmos object. A new container is created with the vector and indexing policies in config.py.
 
         Args:
             release (str): The release (each release has its own container)
@@ -59,21 +97,63 @@ class CosmosObjects:
         Returns:
             AzureCosmosContainer.ContainerProxy: container
         """
-        if release not in cls.__cosmosContainers:
-            try:
-                partition_key_path = PartitionKey(path="/categoryId")
-                database = CosmosObjects.__getCosmosDatabase()
-                cls.__cosmosContainers[release] = database.create_container_if_not_exists(
-                    id=release,
-                    partition_key=partition_key_path,
-                    offer_throughput=400,
-                )
-                logging.info(f"Container created or returned: {CosmosObjects.__cosmosContainers[release].id}")
+        if release in cls.__cosmosContainers: return cls.__cosmosContainers[release]
+        with cls.__lock:
+            if release not in cls.__cosmosContainers:
+                try:
+                    partition_key_path = PartitionKey(path=config.cosmos_partition_key_path)
+                    database = CosmosObjects.__getCosmosDatabase()
+                    cls.__cosmosContainers[release] = database.create_container_if_not_exists(
+                        id=release,
+                        partition_key=partition_key_path,
+                        indexing_policy=config.indexing_policy,
+                        vector_embedding_policy=config.vector_embedding_policy,
+                        offer_throughput=400,
+                    )
+                    logging.info(f"Container created or returned: {CosmosObjects.__cosmosContainers[release].id}")
 
-            except AzureCosmosExceptions.CosmosHttpResponseError:
-                logging.error("Request to the Azure Cosmos database service failed.")
+                except AzureCosmosExceptions.CosmosHttpResponseError:
+                    logging.error("Request to the Azure Cosmos database service failed.")
 
         return cls.__cosmosContainers[release]
     
 
-    
\ No newline at end of file
+    
+
+    @classmethod
+    def getCosmosContainerForBulkWrites(cls, release: str) -> AzureCosmosContainer.ContainerProxy:
+        """Singleton method to return a Cosmos object. Same container as getCosmosContainer (which must have been called first, to make sure it exists), 
+        but through a client that leaves the handling of throttled requests to the caller.
+
+        Args:
+            release (str): The release (each release has its own container)
+
+        Returns:
+            AzureCosmosContainer.ContainerProxy: container
+        """
+        with cls.__lock:
+            if release not in cls.__bulkCosmosContainers:
+                database = CosmosObjects.__getBulkCosmosClient().get_database_client(config.cosmosNoSQLDBName)
+                cls.__bulkCosmosContainers[release] = database.get_container_client(release)
+
+        return cls.__bulkCosmosContainers[release]
+
+    @classmethod
+    def getPartitionKeyPath(cls, release: str) -> str:
+        """Returns the partition key path the container of a release was actually created with. 
+        Containers first created through the langchain wrapper are partitioned on '/id' rather than config.cosmos_partition_key_path.
+
+        Args:
+            release (str): The release (each release has its own container)
+
+        Returns:
+            str: eg: '/categoryId'
+        """
+        if release not in cls.__partitionKeyPaths:
+            cls.__partitionKeyPaths[release] = cls.getCosmosContainer(release).read()['partitionKey']['paths'][0]
+        return cls.__partitionKeyPaths[release]
+
+    @classmethod
+    def isPartitionedByChapter(cls, release: str) -> bool:
+        """Whether the documents of the release's container are partitioned by chapter (see config.cosmos_partition_key_path)."""
+        return cls.getPartitionKeyPath(release) == config.cosmos_partition_key_path
\ No newline at end of file
@@ -1,8 +1,17 @@
 import json
 import logging
 import config
-import csv
+import os
+import time
+import hashlib
+import threading
+import concurrent.futures
+from bisect import bisect_left, bisect_right
+from array import array
+from collections.abc import Mapping
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+from data_stores.ColumnarChapter import ColumnarChapter, ColumnarItems
+from data_stores.HSCodeToSCCodeMapping import HSCodeToSCCodeMapping
 from azure.storage.blob import ContainerClient
 from azure.core.exceptions import ResourceNotFoundError
 
@@ -12,20 +21,34 @@ class DataStores:
     Attributes:
         __hsCodeToSCCodeMapping: dict[str,str]: SC Code functionality temporarily removed. This holds an empty dictionary.
         __scCodeToHSCodeMapping: dict[str,str]: SC Code functionality temporarily removed. This holds an empty dictionary.
-        __json_dicts: dict[int,str]: Maps chapter_number-release_date with the chapter dictionary (a json string).
+        __json_dicts: dict[tuple[int,str],ColumnarChapter]: Maps chapter_number-release_date with the chapter dictionary (held in compact, read-only columnar form).
+        __etags: dict[tuple[int,str],str]: Maps chapter_number-release_date with the ETag of the json blob it was loaded from.
+        __changed_at: dict[tuple[int,str],int]: Maps chapter_number-release_date with the data version of its last upload/deletion through this process, so a full load that listed the container before it does not undo it.
+        __hscode_index: dict[int,tuple[list[str],list[str],array,dict[str,ColumnarItems]]]: Per chapter number, the sorted HS codes of every line item (of every release) and the matching release_date and item position postings.
+        __sccode_index: dict[str,list[tuple[str,int,int]]]: Inverted index mapping an SC code to the (release_date, chapter_number, item position) of every line item carrying it.
+        __sccode_postings_by_chapter: dict[int,dict[str,list[tuple[str,int,int]]]]: The part of __sccode_index contributed by each chapter, used to update __sccode_index one chapter at a time.
     """
 
-    __json_dicts: dict[tuple[str,int],str] = {} # Maps chapter_number-release_date with the chapter dictionary (a json string).
+    __json_dicts: dict[tuple[int,str],ColumnarChapter] = {} # Maps chapter_number-release_date with the chapter dictionary (read-only columnar form).
+    __etags: dict[tuple[int,str],str] = {} # Maps chapter_number-release_date with the ETag of the json blob it was loaded from.
+    __data_version: int = 0 # Increased every time a chapter is added, changed or removed.
+    __changed_at: dict[tuple[int,str],int] = {} # Maps chapter_number-release_date with the data version of its last change made other than by a full load (an upload or a deletion through this process).
+    __update_lock = threading.Lock() # Serializes changes to the json store and its indexes.
+    __sync_thread: threading.Thread = None
+    __hscode_index: dict[int,tuple[list[str],list[str],array,dict[str,ColumnarItems]]] = {} # Maps chapter_number to (sorted HS codes, release_dates, item positions, items of each release the positions refer to). Sorted by HS code ascending, then release descending.
+    __sccode_index: dict[str,list[tuple[str,int,int]]] = {} # Maps SC code to (release_date, chapter_number, item position) postings. Sorted by HS code ascending, then release descending.
+    __sccode_postings_by_chapter: dict[int,dict[str,list[tuple[str,int,int]]]] = {} # Maps chapter_number to that chapter's share of __sccode_index.
 
     @classmethod
-    def getJson_dicts(cls, chapterNumber_releaseDate_combos: list[tuple[int,str]] = None) -> dict[tuple[str,int],str]:
-        """Returns the singleton object containing the dictionary of chapter dictionaries (mapping chapter_number-release_date with the chapter dictionary (a json string)). Make sure to update this using updateJSONdictsFromAzureBlob if required.
+    def getJson_dicts(cls, chapterNumber_releaseDate_combos: list[tuple[int,str]] = None) -> dict[tuple[int,str],ColumnarChapter]:
+        """Returns the singleton object containing the dictionary of chapter dictionaries (mapping chapter_number-release_date with the chapter dictionary). Make sure to update this using updateJSONdictsFromAzureBlob if required.
+        The chapter dictionaries are read-only ColumnarChapter objects: they can be read like the parsed chapter json (eg: chapter['Items'][0]['HS Code']), but use dict(item) to get a line item that can be modified.
 
         Args:
             chapterNumber_releaseDate_combos (list[tuple[int,str]], optional): If specified, filters the returned dictionary to these combos. Defaults to None.
 
         Returns:
-            dict[tuple[str,int],str]: Dictionary mapping a chapter_number-release_date to its json string.
+            dict[tuple[int,str],ColumnarChapter]: Dictionary mapping a chapter_number-release_date to its chapter dictionary.
         """
         if chapterNumber_releaseDate_combos:
             dicts = {}
@@ -37,73 +60,313 @@ class DataStores:
     @classmethod
     def updateJSONdictsFromAzureBlob(cls, chapterNumber_releaseDate_combos: list[tuple[int,str]] = None) -> None:
         """Updates the singleton object containing the dictionary of chapter-release dictionaries from Azure storage.
+        Blobs are fetched concurrently (bounded by config.json_store_download_workers). When loading everything, chapters already in memory 
+        with the same ETag are skipped, and a blob whose ETag matches the local snapshot in config.json_store_cache_directory is read from disk instead of being downloaded again.
+        The data version (see getDataVersion) is increased whenever a chapter is added, changed or removed.
 
         Args:
             chapterNumber_releaseDate_combos (list[tuple[int,str]], optional): If specified, only updates the items matching this filter. Defaults to None.
         """
-        def updateJSONdictFromAzureBlob(_jsonName: str, _chapterNumber: int, _release_date: str):
+        def updateJSONdictFromAzureBlob(_jsonName: str, _etag: str = None) -> tuple[ColumnarChapter,str,bool]:
             """Helper method for updateJSONdictsFromAzureBlob parent function.
+            Returns the chapter (None if the blob does not exist), the ETag of the blob it was read from, and whether it came from the local snapshot.
             """
+            if _etag != None:
+                blob_text = cls.__readFromDiskCache(_jsonName, _etag)
+                if blob_text != None: return ColumnarChapter(json.loads(blob_text)), _etag, True
             blob_client = container_client.get_blob_client(blob=_jsonName)
             try:
                 downloader = blob_client.download_blob(max_concurrency=1, encoding='UTF-8')
                 blob_text = downloader.readall()
-                json_dict = json.loads(blob_text)
-                cls.__json_dicts[(_chapterNumber, _release_date)] = json_dict
             except ResourceNotFoundError: # that means the chapter does not exist (probably has been deleted). Therefore it must be removed from cls.__json_dicts
-                try: del cls.__json_dicts[(_chapterNumber, _release_date)]
-                except KeyError: pass # the chapter was not in cls.__json_dicts anyway, so nothing to do
-            
+                cls.__removeFromDiskCache(_jsonName)
+                return None, None, False
+            etag = downloader.properties.etag
+            cls.__writeToDiskCache(_jsonName, etag, blob_text)
+            return ColumnarChapter(json.loads(blob_text)), etag, False
 
         container_client: ContainerClient = abo.get_container_client(config.json_container_name)
-        jsonNameList = abo.getListOfFilenamesInContainer(config.json_container_name)
+        startVersion = cls.__data_version # a full load leaves alone the chapters changed after this, its listing may predate the change
+        phaseStart = time.perf_counter()
 
+        # phase 1: work out which blobs to fetch
+        jsonNamesAndEtags: dict[str,str] = {}
+        listedKeys: set[tuple[int,str]] = set()
         if chapterNumber_releaseDate_combos:
-            for combo in chapterNumber_releaseDate_combos:
-                chapter_number = combo[0]
-                release_date = combo[1]
-                jsonName = release_date + '/'+ str(chapter_number) + '.json'
-                updateJSONdictFromAzureBlob(jsonName, chapter_number, release_date)
+            for chapter_number, release_date in chapterNumber_releaseDate_combos:
+                jsonNamesAndEtags[release_date + '/'+ str(chapter_number) + '.json'] = None # always downloaded, these were just changed
         else:
-            for jsonName in jsonNameList:
+            for blob in container_client.list_blobs():
+                key = (int(blob.name.rsplit('/')[1].rsplit('.')[0]), blob.name.rsplit('/')[0])
+                listedKeys.add(key)
+                if cls.__etags.get(key) == blob.etag and key in cls.__json_dicts: continue # unchanged since it was loaded
+                jsonNamesAndEtags[blob.name] = blob.etag
+        listingTime = time.perf_counter() - phaseStart
+
+        # phase 2: fetch (from the local snapshot or Azure) and parse
+        phaseStart = time.perf_counter()
+        fetched: dict[tuple[int,str],tuple[ColumnarChapter,str,bool]] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.json_store_download_workers) as executor:
+            futures = {}
+            for jsonName, etag in jsonNamesAndEtags.items():
                 release_date = jsonName.rsplit('/')[0]
                 chapter_number = int(jsonName.rsplit('/')[1].rsplit('.')[0])
-                updateJSONdictFromAzureBlob(jsonName, chapter_number, release_date)
-        logging.info("Loading jsons from Azure Blob into memory completed.")
+                futures[(chapter_number, release_date)] = executor.submit(updateJSONdictFromAzureBlob, jsonName, etag)
+            for key, future in futures.items():
+                try: fetched[key] = future.result()
+                except Exception as e: logging.error(f'Could not load json of chapter {key[0]} of release {key[1]} into memory: {e}')
+        fetchTime = time.perf_counter() - phaseStart
+
+        # phase 3: swap the chapters in and rebuild the indexes of the chapters that changed
+        phaseStart = time.perf_counter()
+        updatedChapterNumbers: set[int] = set()
+        removed = 0
+        with cls.__update_lock:
+            for key, (chapter, etag, _) in fetched.items():
+                if not chapterNumber_releaseDate_combos and cls.__changed_at.get(key, 0) > startVersion: continue
+                if chapter == None:
+                    if cls.__json_dicts.pop(key, None) == None: continue # the chapter was not in cls.__json_dicts anyway, so nothing changed
+                    cls.__etags.pop(key, None)
+                    removed += 1
+                else:
+                    cls.__json_dicts[key] = chapter
+                    cls.__etags[key] = etag
+                if chapterNumber_releaseDate_combos: cls.__changed_at[key] = cls.__data_version + 1 # the data version once this update is done
+                updatedChapterNumbers.add(key[0])
+            if not chapterNumber_releaseDate_combos: # a full listing also tells us which chapters no longer exist
+                for key in list(cls.__json_dicts.keys()):
+                    if key in listedKeys: continue
+                    if cls.__changed_at.get(key, 0) > startVersion: continue # uploaded after the listing was taken
+                    cls.__json_dicts.pop(key, None); cls.__etags.pop(key, None)
+                    cls.__removeFromDiskCache(key[1] + '/' + str(key[0]) + '.json')
+                    updatedChapterNumbers.add(key[0])
+                    removed += 1
+            for chapter_number in updatedChapterNumbers: cls.__rebuildHSCodeIndex(chapter_number)
+            if len(updatedChapterNumbers) > 0: cls.__data_version += 1
+        indexingTime = time.perf_counter() - phaseStart
+
+        loaded = sum(1 for chapter, _, _ in fetched.values() if chapter != None)
+        fromCache = sum(1 for _, _, isFromCache in fetched.values() if isFromCache)
+        logLevel = logging.INFO if len(updatedChapterNumbers) > 0 or chapterNumber_releaseDate_combos else logging.DEBUG # background syncs that find nothing new stay quiet
+        logging.log(logLevel, "Loading jsons from Azure Blob into memory completed. "
+                     f"{loaded} chapters loaded ({fromCache} from local snapshot, {loaded - fromCache} downloaded), {removed} removed. Data version: {cls.__data_version}. "
+                     f"Timings - listing: {listingTime:.2f}s, fetching and parsing: {fetchTime:.2f}s, indexing: {indexingTime:.2f}s")
+
+    @classmethod
+    def getDataVersion(cls) -> int:
+        """Returns the data version of the json store held by this process. It only ever increases, and does so every time a chapter is added, changed or removed."""
+        return cls.__data_version
+
+    @classmethod
+    def getContentFingerprint(cls, releases: list[str] = None) -> str:
+        """Returns a fingerprint of the chapters held (of the given releases), made from the ETags of the json blobs they were loaded from.
+        Unlike getDataVersion, it is the same in every process that holds the same chapters, so it can be used to tell whether something made from the json store is current.
+
+        Args:
+            releases (list[str], optional): If given, only chapters of these releases. Defaults to None.
+
+        Returns:
+            str: hex digest
+        """
+        with cls.__update_lock:
+            keys = [key for key in cls.__json_dicts.keys() if releases == None or key[1] in releases]
+            entries = sorted(f'{release_date}/{chapter_number}:{cls.__etags.get((chapter_number, release_date))}' for chapter_number, release_date in keys)
+        return hashlib.sha256('\n'.join(entries).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def startBackgroundSync(cls) -> None:
+        """Starts a daemon thread that keeps the json store of this process in line with Azure storage, by re-running updateJSONdictsFromAzureBlob 
+        every config.json_store_sync_interval_seconds. Only chapters whose blob ETag changed (or that were added or removed) are fetched.
+        This keeps every worker (and every instance) current, not just the one that handled an upload. Calling it again does nothing.
+        """
+        with cls.__update_lock:
+            if cls.__sync_thread != None: return
+            def sync():
+                while True:
+                    time.sleep(config.json_store_sync_interval_seconds)
+                    try: cls.updateJSONdictsFromAzureBlob()
+                    except Exception as e: logging.error(f'Background sync of the json store failed: {e}')
+            cls.__sync_thread = threading.Thread(target=sync, name='json-store-sync', daemon=True)
+            cls.__sync_thread.start()
+        logging.info(f'Background sync of the json store started (every {config.json_store_sync_interval_seconds} seconds)')
+
+    @classmethod
+    def __getDiskCachePaths(cls, jsonName: str) -> tuple[str,str]:
+        """Returns the paths of the local snapshot of a json blob and of the file holding the ETag it was saved with. None if the blob name cannot be used as a path."""
+        parts = jsonName.split('/')
+        if any(part in ('', '.', '..') for part in parts): return None
+        jsonPath = os.path.join(config.json_store_cache_directory, *parts)
+        return jsonPath, jsonPath + '.etag'
+
+    @classmethod
+    def __readFromDiskCache(cls, jsonName: str, etag: str) -> str:
+        """Returns the locally saved json text if it was saved from a blob with the given ETag, otherwise None."""
+        paths = cls.__getDiskCachePaths(jsonName)
+        if paths == None: return None
+        jsonPath, etagPath = paths
+        try:
+            with open(etagPath, mode='r', encoding='utf-8') as file:
+                if file.read() != etag: return None
+            with open(jsonPath, mode='r', encoding='utf-8') as file:
+                return file.read()
+        except OSError: return None
+
+    @classmethod
+    def __writeToDiskCache(cls, jsonName: str, etag: str, blob_text: str) -> None:
+        paths = cls.__getDiskCachePaths(jsonName)
+        if paths == None or etag == None: return
+        jsonPath, etagPath = paths
+        try:
+            os.makedirs(os.path.dirname(jsonPath), exist_ok=True)
+            # the etag file is written last, so a half written snapshot is never matched with an ETag
+            cls.__removeFromDiskCache(jsonName)
+            with open(jsonPath + '.tmp', mode='w', encoding='utf-8') as file: file.write(blob_text)
+            os.replace(jsonPath + '.tmp', jsonPath)
+            with open(etagPath + '.tmp', mode='w', encoding='utf-8') as file: file.write(etag)
+            os.replace(etagPath + '.tmp', etagPath)
+        except OSError as e: logging.warning(f'Could not save local snapshot of {jsonName}: {e}')
+
+    @classmethod
+    def __removeFromDiskCache(cls, jsonName: str) -> None:
+        paths = cls.__getDiskCachePaths(jsonName)
+        if paths == None: return
+        for path in reversed(paths):
+            try: os.remove(path)
+            except OSError: pass
 
     @classmethod
-    def insertNewJSONDictManually(cls, json_string: str, chapterNumber: int, release_date: str) -> None:
+    def insertNewJSONDictManually(cls, json_string: str, chapterNumber: int, release_date: str, etag: str = None) -> None:
         """Inserts a dictionary for a specified chapter_number-release_date in the singleton object 
         holding all of the chapter_number-release_date to json string mapping.
+
+        Args:
+            etag (str, optional): ETag of the json blob the json_string was uploaded as. If given, the background sync knows this chapter is current and does not fetch it again. Defaults to None.
         """
-        new_json_dict = json.loads(json_string)
-        cls.__json_dicts[(chapterNumber, release_date)] = new_json_dict
+        new_json_dict = ColumnarChapter(json.loads(json_string))
+        with cls.__update_lock:
+            cls.__json_dicts[(chapterNumber, release_date)] = new_json_dict
+            if etag != None: cls.__etags[(chapterNumber, release_date)] = etag
+            else: cls.__etags.pop((chapterNumber, release_date), None) # not known here, the next load from Azure Blob fills it in
+            cls.__rebuildHSCodeIndex(chapterNumber)
+            cls.__data_version += 1
+            cls.__changed_at[(chapterNumber, release_date)] = cls.__data_version
 
     @classmethod
-    def getHSCodeToSCCodeMapping(cls) -> dict[str,str]:
-        """Temporary implementation. Reads hscode to sc code mapping from the csv file.
+    def __rebuildHSCodeIndex(cls, chapterNumber: int) -> None:
+        """Rebuilds the HS code index of a single chapter from every release of that chapter currently held in memory, and updates the chapter's share of the SC code index.
+        The new indexes are built on the side and swapped in with a single assignment, so concurrent searches see either the old or the new index.
         """
+        postings: list[tuple[str,str,int]] = []
+        itemsByRelease: dict[str,ColumnarItems] = {}
+        sccodes: dict[tuple[str,int],str] = {}
+        for (_chapterNumber, release_date), chapter in list(cls.__json_dicts.items()):
+            if _chapterNumber != chapterNumber: continue
+            items: ColumnarItems = chapter['Items']
+            itemsByRelease[release_date] = items
+            for position, (hscode, sccode) in enumerate(zip(items.get_column('HS Code'), items.get_column('SC Code'))):
+                postings.append((hscode, release_date, position))
+                if sccode: sccodes[(release_date, position)] = sccode
 
-        # Read from csv file containing HS Code to SC Code mapping. HS Code is unique.
-        csv_file = 'files/HSCode_to_SCCode_Mapping Sorted.csv'
-        rows = []
+        # sorting by HS code ascending, then release descending (two stable sorts, least significant key first)
+        postings.sort(key=lambda posting: posting[1], reverse=True)
+        postings.sort(key=lambda posting: posting[0])
 
-        with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
+        if len(postings) == 0: cls.__hscode_index.pop(chapterNumber, None)
+        else:
+            hscodes = [posting[0] for posting in postings]
+            releases = [posting[1] for posting in postings]
+            positions = array('i', [posting[2] for posting in postings])
+            cls.__hscode_index[chapterNumber] = (hscodes, releases, positions, itemsByRelease)
 
-            for row in csv_reader:
-                rows.append(row)
+        sccodePostings: dict[str,list[tuple[str,int,int]]] = {}
+        for _, release_date, position in postings:
+            sccode = sccodes.get((release_date, position))
+            if sccode == None: continue
+            sccodePostings.setdefault(sccode, []).append((release_date, chapterNumber, position))
+        cls.__updateSCCodeIndex(chapterNumber, sccodePostings)
 
-        # HS Code format: ####.##.##N
+    @classmethod
+    def __updateSCCodeIndex(cls, chapterNumber: int, sccodePostings: dict[str,list[tuple[str,int,int]]]) -> None:
+        """Replaces the postings a chapter contributes to the SC code index.
+        Chapters cover disjoint HS code ranges (the chapter number is the start of the HS code), so concatenating the per-chapter postings 
+        in chapter order keeps each SC code's postings sorted by HS code ascending, then release descending.
+        """
+        previousPostings = cls.__sccode_postings_by_chapter.get(chapterNumber, {})
+        if len(sccodePostings) == 0: cls.__sccode_postings_by_chapter.pop(chapterNumber, None)
+        else: cls.__sccode_postings_by_chapter[chapterNumber] = sccodePostings
+
+        for sccode in set(previousPostings.keys()) | set(sccodePostings.keys()):
+            postings = []
+            for _chapterNumber in sorted(cls.__sccode_postings_by_chapter.keys()):
+                postings += cls.__sccode_postings_by_chapter[_chapterNumber].get(sccode, [])
+            if len(postings) == 0: cls.__sccode_index.pop(sccode, None)
+            else: cls.__sccode_index[sccode] = postings
+
+    @classmethod
+    def searchHSCodeIndex(cls, chapterNumber: int, hscodePrefix: str, whitelist_releases: list[str] = None) -> list[tuple[str,Mapping]]:
+        """Returns the line items of a chapter whose standardized HS code starts with the given prefix, using a binary search over the chapter's HS code index.
+
+        Args:
+            chapterNumber (int): chapter to search in
+            hscodePrefix (str): start of a standardized HS code (format ####.##.##N) eg: '28', '2802', '2802.10'
+            whitelist_releases (list[str], optional): If given, filters the results to only those of the whitelisted release dates. Defaults to None.
 
-        hsCodeToSCCodeMapping = {}
+        Returns:
+            list[tuple[str,Mapping]]: (release_date, read-only line item) pairs, sorted by HS code ascending, then release descending
+        """
+        index = cls.__hscode_index.get(chapterNumber)
+        if index == None or hscodePrefix == '': return []
+        hscodes, releases, positions, itemsByRelease = index
 
-        for n in range(1,len(rows)):
-            row = rows[n]
-            key = row[0]
-            value = row[1]
-            hsCodeToSCCodeMapping[key] = value
-        
-        if not bool(hsCodeToSCCodeMapping): print("WARNING: HS Code to SC Code dictionary is empty!")
+        start = bisect_left(hscodes, hscodePrefix)
+        end = bisect_left(hscodes, hscodePrefix + '\uffff', lo=start) # HS codes are ascii, so this sorts after every code with the prefix
+        results = []
+        for i in range(start, end):
+            release_date = releases[i]
+            if whitelist_releases and release_date not in whitelist_releases: continue
+            results.append((release_date, itemsByRelease[release_date][positions[i]]))
+        return results
+
+    @classmethod
+    def getLineItemsByHSCode(cls, release_date: str, hscode: str) -> list[Mapping]:
+        """Returns the line items of a release with exactly the given standardized HS code (usually one), using a binary search over the HS code index of its chapter.
 
-        return hsCodeToSCCodeMapping
+        Args:
+            release_date (str): release to look in
+            hscode (str): standardized HS code (format ####.##.##N) eg: '2802.10.00N'
+
+        Returns:
+            list[Mapping]: read-only line items, in the order they appear in the chapter
+        """
+        try: chapterNumber = int(hscode[:2])
+        except ValueError: return []
+        index = cls.__hscode_index.get(chapterNumber)
+        if index == None: return []
+        hscodes, releases, positions, itemsByRelease = index
+
+        start = bisect_left(hscodes, hscode)
+        end = bisect_right(hscodes, hscode, lo=start)
+        return [itemsByRelease[release_date][positions[i]] for i in range(start, end) if releases[i] == release_date]
+
+    @classmethod
+    def searchSCCodeIndex(cls, sccode: str) -> list[tuple[str,int,Mapping]]:
+        """Returns every line item (of every chapter and release) that carries the given SC code, using a single lookup in the SC code index.
+
+        Args:
+            sccode (str): SC code in the stored format eg: 'SC151'
+
+        Returns:
+            list[tuple[str,int,Mapping]]: (release_date, chapter_number, read-only line item) triples, sorted by HS code ascending, then release descending
+        """
+        results = []
+        for release_date, chapterNumber, position in cls.__sccode_index.get(sccode, []):
+            try: item = cls.__json_dicts[(chapterNumber, release_date)]['Items'][position]
+            except (KeyError, IndexError): continue # the chapter is being reloaded right now, its postings will be replaced shortly
+            results.append((release_date, chapterNumber, item))
+        return results
+
+    @classmethod
+    def getHSCodeToSCCodeMapping(cls) -> dict[str,str]:
+        """Returns the hscode to sc code mapping (held in memory by HSCodeToSCCodeMapping, the csv file is not read again unless it changed).
+        """
+        return HSCodeToSCCodeMapping.getMapping()
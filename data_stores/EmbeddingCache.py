@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+import config
+from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+from other_funcs.getEmbeddings import getEmbeddings
+
+class EmbeddingCache:
+    """Singleton class caching vector embeddings so the same text is not sent to the embedding model twice.
+    Query embeddings have two tiers: a bounded in-memory LRU (config.embedding_cache_size entries), backed by one blob per embedding in config.embedding_cache_container_name, which survives restarts and is shared by all workers/instances.
+    Document embeddings (texts of line items, embedded during ingestion) are only kept in blobs, so ingesting text seen in an earlier chapter or release costs no embedding call.
+    Keys are the sha256 of the embedding model name and the exact text (a cached vector is always the embedding of the text looked up), so changing config.embeddingModel never returns stale vectors.
+    Vectors are stored as float64 bytes, so a cached vector is identical to the one the model returned.
+
+    Attributes:
+        __lru: OrderedDict[str,list[float]]: In-memory tier, least recently used first.
+        __stats: dict[str,int]: Hit/miss counters, see getStats().
+    """
+
+    __lru: OrderedDict[str,list[float]] = OrderedDict()
+    __lock = threading.Lock()
+    __stats: dict[str,int] = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0, 'document_hits': 0, 'document_misses': 0}
+    __writer = concurrent.futures.ThreadPoolExecutor(max_workers=2) # persists new embeddings without holding up the request
+
+    @classmethod
+    def getQueryEmbedding(cls, question: str) -> list[float]:
+        """Returns the vector embedding of a user's query, from the cache if the same query was embedded before.
+        A lookup in the persistent tier is given up after config.embedding_cache_query_lookup_timeout_seconds, so a slow read does not hold up the search more than that.
+
+        Args:
+            question (str): user's query
+
+        Returns:
+            list[float]: vector embedding
+        """
+        key = cls.__getKey('query', question)
+        vector = cls.__get(key)
+        if vector != None: return vector
+
+        vector = getEmbeddings.getEmbeddings().embed_query(question)
+        cls.__put(key, vector)
+        return vector
+
+    @classmethod
+    def getDocumentEmbeddings(cls, texts: list[str]) -> dict[str,list[float]]:
+        """Looks up the embeddings of document texts in the persistent tier, config.embedding_cache_download_workers at a time.
+
+        Args:
+            texts (list[str]): distinct texts
+
+        Returns:
+            dict[str,list[float]]: text -> vector embedding, for the texts that were found
+        """
+        def get_document_embedding(text: str):
+            """Helper function."""
+            return text, cls.__getPersisted(cls.__getKey('document', text))
+
+        found = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.embedding_cache_download_workers) as executor:
+            for text, vector in executor.map(get_document_embedding, texts):
+                if vector != None: found[text] = vector
+        with cls.__lock:
+            cls.__stats['document_hits'] += len(found)
+            cls.__stats['document_misses'] += len(texts) - len(found)
+        return found
+
+    @classmethod
+    def putDocumentEmbeddings(cls, vectorsByText: dict[str,list[float]]) -> None:
+        """Persists newly generated embeddings of document texts (waits until they are written).
+
+        Args:
+            vectorsByText (dict[str,list[float]]): text -> vector embedding
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.embedding_cache_download_workers) as executor:
+            for text, vector in vectorsByText.items():
+                executor.submit(cls.__persist, cls.__getKey('document', text), vector)
+
+    @classmethod
+    def getStats(cls) -> dict[str,int]:
+        """Returns the hit/miss counters ('memory_hits', 'persistent_hits', 'misses' of queries, 'document_hits', 'document_misses') and the current number of entries in memory ('size')."""
+        with cls.__lock:
+            stats = dict(cls.__stats)
+            stats['size'] = len(cls.__lru)
+        return stats
+
+    @staticmethod
+    def __getKey(kind: str, text: str) -> str:
+        return kind + '/' + hashlib.sha256(f'{config.embeddingModel}\n{text}'.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def __get(cls, key: str) -> list[float]:
+        """Looks up a key in memory, then in the persistent tier (promoting it to memory on a hit). Returns None on a miss."""
+        with cls.__lock:
+            vector = cls.__lru.get(key)
+            if vector != None:
+                cls.__lru.move_to_end(key)
+                cls.__stats['memory_hits'] += 1
+                return vector
+
+        vector = cls.__getPersisted(key, config.embedding_cache_query_lookup_timeout_seconds)
+        with cls.__lock:
+            if vector == None:
+                cls.__stats['misses'] += 1
+                return None
+            cls.__stats['persistent_hits'] += 1
+        cls.__remember(key, vector)
+        return vector
+
+    @classmethod
+    def __getPersisted(cls, key: str, timeout: float = None) -> list[float]:
+        """Reads a key from the persistent tier. Returns None if it is not there (or cannot be read, within timeout seconds and without retries if a timeout is given)."""
+        try:
+            blob_client = abo.get_container_client(config.embedding_cache_container_name).get_blob_client(key)
+            if timeout == None: return np.frombuffer(blob_client.download_blob().readall(), dtype=np.float64).tolist()
+            downloader = blob_client.download_blob(timeout=max(1, int(timeout)), connection_timeout=timeout, read_timeout=timeout, retry_total=0)
+            return np.frombuffer(downloader.readall(), dtype=np.float64).tolist()
+        except ResourceNotFoundError:
+            return None
+        except Exception as e: # the cache must never break a search or an ingestion
+            logging.warning(f'Could not read embedding {key} from the persistent embedding cache: {e}')
+            return None
+
+    @classmethod
+    def __put(cls, key: str, vector: list[float]) -> None:
+        cls.__remember(key, vector)
+        cls.__writer.submit(cls.__persist, key, vector)
+
+    @classmethod
+    def __remember(cls, key: str, vector: list[float]) -> None:
+        with cls.__lock:
+            cls.__lru[key] = vector
+            cls.__lru.move_to_end(key)
+            while len(cls.__lru) > config.embedding_cache_size: cls.__lru.popitem(last=False)
+
+    @classmethod
+    def __persist(cls, key: str, vector: list[float]) -> None:
+        try:
+            abo.get_container_client(config.embedding_cache_container_name).upload_blob(name=key, data=np.asarray(vector, dtype=np.float64).tobytes(), overwrite=True)
+        except Exception as e:
+            logging.warning(f'Could not write embedding {key} to the persistent embedding cache: {e}')
@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+import concurrent.futures
+
+import config
+
+class FileCatalog:
+    """Singleton class holding, in memory, what the file management page shows: the names of the blobs in the generated-excel, reviewed-excel and json containers
+    (as sets, so checking whether a chapter has a file is O(1)) and the status of every chapter record.
+    It is loaded from storage on first use, and then kept current by the upload/delete paths of this process, which report each change
+    (AzureBlobObjects.upload_to_blob_from_stream, deletingFuncs, and the chapter record methods of AzureTableObjects).
+    Changes made by other workers/instances are picked up by a background refresh (see startBackgroundRefresh).
+
+    Attributes:
+        __blobNames: dict[str,set[str]]: container name -> names of the blobs in it (eg: '2024-01-01/5.xlsx'), for the containers in __containers
+        __chapterRecordStatuses: dict[str,str]: chapter record rowkey (release_date:chapterNumber) -> RecordStatus
+        __changesDuringRefresh: dict[str,dict[str,object]]: source being refreshed -> changes reported while its listing was being read (re-applied on top of the listing)
+    """
+
+    __containers = [config.generatedExcel_container_name, config.reviewedExcel_container_name, config.json_container_name]
+    __chapterRecordsSource = 'chapter records' # key of the chapter records in __changesDuringRefresh and the refresh rotation
+    __blobNames: dict[str,set[str]] = {}
+    __chapterRecordStatuses: dict[str,str] = {}
+    __changesDuringRefresh: dict[str,dict[str,object]] = {}
+    __loaded = False
+    __lock = threading.Lock() # guards the attributes above
+    __load_lock = threading.Lock()
+    __refresh_thread: threading.Thread = None
+
+    @classmethod
+    def __list(cls, source: str) -> set[str] | dict[str,str]:
+        """Reads a source from storage: the blob names of a container, or the rowkeys and statuses of the chapter records."""
+        # imported here since AzureBlobObjects and AzureTableObjects report their changes to this class
+        if source == cls.__chapterRecordsSource:
+            from data_stores.AzureTableObjects import AzureTableObjects as ato
+            table_client = ato.get_table_client(config.azureStorage_chapterTracker_TableName)
+            return {entity['RowKey']: entity['RecordStatus'] for entity in table_client.list_entities(select=['RowKey', 'RecordStatus'])}
+        from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+        return set(abo.getListOfFilenamesInContainer(source))
+
+    @classmethod
+    def __refreshSource(cls, source: str) -> None:
+        """Replaces the cached listing of a source with the one in storage. Changes this process reported while the listing was being read are kept,
+        as the listing may have been taken before they were made.
+        """
+        with cls.__lock: cls.__changesDuringRefresh[source] = {}
+        try: listing = cls.__list(source)
+        except Exception:
+            with cls.__lock: cls.__changesDuringRefresh.pop(source, None)
+            raise
+        with cls.__lock:
+            for key, value in cls.__changesDuringRefresh.pop(source).items():
+                cls.__applyChange(listing, key, value)
+            if source == cls.__chapterRecordsSource: cls.__chapterRecordStatuses = listing
+            else: cls.__blobNames[source] = listing
+
+    @staticmethod
+    def __applyChange(listing: set[str] | dict[str,str], key: str, value) -> None:
+        """value: True/False for a blob that was uploaded/deleted, the new status of a chapter record, or None for a deleted chapter record."""
+        if isinstance(listing, set):
+            if value: listing.add(key)
+            else: listing.discard(key)
+        elif value == None: listing.pop(key, None)
+        else: listing[key] = value
+
+    @classmethod
+    def __report(cls, source: str, key: str, value) -> None:
+        """Applies a change made by this process to the cached listing (if it is loaded), and to the listing of a refresh in progress."""
+        with cls.__lock:
+            if not cls.__loaded: return # it will be in the listing when the catalog is loaded
+            if source in cls.__changesDuringRefresh: cls.__changesDuringRefresh[source][key] = value
+            if source == cls.__chapterRecordsSource: cls.__applyChange(cls.__chapterRecordStatuses, key, value)
+            elif source in cls.__blobNames: cls.__applyChange(cls.__blobNames[source], key, value)
+
+    @classmethod
+    def __ensureLoaded(cls) -> None:
+        """Loads every source from storage (concurrently) the first time the catalog is used."""
+        if cls.__loaded: return
+        with cls.__load_lock:
+            if cls.__loaded: return
+            startTime = time.perf_counter()
+            sources = cls.__containers + [cls.__chapterRecordsSource]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                listings = list(executor.map(cls.__list, sources))
+            with cls.__lock:
+                for source, listing in zip(sources, listings):
+                    if source == cls.__chapterRecordsSource: cls.__chapterRecordStatuses = listing
+                    else: cls.__blobNames[source] = listing
+                cls.__loaded = True
+            logging.info(f'File catalog loaded in {(time.perf_counter() - startTime) * 1000:.0f} ms ({len(cls.__chapterRecordStatuses)} chapter records)')
+
+    @classmethod
+    def getChapterRecordStatuses(cls) -> list[tuple[str,str]]:
+        """Returns the rowkey (release_date:chapterNumber) and RecordStatus of every chapter record, ordered by rowkey (as the table lists them).
+
+        Returns:
+            list[tuple[str,str]]: rowkey, RecordStatus
+        """
+        cls.__ensureLoaded()
+        with cls.__lock: return sorted(cls.__chapterRecordStatuses.items())
+
+    @classmethod
+    def getBlobNames(cls, containerName: str) -> set[str]:
+        """Returns the names of the blobs in a container (one of generated excel, reviewed excel or json). Shared, do not modify it.
+
+        Args:
+            containerName (str): _description_
+
+        Returns:
+            set[str]: blob names (eg: '2024-01-01/5.xlsx')
+        """
+        cls.__ensureLoaded()
+        with cls.__lock: return cls.__blobNames[containerName]
+
+    @classmethod
+    def blobUploaded(cls, containerName: str, blobName: str) -> None:
+        cls.__report(containerName, blobName, True)
+
+    @classmethod
+    def blobDeleted(cls, containerName: str, blobName: str) -> None:
+        cls.__report(containerName, blobName, False)
+
+    @classmethod
+    def chapterRecordChanged(cls, rowkey: str, recordStatus: str) -> None:
+        cls.__report(cls.__chapterRecordsSource, rowkey, recordStatus)
+
+    @classmethod
+    def chapterRecordDeleted(cls, rowkey: str) -> None:
+        cls.__report(cls.__chapterRecordsSource, rowkey, None)
+
+    @classmethod
+    def startBackgroundRefresh(cls) -> None:
+        """Starts a daemon thread that re-reads one source of the catalog from storage every config.file_catalog_refresh_seconds, in turn
+        (generated excels, reviewed excels, jsons, chapter records), so that changes made through other workers/instances show up.
+        Calling it again does nothing.
+        """
+        with cls.__load_lock:
+            if cls.__refresh_thread != None: return
+            def refresh():
+                sources = cls.__containers + [cls.__chapterRecordsSource]
+                i = 0
+                while True:
+                    time.sleep(config.file_catalog_refresh_seconds)
+                    if not cls.__loaded: continue # nobody has opened the file management page yet
+                    try: cls.__refreshSource(sources[i])
+                    except Exception as e: logging.error(f'Background refresh of the file catalog ({sources[i]}) failed: {e}')
+                    i = (i + 1) % len(sources)
+            cls.__refresh_thread = threading.Thread(target=refresh, name='file-catalog-refresh', daemon=True)
+            cls.__refresh_thread.start()
+        logging.info(f'Background refresh of the file catalog started (a source every {config.file_catalog_refresh_seconds} seconds)')
@@ -0,0 +1,88 @@
+import csv
+import os
+import logging
+import threading
+
+import config
+
+class HSCodeToSCCodeMapping:
+    """Singleton class holding the HS code to SC code mapping (config.hscode_to_sccode_mapping_filepath) in memory, for every caller in the process.
+    The csv is parsed once, and parsed again only when the file changes (its modification time or size).
+    
+    Attributes:
+        __hsCodeToSCCode: dict[str,str]: standardized HS code (####.##.##N) -> SC code. An HS code may stand for a whole heading (####.00.00N) or subheading (####.##.00N).
+        __scCodeToHSCodes: dict[str,list[str]]: SC code -> the HS codes mapped to it (in the order of the csv)
+        __fileSignature: tuple[int,int]: modification time and size of the csv when it was parsed
+    """
+
+    __hsCodeToSCCode: dict[str,str] = {}
+    __scCodeToHSCodes: dict[str,list[str]] = {}
+    __fileSignature: tuple[int,int] = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def __refresh(cls) -> None:
+        """Parses the csv again if it changed since it was last parsed."""
+        try:
+            stat = os.stat(config.hscode_to_sccode_mapping_filepath)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError as e:
+            if cls.__fileSignature == None: logging.error(f'HS code to SC code mapping could not be read: {e}')
+            return # keep serving the mapping last read
+        if signature == cls.__fileSignature: return
+
+        with cls.__lock:
+            if signature == cls.__fileSignature: return
+            hsCodeToSCCode: dict[str,str] = {}
+            scCodeToHSCodes: dict[str,list[str]] = {}
+            with open(config.hscode_to_sccode_mapping_filepath, mode='r', newline='', encoding='utf-8') as file:
+                csv_reader = csv.reader(file)
+                next(csv_reader, None) # header row
+                for row in csv_reader: # HS Code is unique
+                    if len(row) < 2: continue
+                    hsCodeToSCCode[row[0]] = row[1]
+                    scCodeToHSCodes.setdefault(row[1], []).append(row[0])
+
+            if not bool(hsCodeToSCCode): logging.warning("HS Code to SC Code dictionary is empty!")
+            cls.__hsCodeToSCCode, cls.__scCodeToHSCodes = hsCodeToSCCode, scCodeToHSCodes # swapped in together, readers never see a half-built mapping
+            cls.__fileSignature = signature
+            logging.info(f'HS code to SC code mapping loaded ({len(hsCodeToSCCode)} HS codes, {len(scCodeToHSCodes)} SC codes)')
+
+    @classmethod
+    def getMapping(cls) -> dict[str,str]:
+        """Returns the HS code -> SC code mapping. Shared, do not modify it.
+
+        Returns:
+            dict[str,str]: standardized HS code (####.##.##N) -> SC code
+        """
+        cls.__refresh()
+        return cls.__hsCodeToSCCode
+
+    @classmethod
+    def getSCCode(cls, hscode: str) -> str:
+        """Returns the SC code of the most specific entry of the mapping that covers the HS code: the HS code itself, else its subheading (####.##.00N), else its heading (####.00.00N).
+
+        Args:
+            hscode (str): standardized HS code (format ####.##.##N) eg: '8202.10.20N'
+
+        Returns:
+            str: SC code, '' if none of them is mapped
+        """
+        cls.__refresh()
+        mapping = cls.__hsCodeToSCCode
+        for candidate in (hscode, hscode[:-3] + "00N", hscode[:-6] + "00.00N"):
+            if candidate in mapping: return mapping[candidate]
+        return ''
+
+    @classmethod
+    def getHSCodes(cls, sccode: str) -> list[str]:
+        """Reverse lookup. Returns the HS codes mapped to an SC code (each may stand for a whole heading or subheading, see getSCCode).
+
+        Args:
+            sccode (str): eg: 'SC151'
+
+        Returns:
+            list[str]: standardized HS codes
+        """
+        cls.__refresh()
+        return list(cls.__scCodeToHSCodes.get(sccode, []))
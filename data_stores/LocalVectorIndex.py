@@ -0,0 +1,195 @@
+import time
+import logging
+import threading
+from io import BytesIO
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+import config
+from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+from data_stores.CosmosObjects import CosmosObjects
+from data_stores.DataStores import DataStores
+
+class LocalVectorIndex:
+    """Singleton class holding an in-process vector index per release, as an alternative to running VectorDistance queries in Cosmos DB (select it with config.vectorstore = "local_numpy").
+    When it is selected, ingestion writes a snapshot of every chapter's vectors (a .npz blob holding the HS codes and a float32 matrix) to config.vector_snapshot_container_name.
+    A release's index is all of its chapter snapshots stacked into one matrix, and a search is a single matrix-vector product followed by argpartition for the top k.
+    Chapters ingested before snapshots were written have none, so their snapshots are made from the vectors in Cosmos by a background thread (see startBackgroundBackfill).
+    Until that is done for a release, isReady is False and searches of the release are to be run against Cosmos.
+    The vectors are normalized, so the dot product gives the same scores as the Cosmos 'dotproduct' distance function.
+
+    Attributes:
+        __indexes: dict[str,dict]: Maps release to its index ('chapters': chapter_number -> (etag, hscodes, vectors), 'hscodes', 'vectors', 'offsets': chapter_number -> (start row, end row), 'checked_at').
+        __backfilled: set[str]: releases whose every chapter (in the json store when it was checked) has a snapshot
+    """
+
+    __indexes: dict[str,dict] = {}
+    __locks: dict[str,threading.Lock] = {}
+    __locks_lock = threading.Lock()
+    __backfilled: set[str] = set()
+    __backfill_thread: threading.Thread = None
+
+    @classmethod
+    def saveChapterSnapshot(cls, hscodes: list[str], vectors: list[list[float]], chapterNumber: int, release_date: str) -> None:
+        """Persists the vectors of a chapter (one per HS code) as a snapshot blob, to be loaded by the local vector index of the release.
+
+        Args:
+            hscodes (list[str]): HS code of each vector
+            vectors (list[list[float]]): the (normalized) vector embeddings, in the same order as hscodes
+            chapterNumber (int): _description_
+            release_date (str): _description_
+        """
+        if len(hscodes) == 0: return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(hscodes), -1)
+        snapshot = BytesIO()
+        np.savez(snapshot, hscodes=np.asarray(hscodes, dtype=str), vectors=vectors)
+        snapshot.seek(0)
+        abo.upload_to_blob_from_stream(snapshot, config.vector_snapshot_container_name, f'{release_date}/{chapterNumber}.npz')
+        cls.__markStale(release_date)
+
+    @classmethod
+    def isReady(cls, release: str) -> bool:
+        """Returns whether every chapter of the release has a snapshot, so that the release can be searched with the local vector index (see startBackgroundBackfill)."""
+        return release in cls.__backfilled
+
+    @classmethod
+    def startBackgroundBackfill(cls) -> None:
+        """Starts a daemon thread that makes the missing snapshots of the chapters of every release in the json store, from their documents in Cosmos,
+        then checks for releases it has not done yet every config.local_vector_index_refresh_seconds. Calling it again does nothing.
+        """
+        with cls.__locks_lock:
+            if cls.__backfill_thread != None: return
+            def backfill():
+                while True:
+                    releases = {release_date for _, release_date in DataStores.getJson_dicts().keys()}
+                    for release in sorted(releases - cls.__backfilled):
+                        try:
+                            if cls.__backfillSnapshots(release): cls.__backfilled.add(release)
+                        except Exception as e: logging.error(f'Vector snapshots of release {release} could not be made from Cosmos: {e}')
+                    time.sleep(config.local_vector_index_refresh_seconds)
+            cls.__backfill_thread = threading.Thread(target=backfill, name='local-vector-index-backfill', daemon=True)
+            cls.__backfill_thread.start()
+        logging.info('Background backfill of the vector snapshots started')
+
+    @classmethod
+    def similarity_search_with_score(cls, queryEmbeddings: list[float], release: str, k: int = 4, filters: dict = None) -> list[tuple[str, float]]:
+        """Performs an exact similarity search against the local vector index of a release.
+
+        Args:
+            queryEmbeddings (list[float]): The embeddings of the user query (vector)
+            release (str): release whose index to search
+            k (int, optional): Top how much to return. Defaults to 4.
+            filters (dict, optional): Only {"Chapter Number": <int>} is supported, to search a single chapter. Defaults to None.
+
+        Raises:
+            ValueError: If filtering on any field other than "Chapter Number" is requested
+
+        Returns:
+            list[tuple[str, float]]: A list of (HS Codes, Similarity Score), most similar first
+        """
+        index = cls.__getIndex(release)
+        vectors: np.ndarray = index['vectors']
+        hscodes: np.ndarray = index['hscodes']
+        if filters:
+            if set(filters.keys()) != {'Chapter Number'}: raise ValueError(f'The local vector index can only be filtered by "Chapter Number", got: {list(filters.keys())}')
+            start, end = index['offsets'].get(int(filters['Chapter Number']), (0, 0))
+            vectors, hscodes = vectors[start:end], hscodes[start:end]
+        if vectors.shape[0] == 0 or k <= 0: return []
+
+        scores = vectors @ np.asarray(queryEmbeddings, dtype=np.float32)
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(str(hscodes[i]), float(scores[i])) for i in top]
+
+    @classmethod
+    def __getLock(cls, release: str) -> threading.Lock:
+        with cls.__locks_lock:
+            if release not in cls.__locks: cls.__locks[release] = threading.Lock()
+            return cls.__locks[release]
+
+    @classmethod
+    def __markStale(cls, release: str) -> None:
+        index = cls.__indexes.get(release)
+        if index != None: index['checked_at'] = 0
+
+    @classmethod
+    def __backfillSnapshots(cls, release: str) -> bool:
+        """Makes the missing snapshot of every chapter of the release that is in the json store but has no snapshot, from the documents of the chapter in Cosmos.
+
+        Args:
+            release (str): _description_
+
+        Returns:
+            bool: whether every such chapter now has a snapshot (False if any could not be made)
+        """
+        container_client = abo.get_container_client(config.vector_snapshot_container_name)
+        snapshotChapterNumbers = {int(blob.name.rsplit('/')[1].rsplit('.')[0]) for blob in container_client.list_blobs(name_starts_with=release + '/')}
+        missing = sorted(chapterNumber for chapterNumber, release_date in DataStores.getJson_dicts().keys() if release_date == release and chapterNumber not in snapshotChapterNumbers)
+        complete = True
+        for chapterNumber in missing:
+            query = 'SELECT c["HS Code"], c.embedding FROM c WHERE STARTSWITH(c["HS Code"], @prefix)' # documents uploaded before they carried Chapter Number are found too
+            parameters = [{"name": "@prefix", "value": f'{chapterNumber:02d}'}]
+            try:
+                items = [item for item in CosmosObjects.getCosmosContainer(release).query_items(query=query, parameters=parameters, enable_cross_partition_query=True) if item.get('embedding')]
+            except Exception as e:
+                logging.error(f'Vector snapshot of chapter {chapterNumber} of release {release} could not be made from Cosmos: {e}')
+                complete = False
+                continue
+            if len(items) == 0: continue # not (yet) in Cosmos
+            cls.saveChapterSnapshot([item['HS Code'] for item in items], [item['embedding'] for item in items], chapterNumber, release)
+            logging.info(f'Vector snapshot of chapter {chapterNumber} of release {release} made from {len(items)} Cosmos documents')
+        return complete
+
+    @classmethod
+    def __getIndex(cls, release: str) -> dict:
+        """Returns the index of a release, first bringing it up to date with the snapshot blobs if it was last checked more than config.local_vector_index_refresh_seconds ago.
+        Only snapshots whose ETag changed are downloaded again.
+        """
+        index = cls.__indexes.get(release)
+        if index != None and time.monotonic() - index['checked_at'] < config.local_vector_index_refresh_seconds: return index
+
+        with cls.__getLock(release):
+            index = cls.__indexes.get(release)
+            if index != None and time.monotonic() - index['checked_at'] < config.local_vector_index_refresh_seconds: return index # refreshed by another thread meanwhile
+
+            chapters: dict[int,tuple[str,np.ndarray,np.ndarray]] = dict(index['chapters']) if index != None else {}
+            container_client = abo.get_container_client(config.vector_snapshot_container_name)
+            listed: dict[int,tuple[str,str]] = {}
+            for blob in container_client.list_blobs(name_starts_with=release + '/'):
+                chapterNumber = int(blob.name.rsplit('/')[1].rsplit('.')[0])
+                listed[chapterNumber] = (blob.name, blob.etag)
+
+            changed = False
+            for chapterNumber in list(chapters.keys()):
+                if chapterNumber not in listed:
+                    del chapters[chapterNumber]; changed = True
+            for chapterNumber, (blobName, etag) in listed.items():
+                if chapterNumber in chapters and chapters[chapterNumber][0] == etag: continue
+                try: downloader = container_client.get_blob_client(blobName).download_blob()
+                except ResourceNotFoundError: # deleted after listing
+                    chapters.pop(chapterNumber, None); changed = True
+                    continue
+                snapshot = np.load(BytesIO(downloader.readall()), allow_pickle=False)
+                chapters[chapterNumber] = (downloader.properties.etag, snapshot['hscodes'], snapshot['vectors'].astype(np.float32, copy=False))
+                changed = True
+
+            if index == None or changed:
+                ordered = [chapters[chapterNumber] for chapterNumber in sorted(chapters.keys())]
+                dimensions = config.vector_embedding_policy['vectorEmbeddings'][0]['dimensions']
+                offsets: dict[int,tuple[int,int]] = {}
+                start = 0
+                for chapterNumber in sorted(chapters.keys()):
+                    offsets[chapterNumber] = (start, start + len(chapters[chapterNumber][1]))
+                    start = offsets[chapterNumber][1]
+                index = {
+                    'chapters': chapters,
+                    'offsets': offsets,
+                    'hscodes': np.concatenate([chapter[1] for chapter in ordered]) if ordered else np.empty(0, dtype=str),
+                    'vectors': np.ascontiguousarray(np.vstack([chapter[2] for chapter in ordered])) if ordered else np.empty((0, dimensions), dtype=np.float32),
+                }
+                logging.info(f'Local vector index of release {release} loaded: {index["vectors"].shape[0]} vectors from {len(chapters)} chapters')
+            index['checked_at'] = time.monotonic()
+            cls.__indexes[release] = index
+            return index
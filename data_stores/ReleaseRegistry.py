@@ -0,0 +1,125 @@
+import time
+import logging
+import threading
+from io import BytesIO
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError, ResourceExistsError, ResourceNotModifiedError
+
+import config
+from data_stores.AzureBlobObjects import AzureBlobObjects as abo
+
+class ReleaseRegistry:
+    """Singleton class holding the declared releases (config.release_holder_filename in config.release_holder_container_name, one release per line) in memory.
+    The file is downloaded on first use, and afterwards only if its ETag changed (checked in the background, see startBackgroundRefresh), so reading the releases needs no storage I/O.
+    Releases are added/removed with writes conditional on the ETag of the file they were computed from, so concurrent changes (from other workers/instances) are not lost.
+
+    Attributes:
+        __releases: list[str]: the declared releases, in the order of the file
+        __etag: str: ETag of the file the releases were read from (None if the file does not exist)
+    """
+
+    __releases: list[str] = []
+    __etag: str = None
+    __loaded = False
+    __lock = threading.Lock() # serializes reads and writes of the file by this process
+    __refresh_thread: threading.Thread = None
+
+    @staticmethod
+    def __parse(text: str) -> list[str]:
+        return text.rsplit('\n')[:-1] # last line is blank
+
+    @classmethod
+    def __getBlobClient(cls):
+        return abo.get_container_client(config.release_holder_container_name).get_blob_client(config.release_holder_filename)
+
+    @classmethod
+    def __read(cls) -> tuple[str,str]:
+        """Downloads the file. Returns its text and ETag ('' and None if it does not exist)."""
+        try: downloader = cls.__getBlobClient().download_blob(encoding='utf-8')
+        except ResourceNotFoundError: return '', None
+        return downloader.readall(), downloader.properties.etag
+
+    @classmethod
+    def __refresh(cls) -> None:
+        """Downloads the file again if its ETag changed since it was last read. Caller must hold __lock."""
+        if cls.__loaded and cls.__etag != None:
+            try: downloader = cls.__getBlobClient().download_blob(encoding='utf-8', etag=cls.__etag, match_condition=MatchConditions.IfModified)
+            except ResourceNotModifiedError: return
+            except ResourceNotFoundError: text, etag = '', None
+            else: text, etag = downloader.readall(), downloader.properties.etag
+        else: text, etag = cls.__read()
+        cls.__releases, cls.__etag, cls.__loaded = cls.__parse(text), etag, True
+
+    @classmethod
+    def __write(cls, change) -> None:
+        """Rewrites the file with change(text) -> new text (None if nothing needs to change), conditional on the file not having changed since it was read.
+        If it did change, the file is read again and the change re-applied to it.
+        """
+        with cls.__lock:
+            text, etag = cls.__read()
+            while True:
+                new_text = change(text)
+                if new_text == None:
+                    cls.__releases, cls.__etag, cls.__loaded = cls.__parse(text), etag, True
+                    return
+                try:
+                    if etag == None: properties = cls.__getBlobClient().upload_blob(BytesIO(new_text.encode('utf-8')), blob_type="BlockBlob", overwrite=False)
+                    else: properties = cls.__getBlobClient().upload_blob(BytesIO(new_text.encode('utf-8')), blob_type="BlockBlob", overwrite=True,
+                                                                          etag=etag, match_condition=MatchConditions.IfNotModified)
+                except (ResourceModifiedError, ResourceExistsError): # changed (or created) by someone else since it was read
+                    text, etag = cls.__read()
+                    continue
+                cls.__releases, cls.__etag, cls.__loaded = cls.__parse(new_text), properties['etag'], True
+                return
+
+    @classmethod
+    def getReleases(cls) -> list[str]:
+        """Returns the declared releases. The file is only downloaded the first time.
+
+        Returns:
+            list[str]: releases, in the order they were added
+        """
+        if not cls.__loaded:
+            with cls.__lock:
+                if not cls.__loaded: cls.__refresh()
+        return list(cls.__releases)
+
+    @classmethod
+    def addRelease(cls, release: str) -> None:
+        """Declares a release (nothing is done if it is already declared)."""
+        def add(text: str) -> str:
+            for existing_release in text.rsplit('\n'):
+                if existing_release.rstrip() == release.rstrip(): return None
+            return text + release + '\n'
+        cls.__write(add)
+
+    @classmethod
+    def removeRelease(cls, release: str) -> None:
+        """Removes a declared release (its first occurrence). Blank lines are dropped from the file."""
+        def remove(text: str) -> str:
+            existing_releases = cls.__parse(text)
+            for i in range(0,len(existing_releases)):
+                if release.strip() == existing_releases[i].strip():
+                    logging.info(f'Release {release} removed.')
+                    existing_releases.pop(i)
+                    break
+            return ''.join(each + '\n' for each in existing_releases if each.strip() != '')
+        cls.__write(remove)
+
+    @classmethod
+    def startBackgroundRefresh(cls) -> None:
+        """Starts a daemon thread that checks the file for changes (made through other workers/instances) every config.release_registry_refresh_seconds.
+        The file is only downloaded when its ETag changed. Calling it again does nothing.
+        """
+        with cls.__lock:
+            if cls.__refresh_thread != None: return
+            def refresh():
+                while True:
+                    time.sleep(config.release_registry_refresh_seconds)
+                    try:
+                        with cls.__lock: cls.__refresh()
+                    except Exception as e: logging.error(f'Background refresh of the declared releases failed: {e}')
+            cls.__refresh_thread = threading.Thread(target=refresh, name='release-registry-refresh', daemon=True)
+            cls.__refresh_thread.start()
+        logging.info(f'Background refresh of the declared releases started (every {config.release_registry_refresh_seconds} seconds)')
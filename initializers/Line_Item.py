@@ -1,8 +1,4 @@
 import numpy as np
-import config
-import os
-import concurrent.futures
-from data_stores.OpenAIObjects import OpenAIObjects
 
 class Line_Item:
     """An object to hold a line item that goes into the cosmos vectorstore.
@@ -13,7 +9,7 @@ class Line_Item:
 
     def __init__(self, fields_to_embed: dict, metadata_fields: dict) -> None:
         """Creates an object to hold a line item that goes into the cosmos vectorstore.
-        Be sure to called the vectorize method to generate the vector for the text.
+        Be sure to called the vectorize method (or batch_embedder.vectorizeLineItems for many line items) to generate the vector for the text.
 
         Args:
             fields_to_embed (dict): dictionary of fields that should be embedded (text fields - chapter name, hs heading, prefix and description).
@@ -26,19 +22,16 @@ class Line_Item:
     def vectorize(self):
         """Generates a single vector embedding for the text fields and stores it in the vector attribute.
         """
-        vectors = []
-        futures = []
-        client = OpenAIObjects.getOpenAIClient()
+        from initializers.batch_embedder import vectorizeLineItems
+        vectorizeLineItems([self])
 
-        def get_vector_for_fieldvalue(text):
-                vector = client.embeddings.create(input = text, model=config.embeddingModel).data[0].embedding
-                if len(vector) != 0: vectors.append(vector)
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for field,text in self.fields_to_embed.items():
-                futures.append(executor.submit(get_vector_for_fieldvalue, text))
-            concurrent.futures.wait(futures)
+    def setVectorFromFieldVectors(self, vectors: list[list[float]]):
+        """Combines the vector embeddings of the text fields into the single (normalized, mean) vector and stores it in the vector attribute.
 
+        Args:
+            vectors (list[list[float]]): vector embedding of each text field (fields that could not be embedded left out)
+        """
+        vectors = [vector for vector in vectors if len(vector) != 0]
         if len(vectors) == 0: 
              self.vector = []
              return
@@ -1,20 +1,20 @@
 # Contains functions used to interact with the Azure Cosmos Vectorstore.
 
-import concurrent.futures
 import uuid
-import os
 import datetime
 import logging
 import pickle
 
 from azure.core import exceptions
+from azure.cosmos.partition_key import NonePartitionKeyValue
 
 import config
-from other_funcs import getEmbeddings as emb
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
 from data_stores.AzureTableObjects import AzureTableObjects as ato
 from initializers.Line_Item import Line_Item
+from initializers import cosmos_bulk_writer
 from data_stores.CosmosObjects import CosmosObjects as co
+from data_stores.LocalVectorIndex import LocalVectorIndex
 
 
 def createVectorstoreUsingAzureCosmosNoSQL(documents: list[Line_Item], chapterNumber: int, mutexKey: str, release_date: str): 
@@ -27,8 +27,6 @@ def createVectorstoreUsingAzureCosmosNoSQL(documents: list[Line_Item], chapterNu
         mutexKey (str): _description_
         release_date (str): _description_
     """
-    vectorstore = getLangchainVectorstore(release_date) # get vectorstore object
-
     # get the current cosmos document IDs of the chapter we are attempting to upload
     cosmos_ids_filename = release_date + '/' + str(chapterNumber) + '.pkl'
     cosmos_ids_container_client = abo.get_container_client(config.cosmos_ids_container_name)
@@ -40,18 +38,11 @@ def createVectorstoreUsingAzureCosmosNoSQL(documents: list[Line_Item], chapterNu
         cosmosIDs: list = None
 
     # if required delete existing chapter uploads, to prevent duplicate entries in cosmos db
-    try:
-        ato.edit_chapter_record(chapterNumber, mutexKey, release_date, newRecordStatus=config.RecordStatus.deletingExistingCosmosDocs)
-        for cosmosID in cosmosIDs:
-            vectorstore.delete_document_by_id(cosmosID)
-            logging.info("Deleted cosmos ID: " + str(cosmosID))
+    ato.edit_chapter_record(chapterNumber, mutexKey, release_date, newRecordStatus=config.RecordStatus.deletingExistingCosmosDocs)
+    deleteChapterDocuments(chapterNumber, release_date, cosmosIDs)
+    if cosmosIDs != None:
         ato.edit_chapter_record(chapterNumber, mutexKey, release_date, newRecordStatus=config.RecordStatus.deletingExistingCosmosIDTracker)
         blob_client.delete_blob()
-    except TypeError as e:
-        pass
-        # this try catch block is redundant now as we don't allow any stage of a record to be overwritten now (instead we must delete that stage explicitly)
-        # therefore disabled the below logging.error
-        # logging.error("Retrieved existing cosmosIDs list is not an iterable object. Maybe this is the first time this chapter is been uploaded to cosmos. Chapter number: " + str(chapterNumber)+ 'Error: '+ str(e))
 
     
     # Add the new documents (line items) to the vector-store
@@ -59,95 +50,48 @@ def createVectorstoreUsingAzureCosmosNoSQL(documents: list[Line_Item], chapterNu
     ct = datetime.datetime.now()
     logging.log(25,f"Adding chapter {str(chapterNumber)} of release {release_date} to vectorstore. Begin time: {str(ct)}")
     logging.log(25,"Total number of line items to be added: " + str(len(documents)))
-    allIDs = []
-
-    container = co.getCosmosContainer(release_date)
-    futures = []
-
-    
-
-    def create_cosmos_item(final_dict_for_item):
-        """Helper function for createVectorstoreUsingAzureCosmosNoSQL parent function.
-        """
-        container.create_item(body=final_dict_for_item)
-        allIDs.append(final_dict_for_item['id'])
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for document in documents:
-            text_fields:dict = document.fields_to_embed
-            vector = document.vector
-            metadata = document.metadata_fields
-
-            vector_dict = {"embedding": vector}
-            id = str(uuid.uuid4())
-            final_dict_for_item = {"id": id}
+    cosmos_items = []
+    for document in documents:
+        text_fields:dict = document.fields_to_embed
+        vector = document.vector
+        metadata = document.metadata_fields
 
-            final_dict_for_item.update(text_fields); final_dict_for_item.update(metadata); final_dict_for_item.update(vector_dict)
+        vector_dict = {"embedding": vector}
+        id = str(uuid.uuid4())
+        final_dict_for_item = {"id": id}
+        # the chapter is the partition key, so a chapter can be queried and deleted without a cross-partition query
+        final_dict_for_item[config.cosmos_partition_key_path.lstrip('/')] = str(chapterNumber)
+        final_dict_for_item.update({"Release": release_date, "Chapter Number": chapterNumber})
 
-            futures.append(executor.submit(create_cosmos_item, final_dict_for_item))
+        final_dict_for_item.update(text_fields); final_dict_for_item.update(metadata); final_dict_for_item.update(vector_dict)
+        cosmos_items.append(final_dict_for_item)
 
-        concurrent.futures.wait(futures)
+    bulk_write_result = cosmos_bulk_writer.bulkCreateItems(release_date, cosmos_items)
+    allIDs = bulk_write_result['done_ids']
 
     # need to store the cosmos document IDs so we can delete them easily later when needed
     allIDs_bytes = pickle.dumps(allIDs)
     
     ato.edit_chapter_record(chapterNumber, mutexKey,release_date, newRecordStatus=config.RecordStatus.addingNewCosmosIdTracker)
     blob_client.upload_blob(allIDs_bytes, blob_type="BlockBlob")
+
+    # snapshot of the vectors of the documents created, loaded by the local vector index
+    if config.vectorstore == "local_numpy":
+        createdIDs = set(allIDs)
+        created = [item for item in cosmos_items if item['id'] in createdIDs and item['embedding']] # not the failed ones, nor line items with nothing to embed
+        try: LocalVectorIndex.saveChapterSnapshot([item['HS Code'] for item in created], [item['embedding'] for item in created], chapterNumber, release_date)
+        except Exception as e: logging.error(f'Vector snapshot of chapter {chapterNumber} of release {release_date} could not be saved, it is made from cosmos when the app is next started (see LocalVectorIndex.startBackgroundBackfill): {e}')
+    if bulk_write_result['failures']: # the documents that were created are tracked above, so deleting the chapter cleans them up
+        ato.edit_chapter_record(chapterNumber, mutexKey,release_date, newRecordStatus=config.RecordStatus.addingNewDocsToCosmosFailed)
+        ato.release_mutex(chapterNumber, mutexKey, release_date)
+        raise Exception(f"{len(bulk_write_result['failures'])} of {len(cosmos_items)} line items of chapter {chapterNumber} of release {release_date} could not be added to cosmos")
     ato.edit_chapter_record(chapterNumber, mutexKey,release_date, newRecordStatus='', newRecordState=config.RecordState.excelUploaded)
     ato.release_mutex(chapterNumber, mutexKey, release_date)
     
     ct = datetime.datetime.now()
     logging.info("Chapter "+ str(chapterNumber) + f" of release {release_date}" +" |||Adding items to cosmos end: - " + str(ct))
 
-def getLangchainVectorstore(release: str):
-    """Simply returns a langchain reference object to our Cosmos DB
-
-    Args:
-        release (str): (each release has its own vectorstore)
-
-    Returns:
-        _type_: _description_
-    """
-    embedding = emb.getEmbeddings.getEmbeddings()
-
-    # policy for vectorstore in cosmos
-    indexing_policy = config.indexing_policy
-
-    # policy for vectorstore in cosmos
-    vector_embedding_policy = config.vector_embedding_policy
-
-    from azure.cosmos import CosmosClient, PartitionKey, exceptions
-    from langchain_community.vectorstores.azure_cosmos_db_no_sql import (AzureCosmosDBNoSqlVectorSearch,)
-
-    HOST = os.environ["COSMOS_ENDPOINT"]
-    KEY = os.environ["COSMOS_KEY"]
-    cosmos_client = CosmosClient(HOST, KEY)
-    database_name = config.cosmosNoSQLDBName
-    container_name = release
-    partition_key = PartitionKey(path="/id")
-    cosmos_container_properties = {"partition_key": partition_key}
-    cosmos_database_properties = {"id": database_name}
-
-    
-
-    #create blank vectorstore (or get an already created one)
-    logging.info("Getting langchain vectorstore object.")
-    vectorstore = AzureCosmosDBNoSqlVectorSearch(
-        cosmos_client=cosmos_client,
-        database_name=database_name,
-        container_name=container_name,
-        vector_embedding_policy=vector_embedding_policy,
-        indexing_policy=indexing_policy,
-        cosmos_container_properties=cosmos_container_properties,
-        cosmos_database_properties=cosmos_database_properties,
-        embedding=embedding,
-    )
-    logging.info("Langchain vector store returned.")
-    return vectorstore
-
 def deleteChapterFromCosmos(chapterNumber: int, release_date: str):
-    vectorstore = getLangchainVectorstore(release_date)
-
     cosmos_ids_filename = release_date + '/' + str(chapterNumber) + '.pkl'
     cosmos_ids_container_client = abo.get_container_client(config.cosmos_ids_container_name)
     blob_client = cosmos_ids_container_client.get_blob_client(cosmos_ids_filename)
@@ -156,15 +100,39 @@ def deleteChapterFromCosmos(chapterNumber: int, release_date: str):
         cosmosIDs: list = pickle.loads(existing_cosmos_ids_pickle_stream.readall())
     except exceptions.ResourceNotFoundError:
         cosmosIDs: list = None
-        logging.error("Cannot find a cosmos IDs pickle for the provided chapter: " + str(chapterNumber) + f" of release {release_date}")
-        return
+        logging.info("Cannot find a cosmos IDs pickle for the provided chapter: " + str(chapterNumber) + f" of release {release_date}, deleting its documents by chapter number only")
 
-    # if required delete existing chapter uploads, to prevent duplicate entries in cosmos db
-    try:
-        for cosmosID in cosmosIDs:
-            vectorstore.delete_document_by_id(cosmosID)
-            logging.info("Deleted cosmos ID: " + str(cosmosID))
-        blob_client.delete_blob()
-    except TypeError as e:
-        logging.error("Retrieved existing cosmosIDs list is not an iterable object. Maybe this is the first time this chapter is been uploaded to cosmos. Chapter number: " + str(chapterNumber)+ f'release" {release_date}'+ 'Error: '+ str(e))
+    deleteChapterDocuments(chapterNumber, release_date, cosmosIDs)
+    if cosmosIDs != None: blob_client.delete_blob()
+
+def deleteChapterDocuments(chapterNumber: int, release_date: str, legacyCosmosIDs: list = None):
+    """Deletes every cosmos document of a chapter with a bulk delete (see cosmos_bulk_writer).
+    Documents are found with a query scoped to the chapter's partition (or, in a container partitioned some other way, a query on their "Chapter Number").
+    Documents uploaded before they carried their chapter are found through the given cosmos IDs (from the chapter's cosmos IDs pickle).
+
+    Args:
+        chapterNumber (int): _description_
+        release_date (str): _description_
+        legacyCosmosIDs (list, optional): cosmos IDs tracked for the chapter. Defaults to None.
+
+    Raises:
+        Exception: If some documents could not be deleted
+    """
+    container = co.getCosmosContainer(release_date)
+    partitionKeyField = co.getPartitionKeyPath(release_date).lstrip('/')
+    query = f'SELECT c.id, c["{partitionKeyField}"] AS partitionKey FROM c'
+    if co.isPartitionedByChapter(release_date):
+        items = container.query_items(query=query, partition_key=str(chapterNumber))
+    else:
+        items = container.query_items(query=query + ' WHERE c["Chapter Number"] = @chapterNumber', parameters=[{"name": "@chapterNumber", "value": chapterNumber}], enable_cross_partition_query=True)
+    idsAndPartitionKeys = {item['id']: item.get('partitionKey', NonePartitionKeyValue) for item in items}
+
+    for cosmosID in legacyCosmosIDs or []:
+        if cosmosID not in idsAndPartitionKeys: # legacy documents have no partition key value, unless it is their id
+            idsAndPartitionKeys[cosmosID] = cosmosID if partitionKeyField == 'id' else NonePartitionKeyValue
+
+    if len(idsAndPartitionKeys) == 0: return
+    result = cosmos_bulk_writer.bulkDeleteItems(release_date, list(idsAndPartitionKeys.items()))
+    if result['failures']:
+        raise Exception(f"{len(result['failures'])} of {len(idsAndPartitionKeys)} cosmos documents of chapter {chapterNumber} of release {release_date} could not be deleted")
 
@@ -0,0 +1,97 @@
+# Contains functions to get vector embeddings for many texts at once (eg: all the line items of a chapter), using multi-input requests to the embeddings API.
+
+import time
+import random
+import logging
+import threading
+import concurrent.futures
+
+import openai
+
+import config
+from data_stores.OpenAIObjects import OpenAIObjects
+from data_stores.EmbeddingCache import EmbeddingCache
+from other_funcs.tokenTracker import TokenTracker
+from initializers.Line_Item import Line_Item
+
+# shared by every ingestion job in the process, so concurrent jobs together never have more than this many embedding requests in flight
+__request_budget = threading.BoundedSemaphore(config.embedding_max_concurrent_requests)
+
+def vectorizeLineItems(line_items: list[Line_Item]) -> dict[str,int]:
+    """Generates the vector of every given Line_Item (see Line_Item.vectorize), embedding all their fields together in batched requests.
+
+    Args:
+        line_items (list[Line_Item]): _description_
+
+    Returns:
+        dict[str,int]: embedding cache statistics of this call, see embedTexts
+    """
+    texts = [text for line_item in line_items for text in line_item.fields_to_embed.values()]
+    vectorsByText, stats = embedTexts(texts)
+    for line_item in line_items:
+        line_item.setVectorFromFieldVectors([vectorsByText[text] for text in line_item.fields_to_embed.values() if text in vectorsByText])
+    return stats
+
+def embedTexts(texts: list[str]) -> tuple[dict[str,list[float]],dict[str,int]]:
+    """Gets the vector embeddings of the given texts. Each distinct text is looked up in the EmbeddingCache (document embeddings) first, 
+    and the rest are embedded once each, in requests of up to config.embedding_batch_max_inputs texts and config.embedding_batch_max_tokens tokens, 
+    sent concurrently within the process-wide request budget. New embeddings are added to the cache.
+    Empty texts cannot be embedded and are left out.
+
+    Args:
+        texts (list[str]): texts to embed (may contain duplicates)
+
+    Raises:
+        openai.RateLimitError: If a request is still throttled after config.embedding_max_retries retries
+
+    Returns:
+        tuple[dict[str,list[float]],dict[str,int]]: text -> vector embedding, statistics ('texts', 'distinct_texts', 'cache_hits', 'embedded', 'requests')
+    """
+    distinctTexts = [text for text in dict.fromkeys(texts) if text]
+    vectorsByText = EmbeddingCache.getDocumentEmbeddings(distinctTexts)
+    textsToEmbed = [text for text in distinctTexts if text not in vectorsByText]
+
+    batches: list[list[str]] = []
+    batch, batchTokens = [], 0
+    for text in textsToEmbed:
+        tokens = TokenTracker.getTokenCount(text)
+        if batch and (len(batch) >= config.embedding_batch_max_inputs or batchTokens + tokens > config.embedding_batch_max_tokens):
+            batches.append(batch)
+            batch, batchTokens = [], 0
+        batch.append(text)
+        batchTokens += tokens
+    if batch: batches.append(batch)
+
+    logging.info(f"Embedding {len(textsToEmbed)} texts in {len(batches)} requests ({len(texts)} texts, {len(distinctTexts)} distinct, {len(vectorsByText)} found in the embedding cache)")
+    newVectorsByText = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.embedding_max_concurrent_requests) as executor:
+        for batch, vectors in zip(batches, executor.map(__embedBatch, batches)):
+            newVectorsByText.update(zip(batch, vectors))
+    EmbeddingCache.putDocumentEmbeddings(newVectorsByText)
+    vectorsByText.update(newVectorsByText)
+
+    stats = {'texts': len(texts), 'distinct_texts': len(distinctTexts), 'cache_hits': len(distinctTexts) - len(textsToEmbed), 'embedded': len(textsToEmbed), 'requests': len(batches)}
+    return vectorsByText, stats
+
+def __embedBatch(batch: list[str]) -> list[list[float]]:
+    """Sends a single multi-input embeddings request, retrying with exponential backoff (or the wait the service asks for) when throttled.
+
+    Args:
+        batch (list[str]): texts to embed
+
+    Returns:
+        list[list[float]]: vectors, in the same order as batch
+    """
+    client = OpenAIObjects.getOpenAIClient().with_options(max_retries=0) # retries are done here, so they are counted against the shared budget
+    for attempt in range(config.embedding_max_retries + 1):
+        with __request_budget:
+            try:
+                response = client.embeddings.create(input=batch, model=config.embeddingModel)
+                return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == config.embedding_max_retries: raise
+                retryAfter = e.response.headers.get('retry-after') if isinstance(e, openai.APIStatusError) else None
+                try: wait = float(retryAfter)
+                except (TypeError, ValueError): wait = min(2 ** attempt, 60) * (0.5 + random.random())
+                logging.warning(f"Embedding request of {len(batch)} texts failed ({type(e).__name__}), retrying in {wait:.1f} s (attempt {attempt + 1} of {config.embedding_max_retries})")
+        time.sleep(wait) # outside the budget, so other requests can go ahead meanwhile
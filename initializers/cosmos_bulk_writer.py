@@ -0,0 +1,152 @@
+# Contains functions to write (or delete) many documents in a Cosmos container as fast as its provisioned throughput (RUs) allows.
+
+import time
+import logging
+import threading
+import concurrent.futures
+
+from azure.cosmos import exceptions as AzureCosmosExceptions
+
+import config
+from data_stores.CosmosObjects import CosmosObjects
+
+class AdaptiveConcurrencyLimit:
+    """Limits the number of requests in flight, adapting the limit the way TCP congestion control does (additive increase, multiplicative decrease):
+    each successful request raises the limit by 1/limit (about +1 per round of requests), and a throttled (429) request halves it
+    and pauses every request for the retry-after time Cosmos asked for. Requests throttled during a pause do not halve the limit again.
+    """
+
+    def __init__(self, initial: int, maximum: int) -> None:
+        self.__limit = float(initial)
+        self.__maximum = maximum
+        self.__inFlight = 0
+        self.__pausedUntil = 0.0
+        self.__condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self.__limit)
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self.__condition:
+            while True:
+                pause = self.__pausedUntil - time.monotonic()
+                if pause > 0: self.__condition.wait(pause)
+                elif self.__inFlight < int(self.__limit): break
+                else: self.__condition.wait()
+            self.__inFlight += 1
+
+    def release(self, retryAfterSeconds: float = None):
+        """Records the end of a request.
+
+        Args:
+            retryAfterSeconds (float, optional): Given if the request was throttled, the wait Cosmos asked for. Defaults to None.
+        """
+        with self.__condition:
+            self.__inFlight -= 1
+            if retryAfterSeconds == None:
+                self.__limit = min(self.__maximum, self.__limit + 1 / self.__limit)
+            else:
+                now = time.monotonic()
+                if now >= self.__pausedUntil: self.__limit = max(1.0, self.__limit / 2)
+                self.__pausedUntil = max(self.__pausedUntil, now + retryAfterSeconds)
+            self.__condition.notify_all()
+
+
+def bulkCreateItems(release: str, items: list[dict]) -> dict:
+    """Creates the given documents in the Cosmos container of a release, with at most config.cosmos_bulk_max_concurrency requests in flight,
+    adapting to throttling (see AdaptiveConcurrencyLimit). A throttled document is retried up to config.cosmos_bulk_max_retries times,
+    other failures are not retried but reported.
+
+    Args:
+        release (str): release whose container to write to
+        items (list[dict]): documents (each with an 'id')
+
+    Returns:
+        dict: 'done_ids' (list[str]: ids of the created documents), 'failures' (list[tuple[str,str]]: id, error), 'throttled' (number of 429 responses),
+        'request_charge' (total RUs), 'seconds', 'items_per_second', 'ru_per_second', 'final_concurrency'
+    """
+    def create_item(container, id: str, item: dict, response_hook):
+        container.create_item(body=item, response_hook=response_hook)
+
+    return __runBulk(release, [(item['id'], item) for item in items], create_item, 'created')
+
+def bulkDeleteItems(release: str, idsAndPartitionKeys: list[tuple[str,object]]) -> dict:
+    """Deletes the given documents from the Cosmos container of a release, the same way bulkCreateItems creates them. Documents that do not exist count as deleted.
+
+    Args:
+        release (str): release whose container to delete from
+        idsAndPartitionKeys (list[tuple[str,object]]): (id, partition key value) of each document
+
+    Returns:
+        dict: same as bulkCreateItems ('done_ids' being the ids of the deleted documents)
+    """
+    def delete_item(container, id: str, partitionKey, response_hook):
+        try: container.delete_item(item=id, partition_key=partitionKey, response_hook=response_hook)
+        except AzureCosmosExceptions.CosmosResourceNotFoundError: pass
+
+    return __runBulk(release, idsAndPartitionKeys, delete_item, 'deleted')
+
+def __runBulk(release: str, operations: list[tuple[str,object]], operation, description: str) -> dict:
+    """Runs operation(container, id, argument, response_hook) for each (id, argument) in operations, with adaptive concurrency (see bulkCreateItems).
+    """
+    CosmosObjects.getCosmosContainer(release) # makes sure the container exists
+    container = CosmosObjects.getCosmosContainerForBulkWrites(release)
+    limit = AdaptiveConcurrencyLimit(config.cosmos_bulk_initial_concurrency, config.cosmos_bulk_max_concurrency)
+
+    def run_operation(idAndArgument: tuple[str,object]) -> tuple[float,str,int]:
+        """Helper function. Returns request charge, error (None if done), number of times throttled.
+        """
+        id, argument = idAndArgument
+        throttled = 0
+        requestCharge = 0.0
+        def record_request_charge(headers: dict, result):
+            nonlocal requestCharge
+            requestCharge = float(headers.get('x-ms-request-charge', 0))
+
+        while True:
+            limit.acquire()
+            try:
+                operation(container, id, argument, record_request_charge)
+            except AzureCosmosExceptions.CosmosHttpResponseError as e:
+                if e.status_code == 429 and throttled < config.cosmos_bulk_max_retries:
+                    throttled += 1
+                    retryAfterMs = (e.headers or {}).get('x-ms-retry-after-ms', 1000)
+                    limit.release(float(retryAfterMs) / 1000)
+                    continue
+                limit.release()
+                return 0.0, e.message, throttled
+            except Exception as e:
+                limit.release()
+                return 0.0, str(e), throttled
+            limit.release()
+            return requestCharge, None, throttled
+
+    doneIDs, failures = [], []
+    requestCharge, throttled = 0.0, 0
+    startTime = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.cosmos_bulk_max_concurrency) as executor:
+        for (id, _), (charge, error, timesThrottled) in zip(operations, executor.map(run_operation, operations)):
+            requestCharge += charge
+            throttled += timesThrottled
+            if error == None: doneIDs.append(id)
+            else: failures.append((id, error))
+    seconds = time.perf_counter() - startTime
+
+    for id, error in failures:
+        logging.error(f"Cosmos document {id} could not be {description} in container {release}: {error}")
+    metrics = {
+        'done_ids': doneIDs,
+        'failures': failures,
+        'throttled': throttled,
+        'request_charge': requestCharge,
+        'seconds': seconds,
+        'items_per_second': len(doneIDs) / seconds if seconds > 0 else 0.0,
+        'ru_per_second': requestCharge / seconds if seconds > 0 else 0.0,
+        'final_concurrency': limit.limit,
+    }
+    logging.log(25, f"Bulk operation on cosmos container {release}: {len(doneIDs)} of {len(operations)} documents {description} in {seconds:.1f} s "
+                f"({metrics['items_per_second']:.1f} items/s, {metrics['ru_per_second']:.0f} RU/s, {requestCharge:.0f} RUs), "
+                f"{throttled} throttled requests, {len(failures)} failures, final concurrency {limit.limit}")
+    return metrics
@@ -3,12 +3,12 @@
 from dotenv import load_dotenv, find_dotenv
 _ = load_dotenv(find_dotenv()) # read local .env file
 import logging
-import concurrent.futures
 from datetime import datetime
 
 import config
 from data_stores.DataStores import DataStores
 from initializers.Line_Item import Line_Item
+from initializers import batch_embedder
 
 
 def update_vectorstore(chapterNumber: int, mutexKey: str, release_date: str):
@@ -45,9 +45,7 @@ def update_vectorstore(chapterNumber: int, mutexKey: str, release_date: str):
         items = json_dict["Items"]
         chapterName = json_dict["Chapter Name"]
 
-        def create_line_item(item):
-            """Helper function.
-            """
+        for item in items:
             prefix: str = item["Prefix"]
             hsHeadingName = item["HS Hdg Name"]
             hscode = item["HS Code"]
@@ -73,15 +71,12 @@ def update_vectorstore(chapterNumber: int, mutexKey: str, release_date: str):
                 "HS Code": hscode
             }
             line_item = Line_Item(fields_to_embed, metadata_fields)
-            line_item.vectorize()
             docs.append(line_item)
-            # print(f'Ended creating line item for hscode {hscode} at time {datetime.now()}')
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for item in items:
-                futures.append(executor.submit(create_line_item, item))
-            concurrent.futures.wait(futures)
+    # the vectors of all line items are generated together, so their texts can be sent in batched requests
+    stats = batch_embedder.vectorizeLineItems(docs)
+    hitRate = stats['cache_hits'] / stats['distinct_texts'] if stats['distinct_texts'] else 0
+    logging.log(25, f"Embedding cache hit rate for chapter {chapterNumber} of release {release_date}: {hitRate:.0%} ({stats['cache_hits']} of {stats['distinct_texts']} distinct texts, {stats['embedded']} embedded in {stats['requests']} requests)")
             
     logging.info(f"END creating Line Item objects from json chapter(s)...Chapter number:{chapterNumber}, release {release_date}... {datetime.now()}")
     # ......................................... #
@@ -92,7 +87,7 @@ def update_vectorstore(chapterNumber: int, mutexKey: str, release_date: str):
     if config.vectorstore == "chroma":
         import initializers.chroma_vectorstore as chr
         chr.createVectorstoreUsingChroma(docs)
-    elif config.vectorstore == "azure_cosmos_nosql":
+    elif config.vectorstore in ("azure_cosmos_nosql", "local_numpy"):
         import initializers.az_cosmos_nosql_vectorstore as azcn
         azcn.createVectorstoreUsingAzureCosmosNoSQL(docs, chapterNumber, mutexKey, release_date)
     else:
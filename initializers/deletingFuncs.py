@@ -5,6 +5,7 @@ from azure.core.exceptions import ResourceNotFoundError
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
 import config
 from data_stores.DataStores import DataStores as ds
+from data_stores.FileCatalog import FileCatalog
 
 def __deleteChapterBlob(chapterNumber: int, file_extension: str, container_name: str, release_date: str):
     """From the given args, we can construct the filename and know from what container it should be deleted."""
@@ -14,6 +15,7 @@ def __deleteChapterBlob(chapterNumber: int, file_extension: str, container_name:
     try: blob_client.delete_blob()
     except ResourceNotFoundError:
         logging.error(f'Blob to be deleted not found. Perhaps it was already deleted or never existed. chapterNumber: {chapterNumber}, release: {release_date}, file_extension:{file_extension}, container_name:{container_name}')
+    FileCatalog.blobDeleted(container_name, filename)
 
 def deleteChapterJsonBlob(chapterNumber: int, release_date: str):
     __deleteChapterBlob(chapterNumber, 'json', config.json_container_name, release_date)
@@ -31,6 +33,9 @@ def deleteChapterGeneratedExcelBlob(chapterNumber: int, release_date: str):
 def deleteChapterPDFBlob(chapterNumber: int, release_date: str):
     __deleteChapterBlob(chapterNumber, 'pdf', config.pdf_container_name, release_date)
 
+def deleteChapterVectorSnapshotBlob(chapterNumber: int, release_date: str):
+    __deleteChapterBlob(chapterNumber, 'npz', config.vector_snapshot_container_name, release_date)
+
 from initializers.az_cosmos_nosql_vectorstore import deleteChapterFromCosmos as __deleteChapterFromCosmos
 def deleteChapterFromCosmos(chapterNumber: int, release_date: str):
     __deleteChapterFromCosmos(chapterNumber, release_date)
\ No newline at end of file
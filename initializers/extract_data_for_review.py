@@ -3,28 +3,64 @@
 
 from io import BytesIO
 import logging
+import logging.handlers
 import pickle
+import time
+import threading
+import multiprocessing
+import concurrent.futures
 
 import pdfplumber
 import pandas as pd
+import numpy as np
+
+import config
+
+__extraction_pool: concurrent.futures.ProcessPoolExecutor = None
+__extraction_pool_lock = threading.Lock()
+__extraction_log_listener: logging.handlers.QueueListener = None
 
 
 def __removeNewLineCharactersFromDataframe(dataframe):
-    """Removes new line character ('\n') from the dataframe. Done in place. Returns void.
+    """Removes new line character ('\n') from the dataframe. Done in place (a column at a time). Returns void.
     """
-    numOfRows = dataframe.shape[0]
-    numOfCols = dataframe.shape[1]
-    for r in range(0,numOfRows):
-        for c in range(0,numOfCols):
-            if dataframe.iloc[r,c] == None: continue
-            dataframe.iloc[r,c] = dataframe.iloc[r,c].replace('\n',' ')
+    for column in dataframe.columns:
+        dataframe[column] = dataframe[column].str.replace('\n',' ',regex=False) # empty cells (None) are left as they are
     
-def __isSeriesALineItem(series, numOfColumns) -> bool:
-    """Checks if a dataframe row (i.e. a series), qualifies as a line item (i.e. has values from the unit column onwards)"""
-    for col in range(4,numOfColumns):
-        value = series.iloc[col]
-        if not __isEmpty(value): return True
-    return False
+def __isEmptyArray(values: np.ndarray) -> np.ndarray:
+    """Returns, for each cell value of the array, whether it is empty ('' or None)"""
+    return (values == None) | (values == "")
+
+def __classifyRows(dataframe: pd.DataFrame) -> np.ndarray:
+    """Classifies each row of the table extracted from the PDF as 'empty', 'prefix', 'just HS heading', 'line item' or 'hscode error' (line item with an HS code of unknown format).
+    Only rows with values from the unit column onwards are considered line items. Done with boolean masks over whole columns.
+
+    Args:
+        dataframe (pd.DataFrame): table extracted from the PDF (new line characters removed)
+
+    Returns:
+        np.ndarray: classification of each row
+    """
+    headerNumber = __getDataframeHeadernameToColumnNumberMapping()
+    if dataframe.shape[0] == 0: return np.array([], dtype=object)
+    values = dataframe.to_numpy(dtype=object)
+
+    hshdg = values[:, headerNumber['HS Hdg']]
+    hscode = values[:, headerNumber['HS Code']]
+    description = values[:, headerNumber['Description']]
+    hshdgIsEmpty = __isEmptyArray(hshdg)
+    isLineItem = ~__isEmptyArray(values[:, 4:]).all(axis=1) # has values from the unit column onwards
+
+    isEmptyRow = __isEmptyArray(description) | (hshdg == "HS Hdg")
+    # a line item without an HS code takes the HS Hdg no. as its HS code
+    effectiveHSCode = np.where(__isEmptyArray(hscode) & ~hshdgIsEmpty, hshdg, np.where(__isEmptyArray(hscode), '', hscode))
+    hscodeIsValid = pd.Series(effectiveHSCode).str.len().isin([5,7,10]).to_numpy() # the formats __standardizeHSCode accepts
+
+    return np.select(
+        [isEmptyRow, hshdgIsEmpty & ~isLineItem, ~hshdgIsEmpty & ~isLineItem, ~hscodeIsValid],
+        ['empty', 'prefix', 'just HS heading', 'hscode error'],
+        default='line item'
+    ).astype(object)
 
 def __getDataframeHeadernameToColumnNumberMapping() -> dict[str,int]:
     """Returns a dictionary mapping an easy to use column name for the dataframe, with its corresponsing column number.
@@ -57,13 +93,6 @@ def __getDataframeHeadernameToColumnNumberMapping() -> dict[str,int]:
     values = list(range(0,25))
     return dict(zip(keys, values))
 
-def __isEmpty(string) -> bool:
-    """ Returns true if the given string is '' or None
-    """
-    if string == "" or string == None:
-        return True
-    return False
-
 def __standardizeHSCode(hscode: str) -> str:
     """ Changes hscodes of the various known formats into a standardized format '####.##.##N'
 
@@ -85,15 +114,109 @@ def __standardizeHSCode(hscode: str) -> str:
         raise ValueError("HS Code of unknown format passed in: {}".format(hscode))
     return hscode
 
-def __extractTableAndTextFromPDF(file: BytesIO) -> tuple[pd.DataFrame,list[str]]:
+def __extractPageRange(pdfBytes: bytes, firstPage: int, endPage: int) -> list[dict]:
+    """Extracts the table rows and text of a range of pages of the PDF. Module level so that it can run in a worker process (see __extractPages).
+
+    Text is only extracted where the strict extraction could use it, i.e. until the first page in the range that has a table (the text above that table),
+    since all required text comes before the table in the document structure.
+
+    Args:
+        pdfBytes (bytes): the PDF file
+        firstPage (int): index of the first page of the range
+        endPage (int): index of the page after the last page of the range
+
+    Returns:
+        list[dict]: one per page - 'rows' (rows of the page's table as-is, None if no table found on the page), 'text' (text of the whole page if it has no table,
+        else the text above the table, None where not extracted), 'firstPageText' (text of the whole first page of the PDF, None for other pages)
+    """
+    pageResults = []
+    tableReached = False
+    with pdfplumber.open(BytesIO(pdfBytes)) as pdf:
+        for pageIndex in range(firstPage, endPage):
+            page = pdf.pages[pageIndex]
+            tableInPage = page.find_table()
+            rowsPerPage = tableInPage.extract() if tableInPage != None else None # same as page.extract_table(), without finding the table again
+            text = None
+            if not tableReached:
+                if tableInPage == None: # if no table found, extract text from whole page
+                    text = page.extract_text()
+                else: # else extract text from the part above the table
+                    tableTop = tableInPage.bbox[1] # top value is 2nd value of bounding box tuple
+                    text = page.within_bbox((0,0,page.width,tableTop)).extract_text() # bounding box tuple order: left, top, right, bottom
+                    tableReached = True
+            firstPageText = None
+            if pageIndex == 0: firstPageText = text if tableInPage == None else page.extract_text()
+            pageResults.append({'rows': rowsPerPage, 'text': text, 'firstPageText': firstPageText})
+            page.close() # frees the page's cached objects, pages are not revisited
+    return pageResults
+
+class __LogRecordForwarder(logging.Handler):
+    """Hands log records received from the extraction worker processes to the logger of the same name in this process (and so to the app's log handlers)."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+def __initExtractionWorker(logQueue) -> None:
+    """Runs in each extraction worker process when it starts: sends the process's log records to the web app process through logQueue."""
+    rootLogger = logging.getLogger()
+    rootLogger.handlers = [logging.handlers.QueueHandler(logQueue)]
+    rootLogger.setLevel(logging.INFO)
+
+def __getExtractionPool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process pool PDF pages are extracted in (created on first use, shared by all extractions of the process).
+    Worker processes are spawned rather than forked, since the web app process has other threads running. Their log records are forwarded to this process.
+    """
+    global __extraction_pool, __extraction_log_listener
+    with __extraction_pool_lock:
+        if __extraction_pool == None:
+            context = multiprocessing.get_context('spawn')
+            logQueue = context.Queue()
+            __extraction_log_listener = logging.handlers.QueueListener(logQueue, __LogRecordForwarder())
+            __extraction_log_listener.start()
+            __extraction_pool = concurrent.futures.ProcessPoolExecutor(max_workers=config.pdf_extraction_workers, mp_context=context,
+                                                                       initializer=__initExtractionWorker, initargs=(logQueue,))
+        return __extraction_pool
+
+def __extractPages(file: BytesIO) -> list[dict]:
+    """Extracts the table rows and text of every page of the PDF (see __extractPageRange). pdfplumber is CPU bound, so the pages are split into one contiguous range
+    per process of a pool of config.pdf_extraction_workers processes (ranges of at least config.pdf_extraction_min_pages_per_worker pages), extracted in parallel.
+    Each worker is sent the PDF and parses it once. Small PDFs (a single range) are extracted in this process.
+
+    Args:
+        file (BytesIO): the PDF file
+
+    Returns:
+        list[dict]: one per page, in page order
+    """
+    pdfBytes = file.getvalue()
+    with pdfplumber.open(BytesIO(pdfBytes)) as pdf:
+        numOfPages = len(pdf.pages)
+
+    numOfRanges = max(1, min(config.pdf_extraction_workers, numOfPages // max(1, config.pdf_extraction_min_pages_per_worker)))
+    pageRanges = [(numOfPages * i // numOfRanges, numOfPages * (i + 1) // numOfRanges) for i in range(numOfRanges)]
+    startTime = time.perf_counter()
+    if len(pageRanges) <= 1 or config.pdf_extraction_workers <= 1:
+        resultsPerRange = [__extractPageRange(pdfBytes, first, end) for first, end in pageRanges]
+    else:
+        pool = __getExtractionPool()
+        futures = [pool.submit(__extractPageRange, pdfBytes, first, end) for first, end in pageRanges]
+        resultsPerRange = [future.result() for future in futures] # in page order
+    logging.info(f"Extracted {numOfPages} PDF pages in {len(pageRanges)} ranges in {time.perf_counter() - startTime:.2f} s")
+
+    return [pageResult for rangeResults in resultsPerRange for pageResult in rangeResults]
+
+def __extractTableAndTextFromPDF(pages: list[dict]) -> tuple[pd.DataFrame,list[str]]:
     """Extracts the table from the tariff PDF and the text that comes before the table.
 
-    Uses pdf plumber to extract the data from the pdfs
+    Uses the pdf plumber results of each page (see __extractPages)
     All the text that comes before the table are saved in the allText array (one item is a page)
     The table is converted into a pandas dataframe (as-is, not processed to remove empty rows, etc.)
 
     Args:
-        file (BytesIO): the PDF file
+        pages (list[dict]): extraction results of the pages of the PDF
+
+    Raises:
+        Exception: If a page after the start of the table has no table
 
     Returns:
         tuple[pd.DataFrame,list[str]]: table as pandas dataframe, text (one item is a page)
@@ -102,77 +225,53 @@ def __extractTableAndTextFromPDF(file: BytesIO) -> tuple[pd.DataFrame,list[str]]
     rows = []
     tableReached = False
 
-    pdf = pdfplumber.open(file)
-
-    for page in pdf.pages:
+    for pageNumber, page in enumerate(pages, start=1):
         if tableReached: # if table has already been reached, continue to extract table, no need to find more text due to the document structure having all required text before the table
-            rowsPerPage = page.extract_table()
-            for row in rowsPerPage:
-                rows.append(row)
+            if page['rows'] == None: raise Exception(f'No table found on page {pageNumber}, after the table started')
+            rows.extend(page['rows'])
             continue
 
-        tableInPage = page.find_table()
-        if tableInPage == None: # if no table found, extract text from whole page
-            textPerPage = page.extract_text()
-            allText.append(textPerPage)
-        else: # else extract text from the part above the table, and start extracting the table
-            tableBBox = tableInPage.bbox
-            tableTop = tableBBox[1] # top value is 2nd value of bounding box tuple
-            croppedPage = page.within_bbox((0,0,page.width,tableTop)) # bounding box tuple order: left, top, right, bottom
-            textPerPage = croppedPage.extract_text()
-            allText.append(textPerPage)
+        allText.append(page['text'])
+        if page['rows'] != None: # the table starts on this page
             tableReached = True
-            rowsPerPage = page.extract_table()
-            for row in rowsPerPage:
-                rows.append(row)
-
-    pdf.close()
+            rows.extend(page['rows'])
 
-    
     df = pd.DataFrame(rows)
 
     return df, allText
 
-def __extractTableAndTextFromPDFNonStrictly(file: BytesIO):
+def __extractTableAndTextFromPDFNonStrictly(pages: list[dict]):
     """Extracts the table from the tariff PDF and text on the first page.
 
-    Uses pdf plumber to extract the data from the pdfs
+    Uses the pdf plumber results of each page (see __extractPages)
     The text of the first page is saved in the allText array (one item is a page)
     The table is converted into a pandas dataframe (as-is, not processed to remove empty rows, etc.)
 
     Args:
-        file (BytesIO): the PDF file
+        pages (list[dict]): extraction results of the pages of the PDF
 
     Returns:
         tuple[pd.DataFrame,list[str]]: table as pandas dataframe, text (one item is a page)
     """
 
-    allText = []
+    allText = [pages[0]['firstPageText']]
     rows = []
 
-    pdf = pdfplumber.open(file)
-
-    allText.append(pdf.pages[0].extract_text())
-
-    for page in pdf.pages:
-        rowsPerPage = page.extract_table()
-        if rowsPerPage == None: continue
-        for row in rowsPerPage:
-            rows.append(row)
-
-    pdf.close()
+    for page in pages:
+        if page['rows'] == None: continue
+        rows.extend(page['rows'])
 
     df = pd.DataFrame(rows)
 
     return df, allText
 
-def __get_excel_and_dictionary_from_pdf(file: BytesIO, userEnteredChapterNumber: int = None, filename: str = None, strict=True) -> tuple[BytesIO,BytesIO,int]:
+def __get_excel_and_dictionary_from_pdf(pages: list[dict], userEnteredChapterNumber: int = None, filename: str = None, strict=True) -> tuple[BytesIO,BytesIO,int]:
     """Data is ripped from the PDF to excel (and a dictionary), so that user will eventually review the excel.
 
     The text and other data (basically data other than the table), are saved to a dictionary as a pickle binary.
     The table which is extracted as a pandas dataframe is extracted in the form of an excel file, for easy reviewing and editing.
     Args:
-        file (BytesIO): the pdf file
+        pages (list[dict]): extraction results of the pages of the pdf (see __extractPages)
         userEnteredChapterNumber (int, optional): If availalbe, used to verify is this matches the chapter number in the PDF. Defaults to None.
         filename (str, optional): If available, used to handle cases where the chapter number extraction of the PDF must be hardcoded due to issues in the PDF. Defaults to None.
         strict (bool, optional): whether to use strict extraction. If strict is not used, parts of the first bit of the table in the pdf may end up in the pre-table-notes section of the dictionary.. Defaults to True.
@@ -183,12 +282,10 @@ def __get_excel_and_dictionary_from_pdf(file: BytesIO, userEnteredChapterNumber:
     Returns:
         tuple[BytesIO,BytesIO,int]: dictionary pickle, excel, chapter number
     """   
-    headerNumber = __getDataframeHeadernameToColumnNumberMapping()
-
     if strict:
-        df, allText = __extractTableAndTextFromPDF(file)
+        df, allText = __extractTableAndTextFromPDF(pages)
     else:
-        df, allText = __extractTableAndTextFromPDFNonStrictly(file) 
+        df, allText = __extractTableAndTextFromPDFNonStrictly(pages) 
     __removeNewLineCharactersFromDataframe(df)
     # isolate chapter number and name from the PDF text
     # ......................................... #
@@ -218,8 +315,6 @@ def __get_excel_and_dictionary_from_pdf(file: BytesIO, userEnteredChapterNumber:
         logging.error(f'Process of validating column header schema failed. Please check it manually. Chapter {chapterNumber}. Excel has been generated as normal.')
         logging.log(25,f'Process of validating column header schema failed. Please check it manually. Chapter {chapterNumber} Excel has been generated as normal.')
     
-    df['LineItem?'] = None  
-   
     # create a dictionary for creating a json for the whole pdf
     # ......................................... #
     dictionaryForThisPDF = dict.fromkeys(["Chapter Number", "Chapter Name", "Pre-Table Notes", "Items"])
@@ -236,53 +331,8 @@ def __get_excel_and_dictionary_from_pdf(file: BytesIO, userEnteredChapterNumber:
     dictionary_stream.seek(0)
     # ......................................... #
 
-    
-    # extract line items with HS codes from the table, only rows with a valid unit are considered to be a valid line item
-    # ......................................... #
-    ongoing_prefix = ""
-    numOfColumns = df.shape[1]
-    
-    numOfRows = df.shape[0] # rows
-    # only a row with a non-null unit will be considered a valid item
-    for n in range(0,numOfRows): # starting from 3 because 0-2 are just table headers all over the place
-        current_series = df.loc[n]
-        current_hshdg = current_series.values[headerNumber['HS Hdg']]; 
-        if current_hshdg == None: current_hshdg = ''
-        current_hscode = current_series.values[headerNumber['HS Code']]
-        if current_hscode == None: current_hscode = ''
-        current_description = current_series.values[headerNumber['Description']]
-        if current_description == None: current_description = ''
-
-        if __isEmpty(current_description) or (current_hshdg == "HS Hdg"): # row is considered empty
-            df.loc[n, 'LineItem?'] = 'empty'
-            continue
-        if __isEmpty(current_hshdg) and not __isSeriesALineItem(current_series, numOfColumns): # description considered a prefix
-            df.loc[n, 'LineItem?'] = 'prefix'
-            ongoing_prefix = current_description
-            continue
-        if (not __isEmpty(current_hshdg)) and not __isSeriesALineItem(current_series, numOfColumns): # row has a HS Hdg no. but no HS code no.
-            df.loc[n, 'LineItem?'] = 'just HS heading'
-            ongoing_prefix = "" # reset on-going prefix since we have moved to a new hs hdg
-            if not __isSeriesALineItem(current_series, numOfColumns): # not an item
-                continue
-            else:
-                current_hscode = current_hshdg # the hs.hdg is assigned to the hscode
-        if (not __isEmpty(current_hshdg)) and __isSeriesALineItem(current_series, numOfColumns) and __isEmpty(current_hscode):
-            current_hscode = current_hshdg
-        if __isSeriesALineItem(current_series, numOfColumns): # this is a valid item
-            # create a json item
-            df.loc[n, 'LineItem?'] = 'line item'
-            try: __standardizeHSCode(current_hscode)
-            except Exception as e: 
-                df.loc[n, 'LineItem?'] = 'hscode error'
-                # logging.error("Exception occured at Hs hdg: " + current_hshdg + " current description: " + current_description + " prefix: " + ongoing_prefix)
-                # logging.error(type(e))
-                # logging.error(e)
-
-            #if description contains "other", reset prefix
-            current_description_uppercase = current_description.upper()
-            if "OTHER" in current_description_uppercase:
-                ongoing_prefix = "" # reset on-going prefix since we have reached "other" description
+    # classify the rows of the table for the reviewer, only rows with a valid unit are considered to be a valid line item
+    df['LineItem?'] = __classifyRows(df)
     excel_stream = BytesIO()
     df.to_excel(excel_stream, engine='openpyxl')
     excel_stream.seek(0)
@@ -300,10 +350,14 @@ def convertPDFToExcelForReview(file: BytesIO, userEnteredChapterNumber: int = No
         tuple[BytesIO,BytesIO,int]: dictionary pickle, excel, chapter number
     """
     results = None
-    try: results = __get_excel_and_dictionary_from_pdf(file, userEnteredChapterNumber, filename)
+    try: pages = __extractPages(file) # done once, both the strict and non-strict extraction use these results
+    except Exception as e:
+        logging.error("Error reading pdf " + str(filename) + " Error: " + str(type(e)) + ": " + str(e))
+        return None,None,None
+    try: results = __get_excel_and_dictionary_from_pdf(pages, userEnteredChapterNumber, filename)
     except Exception as e:
         logging.warning("Error processing file " + filename + " Error: " + str(type(e)) + ": " + str(e) + '\nWill try using non-strict extraction')
-        try: results = __get_excel_and_dictionary_from_pdf(file,userEnteredChapterNumber,filename, strict=False)
+        try: results = __get_excel_and_dictionary_from_pdf(pages,userEnteredChapterNumber,filename, strict=False)
         except Exception as e:
             logging.error("Error processing file non-strictly " + filename + " Error: " + str(type(e)) + ": " + str(e))
             return None,None,None
@@ -6,8 +6,12 @@ import pickle
 from io import BytesIO
 
 import pandas as pd
+import numpy as np
+import openpyxl as oxl
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
 
 from data_stores.DataStores import DataStores
+from data_stores.HSCodeToSCCodeMapping import HSCodeToSCCodeMapping
 import config
 from data_stores.DataStores import DataStores as ds
 from data_stores.AzureBlobObjects import AzureBlobObjects as abo
@@ -46,13 +50,6 @@ def __getDataframeHeadernameToColumnNumberMapping() -> dict[str,int]:
     values = list(range(0,25))
     return dict(zip(keys, values))
 
-def __isEmpty(string) -> bool:
-    """ Returns true if the given string is '' or None
-    """
-    if string == "" or string == None:
-        return True
-    return False
-
 def __standardizeHSCode(hscode: str) -> str:
     """ Changes hscodes of the various known formats into a standardized format '####.##.##N'
 
@@ -76,122 +73,143 @@ def __standardizeHSCode(hscode: str) -> str:
         raise ValueError()
     return hscode
           
-def __doesHSCodeMatchChapterNumber(hscode: str, chapterNumber: int) -> bool:
-    standardizedHSCode = __standardizeHSCode(hscode)
-    chapterNumberPart = standardizedHSCode[:2] # extract the chapter number part from the standardized hs code
-    if int(chapterNumberPart) == chapterNumber: return True
-    else: return False
+def __standardizeHSCodes(hscodes: np.ndarray) -> np.ndarray:
+    """ __standardizeHSCode of a whole column of HS codes at once (without logging).
+
+    Args:
+        hscodes (np.ndarray): HS codes (str)
+
+    Returns:
+        np.ndarray: Standardized HS codes, None where the HS code is of an unknown format
+    """
+    hscodes = pd.Series(hscodes, dtype=object)
+    lengths = hscodes.str.len()
+    return np.select(
+        [lengths == 7, lengths == 10, lengths == 5], # eg: '8202.10', '8202.10.20', '28.03'
+        [hscodes + '.00N', hscodes + 'N', hscodes.str.replace('.','',regex=False) + '.00.00N'],
+        default=None
+    )
+
+def __excelCellToString(cell) -> str:
+    """Converts an excel cell's value to the string pd.read_excel(dtype=str, na_filter=False) gives for it 
+    (empty cells are '', whole numbers have no decimal point, error cells such as #N/A are left as NaN like pandas does)."""
+    if cell.value is None: return ''
+    if cell.data_type == TYPE_ERROR: return np.nan
+    if cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        if value != cell.value: value = float(cell.value)
+        return str(value)
+    return str(cell.value)
+
+def __readExcelAsStrings(excelFile: BytesIO) -> list[list[str]]:
+    """Reads the first sheet of an excel as rows of strings, streaming it with openpyxl's read-only mode instead of building a dataframe.
+    Gives the same values as pd.read_excel(excelFile, na_filter=False, dtype=str): trailing empty cells and rows are dropped, and rows are padded with '' to the same width.
+
+    Args:
+        excelFile (BytesIO): _description_
+
+    Returns:
+        list[list[str]]: rows, header row included
+    """
+    workbook = oxl.load_workbook(excelFile, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+        sheet.reset_dimensions() # the dimensions saved in the file can be wrong
+        rows = []
+        lastRowWithData = -1
+        for rowNumber, row in enumerate(sheet.iter_rows()):
+            values = [__excelCellToString(cell) for cell in row]
+            while values and values[-1] == '': values.pop()
+            if values: lastRowWithData = rowNumber
+            rows.append(values)
+    finally:
+        workbook.close()
+
+    rows = rows[:lastRowWithData + 1]
+    if rows:
+        width = max(len(row) for row in rows)
+        rows = [row + [''] * (width - len(row)) for row in rows]
+    return rows
 
 def __saveExcelAndDictToJSON2(excelFile: BytesIO, dictStream: BytesIO, chapterNumber: int) -> str:
     """ Reads a single excel file from the specified filepath (and the persisted corresponding pickle dictionary), 
-    and saves it as a .json in the location defined inside the function. Also saves the SCCode to HSCode mapping dictionary to disk.
+    and saves it as a .json in the location defined inside the function.
+    The excel is streamed (see __readExcelAsStrings), and rows are classified with column-wise masks before the items are built.
     ### Args:
         filepath: filepath to the pdf (str)
     """
-    scCodeToHSCodeMapping = {} # this does nothing for now
     # Create an 'enum' that matches a column name with the matching column number in the dataframe
     # ......................................... #
     headerNumber = __getDataframeHeadernameToColumnNumberMapping()
     # ......................................... #
 
 
-    hsToSCMapping = DataStores.getHSCodeToSCCodeMapping()
-   
 
-    df = pd.read_excel(excelFile, na_filter=False, dtype=str)
+    rows = __readExcelAsStrings(excelFile)
     dictionaryForThisPDF: dict = pickle.load(dictStream)
 
-    # drop first and last columns (first column is just pandas row numbers, and last column is my 'LineItem?' column)
-    del df[df.columns[0]]
-    numOfColumns = df.shape[1]
-    del df[df.columns[numOfColumns - 1]]
+    # drop the header row, and first and last columns (first column is just pandas row numbers, and last column is my 'LineItem?' column)
+    values = np.array([row[1:-1] for row in rows[1:]], dtype=object)
+    df = pd.DataFrame(values)
 
     # extract line items with HS codes from the table, only rows with a valid unit are considered to be a valid line item
     # ......................................... #
-    ongoing_prefix = ""
-    ongoing_hshdgname = ""
-    ongoing_hshdg = ""
-    numOfColumns = df.shape[1]
     keysForAnItem = __get_keysForAnItem(df)
     items = []
 
-    def isSeriesALineItem(series, numOfColumns) -> bool:
-        for col in range(4,numOfColumns):
-            value = series.iloc[col]
-            if not __isEmpty(value): return True
-        return False
-
-    numOfRows = df.shape[0] # rows
-
-    # only a row with a non-null unit will be considered a valid item
-    for n in range(0,numOfRows): # starting from 3 because 0-2 are just table headers all over the place
-        current_series = df.loc[n]
-        current_hshdg = current_series.values[headerNumber['HS Hdg']]; 
-        if current_hshdg == None: current_hshdg = ''
-        current_hscode = current_series.values[headerNumber['HS Code']]
-        if current_hscode == None: current_hscode = ''
-        current_description = current_series.values[headerNumber['Description']]
-        if current_description == None: current_description = ''
-
-        if __isEmpty(current_description) or (current_hshdg == "HS Hdg"): # row is considered empty
-            continue
-        if __isEmpty(current_hshdg) and not isSeriesALineItem(current_series, numOfColumns): # description considered a prefix
+    # classify all rows at once with column masks
+    hshdgs = values[:, headerNumber['HS Hdg']]
+    hscodes = values[:, headerNumber['HS Code']]
+    descriptions = values[:, headerNumber['Description']]
+    isLineItemRow = (values[:, 4:] != '').any(axis=1) # only a row with a non-null unit (or any value after it) will be considered a valid item
+    isEmptyRow = (descriptions == '') | (hshdgs == "HS Hdg")
+    isPrefixRow = ~isEmptyRow & (hshdgs == '') & ~isLineItemRow # description considered a prefix
+    isHeadingRow = ~isEmptyRow & (hshdgs != '') & ~isLineItemRow # row has a HS Hdg no. but no HS code no.
+    itemHSCodes = np.where(hscodes == '', hshdgs, hscodes) # an item that has a hs hdg, but no declared hs code, takes the hs hdg as its hs code
+    isItemRow = ~isEmptyRow & isLineItemRow & (itemHSCodes != '')
+    standardizedHSCodes = __standardizeHSCodes(itemHSCodes)
+
+    # the prefix and hs heading carry on from row to row, so only this part is done row by row (and only for rows that are not empty)
+    ongoing_prefix = ""
+    ongoing_hshdgname = ""
+    ongoing_hshdg = ""
+    rowValues = values.tolist()
+    for n in np.flatnonzero(isPrefixRow | isHeadingRow | isItemRow).tolist():
+        current_description = descriptions[n]
+        if isPrefixRow[n]:
             ongoing_prefix = current_description
             continue
-        if (not __isEmpty(current_hshdg)) and not isSeriesALineItem(current_series, numOfColumns): # row has a HS Hdg no. but no HS code no.
-            ongoing_hshdg = current_hshdg
+        if isHeadingRow[n]:
+            ongoing_hshdg = hshdgs[n]
             ongoing_hshdgname = current_description
             ongoing_prefix = "" # reset on-going prefix since we have moved to a new hs hdg
-            if not isSeriesALineItem(current_series, numOfColumns): # not an item
-                continue
-            else:
-                current_hscode = current_hshdg # the hs.hdg is assigned to the hscode
-        if (not __isEmpty(current_hshdg)) and isSeriesALineItem(current_series, numOfColumns) and __isEmpty(current_hscode):
-            current_hscode = current_hshdg
-        if isSeriesALineItem(current_series, numOfColumns) and not __isEmpty(current_hscode): # this is a valid item
-            # create a json item
-            values = [ongoing_prefix] + [ongoing_hshdgname] + list(df.loc[n].values)
-            item = dict(zip(keysForAnItem, values))
-            item.pop('Blank',item['Blank'])
-            item['HS Hdg'] = ongoing_hshdg
-            try: standardizedHSCode = __standardizeHSCode(current_hscode)
-            except Exception as e: 
-                standardizedHSCode = current_hscode
+            continue
+
+        # this is a valid item, create a json item
+        standardizedHSCode = standardizedHSCodes[n]
+        if standardizedHSCode == None:
+            current_hscode = itemHSCodes[n]
+            try: __standardizeHSCode(current_hscode) # logs the unknown format
+            except Exception as e:
                 logging.error(current_hscode)
-                logging.error("Exception occured at Hs hdg: " + current_hshdg + " current description: " + current_description + " prefix: " + ongoing_prefix)
+                logging.error("Exception occured at Hs hdg: " + hshdgs[n] + " current description: " + current_description + " prefix: " + ongoing_prefix)
                 logging.error(type(e))
                 logging.error(e)
-                continue # skip this row
-            item['HS Code'] =  standardizedHSCode# this value will be added explicitly in case this is an item that has a hs hdg, but no declared hs code
-
-            if not __doesHSCodeMatchChapterNumber(current_hscode, chapterNumber):
-                raise Exception("User entered chapter number does not match at least one of the valid HS codes in the excel file")
-
-            standardizedHSCode2 = standardizedHSCode[:-3] + "00N"
-            standardizedHSCode3 = standardizedHSCode2[:-6]+"00.00N"
-            if standardizedHSCode in hsToSCMapping:
-                item['SC Code'] = hsToSCMapping[standardizedHSCode]
-            elif standardizedHSCode2 in hsToSCMapping:
-                item['SC Code'] = hsToSCMapping[standardizedHSCode2]
-            elif standardizedHSCode3 in hsToSCMapping:
-                item['SC Code'] = hsToSCMapping[standardizedHSCode3]
-            else:
-                item['SC Code'] = ''
-            # if numOfColumns == 24: # some pdf tables don't have a cess column split into GEN and SG
-            #     item["Cess_SG"] = ''
-            items.append(item)
-
-            if item['SC Code'] == '':
-                pass
-            elif item['SC Code'] in scCodeToHSCodeMapping:
-                scCodeToHSCodeMapping[item['SC Code']].append(item['HS Code'])
-            else:
-                scCodeToHSCodeMapping[item['SC Code']] = [item['HS Code']]
-
-            #if description contains "other", reset prefix
-            current_description_uppercase = current_description.upper()
-            if "OTHER" in current_description_uppercase:
-                ongoing_prefix = "" # reset on-going prefix since we have reached "other" description
+            continue # skip this row
+        item = dict(zip(keysForAnItem, [ongoing_prefix, ongoing_hshdgname] + rowValues[n]))
+        item.pop('Blank',item['Blank'])
+        item['HS Hdg'] = ongoing_hshdg
+        item['HS Code'] = standardizedHSCode
+
+        if int(standardizedHSCode[:2]) != chapterNumber: # the chapter number part of the standardized hs code
+            raise Exception("User entered chapter number does not match at least one of the valid HS codes in the excel file")
+
+        item['SC Code'] = HSCodeToSCCodeMapping.getSCCode(standardizedHSCode) # '' if not mapped
+        items.append(item)
+
+        #if description contains "other", reset prefix
+        if "OTHER" in current_description.upper():
+            ongoing_prefix = "" # reset on-going prefix since we have reached "other" description
             
     # ......................................... #
         
@@ -232,8 +250,8 @@ def extract_data_to_json_store(excelfile: BytesIO, mutexKey: str, chapterNumber:
     abo.upload_to_blob_from_stream(excelfile, config.reviewedExcel_container_name,  f'{release_date}/{chapterNumber}.xlsx') # Excel uploaded to Azure blob
     logging.info('Excel @ ' + f'{release_date}/{chapterNumber}.xlsx' + ' successfully uploaded')
     ato.edit_chapter_record(chapterNumber, mutexKey, release_date, newRecordStatus=config.RecordStatus.uploadingJson)
-    abo.upload_to_blob_from_stream(json_stream, config.json_container_name,  f'{release_date}/{chapterNumber}.json') # Json uploaded to Azure blob
-    ds.insertNewJSONDictManually(json_string, int(chapterNumber), release_date)
+    uploaded_json_properties = abo.upload_to_blob_from_stream(json_stream, config.json_container_name,  f'{release_date}/{chapterNumber}.json') # Json uploaded to Azure blob
+    ds.insertNewJSONDictManually(json_string, int(chapterNumber), release_date, etag=uploaded_json_properties.get('etag'))
     logging.info(f"Uploaded json for chapternumber {chapterNumber} of release {release_date}")
     return True
 
@@ -0,0 +1,24 @@
+import threading
+
+class MemoryBudget:
+    """Limits the (estimated) memory used by tasks running at the same time, eg: PDFs being processed concurrently by a batch upload.
+    A task that needs more than the whole budget is still let through once nothing else is running, so it never waits forever.
+    """
+
+    def __init__(self, budgetBytes: int) -> None:
+        self.__budgetBytes = budgetBytes
+        self.__inUseBytes = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self, numOfBytes: int):
+        """Blocks until numOfBytes fit within the budget, then reserves them."""
+        with self.__condition:
+            while self.__inUseBytes > 0 and self.__inUseBytes + numOfBytes > self.__budgetBytes:
+                self.__condition.wait()
+            self.__inUseBytes += numOfBytes
+
+    def release(self, numOfBytes: int):
+        """Returns bytes reserved by acquire to the budget."""
+        with self.__condition:
+            self.__inUseBytes -= numOfBytes
+            self.__condition.notify_all()
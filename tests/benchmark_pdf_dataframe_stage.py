@@ -0,0 +1,185 @@
+# Micro-benchmark of the dataframe stage of the PDF to excel conversion (extract_data_for_review): new line removal and row classification.
+# Compares it with the previous per-cell implementation on a synthetic 5,000-row table, and checks both give the same result.
+# Run from the repository root: python -m tests.benchmark_pdf_dataframe_stage
+
+import random
+import time
+
+import pandas as pd
+
+import initializers.extract_data_for_review as extract_data_for_review
+
+removeNewLineCharactersFromDataframe = vars(extract_data_for_review)['__removeNewLineCharactersFromDataframe']
+classifyRows = vars(extract_data_for_review)['__classifyRows']
+
+NUM_OF_ROWS = 5000
+NUM_OF_COLUMNS = 24
+
+def make_synthetic_table(numOfRows: int) -> pd.DataFrame:
+    """Builds a table shaped like one extracted from a tariff PDF: header rows, HS headings, prefixes, line items (some with broken HS codes) and blank rows."""
+    random.seed(0)
+    rows = []
+    header = ['HS Hdg', 'HS Code', None, 'Description', 'Unit', 'ICL/SLSI', 'Preferential\nDuty'] + [None] * (NUM_OF_COLUMNS - 7)
+    for n in range(numOfRows):
+        kind = random.random()
+        row = [None] * NUM_OF_COLUMNS
+        if n % 500 == 0: row = list(header)
+        elif kind < 0.1: pass # blank row
+        elif kind < 0.2: row[0], row[3] = f'{random.randint(1,99):02}.{random.randint(1,99):02}', 'Heading\ndescription'
+        elif kind < 0.3: row[3] = '- Prefix\ndescription:'
+        else:
+            row[0] = random.choice(['', None, f'{random.randint(1,99):02}.{random.randint(1,99):02}'])
+            row[1] = random.choice(['8202.10', '8202.10.20', '', None, '8202.1'])
+            row[3] = random.choice(['-- Other', 'Line item\ndescription'])
+            row[4] = random.choice(['kg', 'u', '', None])
+            row[16] = random.choice(['15%', 'Free', None])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+# The previous implementation, copied unchanged from the baseline commit: its helper functions, and the row classification loop of __get_excel_and_dictionary_from_pdf.
+
+def __removeNewLineCharactersFromDataframe(dataframe):
+    """Removes new line character ('\n') from the dataframe. Done in place. Returns void.
+    """
+    numOfRows = dataframe.shape[0]
+    numOfCols = dataframe.shape[1]
+    for r in range(0,numOfRows):
+        for c in range(0,numOfCols):
+            if dataframe.iloc[r,c] == None: continue
+            dataframe.iloc[r,c] = dataframe.iloc[r,c].replace('\n',' ')
+    
+def __isSeriesALineItem(series, numOfColumns) -> bool:
+    """Checks if a dataframe row (i.e. a series), qualifies as a line item (i.e. has values from the unit column onwards)"""
+    for col in range(4,numOfColumns):
+        value = series.iloc[col]
+        if not __isEmpty(value): return True
+    return False
+
+def __getDataframeHeadernameToColumnNumberMapping() -> dict[str,int]:
+    """Returns a dictionary mapping an easy to use column name for the dataframe, with its corresponsing column number.
+    """
+    keys = ["HS Hdg", 
+            "HS Code", 
+            "Blank",
+            "Description", 
+            "Unit",
+            "ICL/SLSI",
+            "Preferential Duty_AP",
+            "Preferential Duty_AD",
+            "Preferential Duty_BN",
+            "Preferential Duty_GT",
+            "Preferential Duty_IN",
+            "Preferential Duty_PK",
+            "Preferential Duty_SA",
+            "Preferential Duty_SF",
+            "Preferential Duty_SD",
+            "Preferential Duty_SG",
+            "Gen Duty",
+            "VAT",
+            "PAL_Gen",
+            "PAL_SG",
+            "Cess_GEN",
+            "Cess_SG",
+            "Excise SPD",
+            "SSCL",
+            "SCL"]
+    values = list(range(0,25))
+    return dict(zip(keys, values))
+
+def __isEmpty(string) -> bool:
+    """ Returns true if the given string is '' or None
+    """
+    if string == "" or string == None:
+        return True
+    return False
+
+def __standardizeHSCode(hscode: str) -> str:
+    """ Changes hscodes of the various known formats into a standardized format '####.##.##N'
+
+    Args:
+        hscode: (str) The HS Code to be standardized
+    Returns:
+        Standardized HS Code (str)
+    Raises:
+        ValueError - if HS Code of unknown format is passed in.
+    """
+    if len(hscode) == 7: # eg: '8202.10'
+        hscode += '.00N'
+    elif len(hscode) == 10: # eg: '8202.10.20'
+        hscode += 'N'
+    elif len(hscode) == 5: # eg: '28.03'
+        hscode = hscode.replace('.','')
+        hscode += '.00.00N'
+    else:
+        raise ValueError("HS Code of unknown format passed in: {}".format(hscode))
+    return hscode
+
+def legacy_stage(df: pd.DataFrame):
+    """The previous implementation (per-cell iloc writes, and df.loc per row with a Python loop over the columns), run as __get_excel_and_dictionary_from_pdf ran it."""
+    headerNumber = __getDataframeHeadernameToColumnNumberMapping()
+    __removeNewLineCharactersFromDataframe(df)
+    df['LineItem?'] = None
+
+    # extract line items with HS codes from the table, only rows with a valid unit are considered to be a valid line item
+    # ......................................... #
+    ongoing_prefix = ""
+    numOfColumns = df.shape[1]
+    
+    numOfRows = df.shape[0] # rows
+    # only a row with a non-null unit will be considered a valid item
+    for n in range(0,numOfRows): # starting from 3 because 0-2 are just table headers all over the place
+        current_series = df.loc[n]
+        current_hshdg = current_series.values[headerNumber['HS Hdg']]; 
+        if current_hshdg == None: current_hshdg = ''
+        current_hscode = current_series.values[headerNumber['HS Code']]
+        if current_hscode == None: current_hscode = ''
+        current_description = current_series.values[headerNumber['Description']]
+        if current_description == None: current_description = ''
+
+        if __isEmpty(current_description) or (current_hshdg == "HS Hdg"): # row is considered empty
+            df.loc[n, 'LineItem?'] = 'empty'
+            continue
+        if __isEmpty(current_hshdg) and not __isSeriesALineItem(current_series, numOfColumns): # description considered a prefix
+            df.loc[n, 'LineItem?'] = 'prefix'
+            ongoing_prefix = current_description
+            continue
+        if (not __isEmpty(current_hshdg)) and not __isSeriesALineItem(current_series, numOfColumns): # row has a HS Hdg no. but no HS code no.
+            df.loc[n, 'LineItem?'] = 'just HS heading'
+            ongoing_prefix = "" # reset on-going prefix since we have moved to a new hs hdg
+            if not __isSeriesALineItem(current_series, numOfColumns): # not an item
+                continue
+            else:
+                current_hscode = current_hshdg # the hs.hdg is assigned to the hscode
+        if (not __isEmpty(current_hshdg)) and __isSeriesALineItem(current_series, numOfColumns) and __isEmpty(current_hscode):
+            current_hscode = current_hshdg
+        if __isSeriesALineItem(current_series, numOfColumns): # this is a valid item
+            # create a json item
+            df.loc[n, 'LineItem?'] = 'line item'
+            try: __standardizeHSCode(current_hscode)
+            except Exception as e: 
+                df.loc[n, 'LineItem?'] = 'hscode error'
+                # logging.error("Exception occured at Hs hdg: " + current_hshdg + " current description: " + current_description + " prefix: " + ongoing_prefix)
+                # logging.error(type(e))
+                # logging.error(e)
+
+            #if description contains "other", reset prefix
+            current_description_uppercase = current_description.upper()
+            if "OTHER" in current_description_uppercase:
+                ongoing_prefix = "" # reset on-going prefix since we have reached "other" description
+
+def current_stage(dataframe: pd.DataFrame):
+    """The current implementation (column-wise string operations and boolean masks)."""
+    removeNewLineCharactersFromDataframe(dataframe)
+    dataframe['LineItem?'] = classifyRows(dataframe)
+
+if __name__ == '__main__':
+    table = make_synthetic_table(NUM_OF_ROWS)
+    results = {}
+    for name, stage in [('legacy', legacy_stage), ('current', current_stage)]:
+        dataframe = table.copy()
+        startTime = time.perf_counter()
+        stage(dataframe)
+        print(f'{name}: {time.perf_counter() - startTime:.3f} s for {NUM_OF_ROWS} rows x {NUM_OF_COLUMNS} columns')
+        results[name] = dataframe
+    print('same result:', results['legacy'].equals(results['current']))
+    print(results['current']['LineItem?'].value_counts().to_string())
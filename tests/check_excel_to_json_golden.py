@@ -0,0 +1,86 @@
+# Golden check of the reviewed excel to json conversion (extract_data_to_json_store): the json must be byte-identical to the expected json stored in
+# tests/golden (one file per known column header layout), for synthetic reviewed excels of that layout, including cells a reviewer may have retyped
+# as numbers, dates or excel errors. The expected json was made by the pd.read_excel/df.loc implementation the conversion replaced.
+# The SC codes in it come from files/HSCode_to_SCCode_Mapping Sorted.csv, so the files must be made again (--regenerate) if that mapping changes.
+# Run from the repository root: python -m tests.check_excel_to_json_golden [--regenerate]
+
+import os
+import sys
+import pickle
+import random
+import time
+import datetime
+from io import BytesIO
+
+import pandas as pd
+
+import initializers.extract_data_to_json_store as extract_data_to_json_store
+
+saveExcelAndDictToJSON = vars(extract_data_to_json_store)['__saveExcelAndDictToJSON2']
+
+CHAPTER_NUMBER = 82
+GOLDEN_DIRECTORY = os.path.join(os.path.dirname(__file__), 'golden')
+HEADER_LAYOUTS = { # columns after 'Cess': (top header row, bottom header row)
+    'cess_gen_sg, excise, surcharge': (['Cess', '', 'Excise', 'Surcharge', 'SSCL', 'SCL'], ['GEN', 'SG', '', '', '', '']),
+    'cess, excise': (['Cess', 'Excise', 'SSCL', 'SCL'], ['', '', '', '']),
+    'cess_gen_sg, surcharge': (['Cess', '', 'Surcharge', 'SSCL', 'SCL'], ['GEN', 'SG', '', '', '']),
+}
+
+def make_reviewed_excel(layout: str, numOfRows: int, seed: int) -> BytesIO:
+    """Builds an excel shaped like the one the PDF stage generates for review (pandas row numbers, table columns, 'LineItem?'), with some retyped cells."""
+    random.seed(seed)
+    top, bottom = HEADER_LAYOUTS[layout]
+    rows = [['pre-table text'] + [None] * (19 + len(top)),
+            ['HS Hdg', 'HS Code', None, 'Description', 'Unit', 'ICL/SLSI', 'Preferential Duty'] + [None] * 9 + ['Gen Duty', 'VAT', 'PAL', None] + top,
+            [None] * 6 + ['AP','AD','BN','GT','IN','PK','SA','SF','SD','SG'] + [None, None, 'Gen', 'SG'] + bottom]
+    for _ in range(numOfRows):
+        row = [None] * len(rows[1])
+        kind = random.random()
+        if kind < 0.1: pass # blank row
+        elif kind < 0.2: row[0], row[3] = f'{CHAPTER_NUMBER}.{random.randint(1,99):02}', 'Heading description'
+        elif kind < 0.35: row[3] = random.choice(['- Prefix:', '- Other prefix:'])
+        else:
+            row[0] = random.choice(['', None, f'{CHAPTER_NUMBER}.{random.randint(1,99):02}'])
+            row[1] = random.choice(['8202.10', '8202.10.20', '', None, '8202.1', '8201.90.10', '8201.10', '82.01'])
+            row[3] = random.choice(['-- Other', 'Line item description', 'Other than '])
+            row[4] = random.choice(['kg', 'u', '', None])
+            for col in range(5, len(row)): row[col] = random.choice([None, '', 'Free', '15%', 'Ex', '10'])
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    df['LineItem?'] = 'line item'
+
+    excel_stream = BytesIO()
+    with pd.ExcelWriter(excel_stream, engine='openpyxl') as writer:
+        df.to_excel(writer)
+        sheet = writer.sheets['Sheet1']
+        for rowNumber in range(5, sheet.max_row + 1, 7): # cells retyped by a reviewer
+            sheet.cell(rowNumber, 18).value = random.choice([15, 2.5, 0.0, 1e20, True])
+            sheet.cell(rowNumber, 19).value = random.choice([datetime.datetime(2024, 11, 18), '#N/A', ' Free '])
+    excel_stream.seek(0)
+    return excel_stream
+
+def get_golden_path(layout: str) -> str:
+    return os.path.join(GOLDEN_DIRECTORY, 'excel_to_json_' + layout.replace(', ', '__') + '.json')
+
+def run(excel: BytesIO, dictionary: dict) -> tuple[str, float]:
+    startTime = time.perf_counter()
+    try: result = saveExcelAndDictToJSON(excel, BytesIO(pickle.dumps(dictionary)), CHAPTER_NUMBER)
+    except Exception as e: result = f'raised {type(e).__name__}: {e}'
+    return result, time.perf_counter() - startTime
+
+if __name__ == '__main__':
+    regenerate = '--regenerate' in sys.argv[1:]
+    dictionary = {"Chapter Number": CHAPTER_NUMBER, "Chapter Name": "Tools", "Pre-Table Notes": "Notes.", "Items": None}
+    allIdentical = True
+    for seed, layout in enumerate(HEADER_LAYOUTS):
+        result, seconds = run(make_reviewed_excel(layout, 1000, seed), dictionary)
+        if regenerate:
+            os.makedirs(GOLDEN_DIRECTORY, exist_ok=True)
+            with open(get_golden_path(layout), 'wb') as file: file.write(result.encode('utf-8'))
+            print(f'{layout}: expected json written ({len(result)} characters), {seconds:.2f} s')
+            continue
+        with open(get_golden_path(layout), 'rb') as file: golden = file.read()
+        identical = result.encode('utf-8') == golden
+        allIdentical = allIdentical and identical
+        print(f'{layout}: {"identical" if identical else "DIFFERENT"} json ({len(result)} characters), {seconds:.2f} s')
+    if not regenerate: print('PASS' if allIdentical else 'FAIL')